@@ -174,6 +174,17 @@ class ParseError(BaseAPIClientError):
     message = 'Parse Error'
 
 
+class RequestTooLarge(BaseAPIClientError):
+    """
+    Response given when the request body exceeds the size limit.
+    """
+
+    code = 413
+    domain = 'global'
+    reason = 'requestTooLarge'
+    message = 'Request Entity Too Large'
+
+
 class ServiceUnavailable(BaseAPIServiceError):
     """
     Response given when the service is (partially) unavailable.
@@ -1,8 +1,19 @@
 from random import randint
+from threading import (
+    Lock,
+    Thread,
+)
+import time
 
+from redis import RedisError
 from repoze import lru
 from sqlalchemy import select
 
+from ichnaea.config import (
+    API_KEY_CACHE_NEGATIVE_SIZE,
+    API_KEY_CACHE_SIZE,
+)
+from ichnaea.db import db_worker_session
 from ichnaea.models import ApiKey
 from ichnaea.models.constants import VALID_APIKEY_REGEX
 
@@ -10,7 +21,11 @@ _MARKER = object()
 
 # Five minutes +/- 10% cache timeout.
 API_CACHE_TIMEOUT = 300 + randint(-30, 30)
-API_CACHE = lru.ExpiringLRUCache(500, default_timeout=API_CACHE_TIMEOUT)
+# Serve expired entries for up to another five minutes, while
+# they are being refreshed.
+API_CACHE_STALE_TIMEOUT = 300
+# Redis pub/sub channel used to invalidate cached API keys.
+API_CACHE_CHANNEL = 'api_key_invalidate'
 
 _API_KEY_COLUMN_NAMES = (
     'valid_key', 'maxreq',
@@ -21,23 +36,196 @@ _API_KEY_COLUMN_NAMES = (
 )
 
 
-def get_key(session, valid_key):
-    value = API_CACHE.get(valid_key, _MARKER)
-    if value is _MARKER:
-        columns = ApiKey.__table__.c
-        fields = [getattr(columns, f) for f in _API_KEY_COLUMN_NAMES]
-        row = (
-            session.execute(
-                select(fields)
-                .where(columns.valid_key == valid_key))
-        ).fetchone()
-        if row is not None:
-            # Create Key from sqlalchemy.engine.result.RowProxy
-            value = Key(**dict(row.items()))
+def _load_key(session, valid_key):
+    columns = ApiKey.__table__.c
+    fields = [getattr(columns, f) for f in _API_KEY_COLUMN_NAMES]
+    row = (
+        session.execute(
+            select(fields)
+            .where(columns.valid_key == valid_key))
+    ).fetchone()
+    if row is not None:
+        # Create Key from sqlalchemy.engine.result.RowProxy
+        return Key(**dict(row.items()))
+    return None
+
+
+class ApiKeyCache(object):
+    """
+    A per-process cache of :class:`~ichnaea.api.key.Key` instances.
+
+    Known keys are fresh for `timeout` seconds. Afterwards they are
+    served stale for up to `stale_timeout` seconds, while they are
+    refreshed in the background. Unknown keys are kept in a separate,
+    smaller cache, so they cannot evict known keys.
+
+    Only one caller loads any given key from the database at a time,
+    concurrent callers wait for its result.
+
+    Keys can be invalidated across all processes by publishing them
+    on the :data:`~ichnaea.api.key.API_CACHE_CHANNEL` Redis channel,
+    see :func:`~ichnaea.api.key.invalidate_key`.
+    """
+
+    poll_interval = 1.0  # How often to check for invalidations.
+
+    def __init__(self, size=500, negative_size=1000,
+                 timeout=API_CACHE_TIMEOUT,
+                 stale_timeout=API_CACHE_STALE_TIMEOUT):
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self._cache = lru.LRUCache(size)
+        self._negative = lru.ExpiringLRUCache(
+            negative_size, default_timeout=timeout)
+        self._lock = Lock()
+        self._loading = {}
+        self._refreshing = set()
+        self._pubsub = None
+        self._last_poll = 0.0
+
+    def clear(self):
+        self._cache.clear()
+        self._negative.clear()
+
+    def invalidate(self, valid_key):
+        self._cache.invalidate(valid_key)
+        self._negative.invalidate(valid_key)
+
+    def subscribe(self, redis_client):
+        """
+        Start listening for invalidations on the Redis channel,
+        closing any earlier subscription.
+        """
+        self.unsubscribe()
+        self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(API_CACHE_CHANNEL)
+
+    def unsubscribe(self):
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def _poll(self, now):
+        if self._pubsub is None or now - self._last_poll < self.poll_interval:
+            return
+        self._last_poll = now
+        try:
+            message = self._pubsub.get_message()
+            while message is not None:
+                if message['type'] == 'message':
+                    self.invalidate(message['data'].decode('utf-8'))
+                message = self._pubsub.get_message()
+        except RedisError:  # pragma: no cover
+            # Forget about all keys, as we might have missed messages.
+            self.clear()
+
+    def _put(self, valid_key, value):
+        if value is None:
+            self._cache.invalidate(valid_key)
+            self._negative.put(valid_key, None)
         else:
-            value = None
-        API_CACHE.put(valid_key, value)
-    return value
+            self._cache.put(valid_key, (value, time.time() + self.timeout))
+
+    def _load(self, session, valid_key):
+        with self._lock:
+            lock = self._loading.get(valid_key)
+            owner = lock is None
+            if owner:
+                lock = self._loading[valid_key] = Lock()
+                lock.acquire()
+
+        if not owner:
+            # Wait for the concurrent load and use its result.
+            with lock:
+                pass
+            value = self._cache.get(valid_key, _MARKER)
+            if value is not _MARKER:
+                return value[0]
+            value = self._negative.get(valid_key, _MARKER)
+            if value is not _MARKER:
+                return value
+
+        try:
+            value = _load_key(session, valid_key)
+            self._put(valid_key, value)
+            return value
+        finally:
+            if owner:
+                with self._lock:
+                    del self._loading[valid_key]
+                lock.release()
+
+    def _refresh(self, database, valid_key):
+        try:
+            with db_worker_session(database, commit=False) as session:
+                self._put(valid_key, _load_key(session, valid_key))
+        except Exception:  # pragma: no cover
+            # Keep serving the stale value until it runs out.
+            pass
+        finally:
+            self._refreshing.discard(valid_key)
+
+    def _refresh_inline(self, session, valid_key):
+        try:
+            self._put(valid_key, _load_key(session, valid_key))
+        finally:
+            self._refreshing.discard(valid_key)
+
+    def _stat_count(self, stats_client, status):
+        if stats_client is not None:
+            stats_client.incr('api.key.cache', tags=['status:' + status])
+
+    def get(self, session, valid_key, database=None, stats_client=None):
+        """
+        Return the cached key or load it from the database.
+
+        :param database: If given, stale keys are refreshed in a
+                         background thread using a separate session.
+        """
+        now = time.time()
+        self._poll(now)
+
+        value = self._cache.get(valid_key, _MARKER)
+        if value is not _MARKER:
+            key, expires = value
+            if now < expires:
+                self._stat_count(stats_client, 'hit')
+                return key
+            if now < expires + self.stale_timeout:
+                self._stat_count(stats_client, 'stale')
+                if valid_key not in self._refreshing:
+                    self._refreshing.add(valid_key)
+                    if database is None:
+                        self._refresh_inline(session, valid_key)
+                    else:
+                        Thread(target=self._refresh,
+                               args=(database, valid_key),
+                               daemon=True).start()
+                return key
+
+        value = self._negative.get(valid_key, _MARKER)
+        if value is not _MARKER:
+            self._stat_count(stats_client, 'negative')
+            return value
+
+        self._stat_count(stats_client, 'miss')
+        return self._load(session, valid_key)
+
+
+API_CACHE = ApiKeyCache(size=API_KEY_CACHE_SIZE,
+                        negative_size=API_KEY_CACHE_NEGATIVE_SIZE)
+
+
+def get_key(session, valid_key, database=None, stats_client=None):
+    return API_CACHE.get(session, valid_key,
+                         database=database, stats_client=stats_client)
+
+
+def invalidate_key(redis_client, valid_key):
+    """
+    Remove the API key from the caches of all web processes.
+    """
+    redis_client.publish(API_CACHE_CHANNEL, valid_key)
 
 
 def validated_key(text):
@@ -42,17 +42,22 @@ class BluePositionMixin(object):
     def search_blue(self, query):
         results = self.result_list()
 
-        blues = query_macs(query, query.blue, self.raven_client, BlueShard)
-        for cluster in cluster_networks(blues, query.blue,
-                                        min_radius=BLUE_MIN_ACCURACY,
-                                        min_signal=MIN_BLUE_SIGNAL,
-                                        max_distance=MAX_BLUE_CLUSTER_METERS):
-            result = aggregate_cluster_position(
-                cluster, self.result_type, 'blue',
-                max_networks=MAX_BLUES_IN_CLUSTER,
-                min_accuracy=BLUE_MIN_ACCURACY,
-                max_accuracy=BLUE_MAX_ACCURACY,
-            )
+        with query.timer.stage('fetch', 'blue'):
+            blues = query_macs(query, query.blue, self.raven_client, BlueShard)
+        with query.timer.stage('cluster', 'blue'):
+            clusters = cluster_networks(
+                blues, query.blue,
+                min_radius=BLUE_MIN_ACCURACY,
+                min_signal=MIN_BLUE_SIGNAL,
+                max_distance=MAX_BLUE_CLUSTER_METERS)
+        for cluster in clusters:
+            with query.timer.stage('aggregate', 'blue'):
+                result = aggregate_cluster_position(
+                    cluster, self.result_type, 'blue',
+                    max_networks=MAX_BLUES_IN_CLUSTER,
+                    min_accuracy=BLUE_MIN_ACCURACY,
+                    max_accuracy=BLUE_MAX_ACCURACY,
+                )
             results.add(result)
 
         return results
@@ -75,7 +80,8 @@ class BlueRegionMixin(object):
 
         now = util.utcnow()
         regions = defaultdict(int)
-        blues = query_macs(query, query.blue, self.raven_client, BlueShard)
+        with query.timer.stage('fetch', 'blue'):
+            blues = query_macs(query, query.blue, self.raven_client, BlueShard)
         for blue in blues:
             regions[blue.region] += station_score(blue, now)
 
@@ -234,12 +234,16 @@ class CellPositionMixin(object):
         results = self.result_list()
 
         if query.cell:
-            cells = query_cells(
-                query, query.cell, self.cell_model, self.raven_client)
+            with query.timer.stage('fetch', 'cell'):
+                cells = query_cells(
+                    query, query.cell, self.cell_model, self.raven_client)
             if cells:
-                for cluster in cluster_cells(cells, query.cell):
-                    lat, lon, accuracy, score = aggregate_cell_position(
-                        cluster, CELL_MIN_ACCURACY, CELL_MAX_ACCURACY)
+                with query.timer.stage('cluster', 'cell'):
+                    clusters = cluster_cells(cells, query.cell)
+                for cluster in clusters:
+                    with query.timer.stage('aggregate', 'cell'):
+                        lat, lon, accuracy, score = aggregate_cell_position(
+                            cluster, CELL_MIN_ACCURACY, CELL_MAX_ACCURACY)
 
                     used_networks = [
                         ('cell', bytes(id_), bool(seen_today)) for
@@ -253,12 +257,17 @@ class CellPositionMixin(object):
                 return results
 
         if query.cell_area:
-            areas = query_areas(
-                query, query.cell_area, self.area_model, self.raven_client)
+            with query.timer.stage('fetch', 'area'):
+                areas = query_areas(
+                    query, query.cell_area, self.area_model, self.raven_client)
             if areas:
-                for cluster in cluster_areas(areas, query.cell_area):
-                    lat, lon, accuracy, score = aggregate_cell_position(
-                        cluster, CELLAREA_MIN_ACCURACY, CELLAREA_MAX_ACCURACY)
+                with query.timer.stage('cluster', 'area'):
+                    clusters = cluster_areas(areas, query.cell_area)
+                for cluster in clusters:
+                    with query.timer.stage('aggregate', 'area'):
+                        lat, lon, accuracy, score = aggregate_cell_position(
+                            cluster,
+                            CELLAREA_MIN_ACCURACY, CELLAREA_MAX_ACCURACY)
 
                     used_networks = [
                         ('area', bytes(id_), bool(seen_today)) for
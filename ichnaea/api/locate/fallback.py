@@ -3,13 +3,12 @@ Implementation of a fallback source using an external web service.
 """
 
 from collections import defaultdict, namedtuple
-import time
+import struct
 
 import colander
 import numpy
 from requests.exceptions import RequestException
 from redis import RedisError
-import simplejson
 
 from ichnaea.api.schema import (
     BoundedFloat,
@@ -20,11 +19,20 @@ from ichnaea.api.schema import (
 )
 from ichnaea.api.locate.constants import DataSource
 from ichnaea.api.locate.source import PositionSource
-from ichnaea.api.rate_limit import rate_limit_exceeded
+from ichnaea.api.rate_limit import gcra_rate_limit_exceeded
+from ichnaea import codec
+from ichnaea.config import FALLBACK_CACHE_COMPACT
 from ichnaea.geocalc import distance
 
 # Magic constant to cache not found.
 LOCATION_NOT_FOUND = '404'
+# Compact single byte representation of the not found marker.
+LOCATION_NOT_FOUND_COMPACT = b'\x00'
+
+# Binary layout of a cached result: lat, lon, accuracy and an index
+# into the FALLBACK_VALUES tuple.
+CACHE_VALUE_STRUCT = struct.Struct('!dddB')
+FALLBACK_VALUES = (None, 'lacf')
 
 # Supported fallback schemata
 COMBAIN_V1_SCHEMA = 'combain/v1'
@@ -266,29 +274,29 @@ class FallbackCache(object):
     # we cache contents changes.
     cache_keys = {
         COMBAIN_V1_SCHEMA: {
-            'fallback_blue': b'cache:fallback:combain:v1:1:blue:',
-            'fallback_cell': b'cache:fallback:combain:v1:1:cell:',
-            'fallback_wifi': b'cache:fallback:combain:v1:1:wifi:',
+            'fallback_blue': b'cache:fallback:combain:v1:2:blue:',
+            'fallback_cell': b'cache:fallback:combain:v1:2:cell:',
+            'fallback_wifi': b'cache:fallback:combain:v1:2:wifi:',
         },
         GOOGLEMAPS_V1_SCHEMA: {
-            'fallback_blue': b'cache:fallback:googlemaps:v1:1:blue:',
-            'fallback_cell': b'cache:fallback:googlemaps:v1:1:cell:',
-            'fallback_wifi': b'cache:fallback:googlemaps:v1:1:wifi:',
+            'fallback_blue': b'cache:fallback:googlemaps:v1:2:blue:',
+            'fallback_cell': b'cache:fallback:googlemaps:v1:2:cell:',
+            'fallback_wifi': b'cache:fallback:googlemaps:v1:2:wifi:',
         },
         ICHNAEA_V1_SCHEMA: {
-            'fallback_blue': b'cache:fallback:ichnaea:v1:1:blue:',
-            'fallback_cell': b'cache:fallback:ichnaea:v1:1:cell:',
-            'fallback_wifi': b'cache:fallback:ichnaea:v1:1:wifi:',
+            'fallback_blue': b'cache:fallback:ichnaea:v1:2:blue:',
+            'fallback_cell': b'cache:fallback:ichnaea:v1:2:cell:',
+            'fallback_wifi': b'cache:fallback:ichnaea:v1:2:wifi:',
         },
         UNWIREDLABS_V1_SCHEMA: {
-            'fallback_blue': b'cache:fallback:unwiredlabs:v1:1:blue:',
-            'fallback_cell': b'cache:fallback:unwiredlabs:v1:1:cell:',
-            'fallback_wifi': b'cache:fallback:unwiredlabs:v1:1:wifi:',
+            'fallback_blue': b'cache:fallback:unwiredlabs:v1:2:blue:',
+            'fallback_cell': b'cache:fallback:unwiredlabs:v1:2:cell:',
+            'fallback_wifi': b'cache:fallback:unwiredlabs:v1:2:wifi:',
         }
     }
 
     def __init__(self, raven_client, redis_client, stats_client,
-                 schema=DEFAULT_SCHEMA):
+                 schema=DEFAULT_SCHEMA, compact_not_found=True):
         self.raven_client = raven_client
         self.redis_client = redis_client
         self.stats_client = stats_client
@@ -296,6 +304,37 @@ class FallbackCache(object):
         self.cache_key_blue = self.cache_keys[schema]['fallback_blue']
         self.cache_key_cell = self.cache_keys[schema]['fallback_cell']
         self.cache_key_wifi = self.cache_keys[schema]['fallback_wifi']
+        if compact_not_found:
+            self.not_found_value = LOCATION_NOT_FOUND_COMPACT
+        else:
+            self.not_found_value = LOCATION_NOT_FOUND.encode('ascii')
+
+    def _pack(self, result):
+        """
+        Return the binary cache representation of the given result.
+        """
+        if result.not_found():
+            return self.not_found_value
+        return CACHE_VALUE_STRUCT.pack(
+            result.lat, result.lon, result.accuracy,
+            FALLBACK_VALUES.index(result.fallback))
+
+    def _unpack(self, value):
+        """
+        Return an :class:`~ichnaea.api.locate.fallback.ExternalResult`
+        for the given binary cache value.
+
+        :raises: :exc:`struct.error`
+        """
+        if value in (LOCATION_NOT_FOUND_COMPACT,
+                     LOCATION_NOT_FOUND.encode('ascii')):
+            return ExternalResult(None, None, None, None)
+        lat, lon, accuracy, fallback = CACHE_VALUE_STRUCT.unpack(value)
+        try:
+            fallback = FALLBACK_VALUES[fallback]
+        except IndexError:
+            raise struct.error('Invalid fallback value: %s' % fallback)
+        return ExternalResult(lat, lon, accuracy, fallback)
 
     def _stat_count(self, fallback_name, status):
         tags = ['fallback_name:%s' % fallback_name,
@@ -378,17 +417,15 @@ class FallbackCache(object):
                 if not value:
                     continue
 
-                value = simplejson.loads(value)
-                if value == LOCATION_NOT_FOUND:
-                    value = ExternalResult(None, None, None, None)
+                value = self._unpack(value)
+                if value.not_found():
                     clustered_results[not_found_cluster] = [value]
                 else:
-                    value = ExternalResult(**value)
                     # ~100x100m clusters
                     clustered_results[(round(value.lat, 3),
                                        round(value.lat, 3),
                                        value.fallback)].append(value)
-        except (simplejson.JSONDecodeError, RedisError):
+        except (struct.error, RedisError):
             self.raven_client.captureException()
             self._stat_count(fallback_name, 'failure')
             return None
@@ -436,6 +473,9 @@ class FallbackCache(object):
         """
         Cache the given position for all networks present in the query.
 
+        Each network key gets the same binary packed value and its own
+        expiry, all written in a single pipeline round trip.
+
         :param query: The query for which we got a result.
         :type query: :class:`ichnaea.api.locate.query.Query`
 
@@ -449,21 +489,13 @@ class FallbackCache(object):
             return
 
         cache_keys = self._cache_keys(query)
-        if result.not_found():
-            cache_value = LOCATION_NOT_FOUND
-        else:
-            cache_value = result._asdict()
-
         try:
-            cache_value = simplejson.dumps(cache_value)
-            cache_values = dict([(key, cache_value) for key in cache_keys])
-
-            with self.redis_client.pipeline() as pipe:
-                pipe.mset(cache_values)
+            cache_value = self._pack(result)
+            with self.redis_client.pipeline(transaction=False) as pipe:
                 for cache_key in cache_keys:
-                    pipe.expire(cache_key, expire)
+                    pipe.set(cache_key, cache_value, ex=expire)
                 pipe.execute()
-        except (simplejson.JSONDecodeError, RedisError):
+        except (struct.error, ValueError, RedisError):
             self.raven_client.captureException()
 
 
@@ -571,6 +603,7 @@ class FallbackPositionSource(PositionSource):
                 self.redis_client,
                 self.stats_client,
                 schema=schema,
+                compact_not_found=FALLBACK_CACHE_COMPACT,
             )
 
     def _stat_count(self, stat, tags):
@@ -580,8 +613,7 @@ class FallbackPositionSource(PositionSource):
         return self.stats_client.timed('locate.fallback.' + stat, tags=tags)
 
     def _ratelimit_key(self, name, interval):
-        now = int(time.time())
-        return 'fallback_ratelimit:%s:%s' % (name, now // interval)
+        return 'fallback_ratelimit:gcra:%s:%s' % (name, interval)
 
     def _ratelimit_reached(self, query):
         api_key = query.api_key
@@ -590,11 +622,11 @@ class FallbackPositionSource(PositionSource):
         interval = api_key.fallback_ratelimit_interval or 1
         ratelimit_key = self._ratelimit_key(name, interval)
 
-        return limit and rate_limit_exceeded(
+        return limit and gcra_rate_limit_exceeded(
             self.redis_client,
             ratelimit_key,
             maxreq=limit,
-            expire=interval * 5,
+            interval=interval,
             on_error=True,
         )
 
@@ -633,10 +665,9 @@ class FallbackPositionSource(PositionSource):
 
             validated = None
             try:
-                body = response.json()
+                body = codec.loads(response.content)
                 validated = result_schema.deserialize(body)
-            except (colander.Invalid,
-                    simplejson.JSONDecodeError):  # pragma: no cover
+            except (colander.Invalid, ValueError):  # pragma: no cover
                 self.raven_client.captureException()
 
             if not validated:  # pragma: no cover
@@ -644,7 +675,7 @@ class FallbackPositionSource(PositionSource):
 
             return ExternalResult(**validated)
 
-        except (simplejson.JSONDecodeError, RequestException):
+        except (ValueError, RequestException):
             self.raven_client.captureException()
 
     def should_search(self, query, results):
@@ -664,17 +695,20 @@ class FallbackPositionSource(PositionSource):
         results = self.result_list()
         result_data = None
 
-        cached_result = cache.get(query)
+        with query.timer.stage('cache', 'fallback'):
+            cached_result = cache.get(query)
         if cached_result:
             # use our own cache, without checking the rate limit
             result_data = cached_result
         elif not self._ratelimit_reached(query):
             # only rate limit the external call
-            result_data = self._make_external_call(query, fallback_schema)
+            with query.timer.stage('lookup', 'fallback'):
+                result_data = self._make_external_call(query, fallback_schema)
             if result_data is not None:
                 # we got a new possibly not_found answer
-                cache.set(query, result_data,
-                          expire=query.api_key.fallback_cache_expire or 1)
+                with query.timer.stage('cache', 'fallback'):
+                    cache.set(query, result_data,
+                              expire=query.api_key.fallback_cache_expire or 1)
 
         if result_data is not None and not result_data.not_found():
             results.add(self.result_type(
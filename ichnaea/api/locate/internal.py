@@ -89,13 +89,14 @@ class InternalPositionSource(BaseInternalSource,
         }]
 
         try:
-            self.data_queues['update_incoming'].enqueue(data)
+            self.data_queues['update_incoming_buffered'].enqueue(data)
         except Exception:  # pragma: no cover
             self.raven_client.captureException()
 
     def search(self, query):
         results = super(InternalPositionSource, self).search(query)
-        self._store_query(query, results)
+        with query.timer.stage('store'):
+            self._store_query(query, results)
         return results
 
 
@@ -14,6 +14,7 @@ from ichnaea.api.locate.schema import (
     FallbackLookup,
     WifiLookup,
 )
+from ichnaea.log import StageTimer
 
 try:
     from collections import OrderedDict
@@ -29,14 +30,27 @@ METRIC_MAPPING = {
 
 class Query(object):
 
+    _api_type = None
     _fallback = None
     _geoip = None
     _ip = None
     _region = None
 
+    # Validated networks, filled in on first access.
+    _blue = None
+    _cell = None
+    _cell_area = None
+    _wifi = None
+
+    # Memoized derived values, reset whenever an input changes.
+    _expected_accuracy = None
+    _json = None
+    _networks = None
+
     def __init__(self, fallback=None, ip=None, blue=None, cell=None, wifi=None,
                  api_key=None, api_type=None, session=None,
-                 http_session=None, geoip_db=None, stats_client=None):
+                 http_session=None, geoip_db=None, stats_client=None,
+                 timer=None):
         """
         A class representing a concrete query.
 
@@ -70,7 +84,11 @@ class Query(object):
 
         :param stats_client: A stats client.
         :type stats_client: :class:`~ichnaea.log.StatsClient`
+
+        :param timer: A timer collecting the durations of query stages.
+        :type timer: :class:`~ichnaea.log.StageTimer`
         """
+        self.timer = timer if timer is not None else StageTimer()
         self.geoip_db = geoip_db
         self.http_session = http_session
         self.session = session
@@ -82,10 +100,25 @@ class Query(object):
         self.cell = cell
         self.wifi = wifi
         self.api_key = api_key
-        if api_type not in (None, 'region', 'locate'):
-            raise ValueError('Invalid api_type.')
         self.api_type = api_type
 
+    def _invalidate(self):
+        self._expected_accuracy = None
+        self._json = None
+        self._networks = None
+
+    @property
+    def api_type(self):
+        """The type of query API, for example `locate`."""
+        return self._api_type
+
+    @api_type.setter
+    def api_type(self, value):
+        if value not in (None, 'region', 'locate'):
+            raise ValueError('Invalid api_type.')
+        self._api_type = value
+        self._invalidate()
+
     @property
     def fallback(self):
         """
@@ -102,6 +135,7 @@ class Query(object):
         if valid is None:  # pragma: no cover
             valid = FallbackLookup.create()
         self._fallback = valid
+        self._invalidate()
 
     @property
     def geoip(self):
@@ -141,11 +175,13 @@ class Query(object):
             region = None
             geoip = None
             if self.geoip_db:
-                geoip = self.geoip_db.lookup(valid)
+                with self.timer.stage('lookup', 'geoip'):
+                    geoip = self.geoip_db.lookup(valid)
                 if geoip:
                     region = geoip.get('region_code')
             self._geoip = geoip
             self._region = region
+        self._invalidate()
 
     @property
     def region(self):
@@ -168,15 +204,20 @@ class Query(object):
         If fewer than :data:`~ichnaea.api.locate.constants.MIN_BLUSS_IN_QUERY`
         unique valid Bluetooth networks are found, returns an empty list.
         """
+        if self._blue is None:
+            with self.timer.stage('validate', 'blue'):
+                self._blue = self._validate_blue(self._blue_unvalidated)
         return self._blue
 
     @blue.setter
     def blue(self, values):
         if not values:
             values = []
-        values = list(values)
-        self._blue_unvalidated = values
+        self._blue_unvalidated = list(values)
+        self._blue = None
+        self._invalidate()
 
+    def _validate_blue(self, values):
         filtered = OrderedDict()
         for value in values:
             valid_blue = BlueLookup.create(**value)
@@ -189,7 +230,7 @@ class Query(object):
 
         if len(filtered) < MIN_BLUES_IN_QUERY:
             filtered = {}
-        self._blue = list(filtered.values())
+        return list(filtered.values())
 
     @property
     def cell(self):
@@ -200,6 +241,9 @@ class Query(object):
         If the same cell network is supplied multiple times, this chooses only
         the best entry for each unique network.
         """
+        if self._cell is None:
+            with self.timer.stage('validate', 'cell'):
+                self._validate_cell(self._cell_unvalidated)
         return self._cell
 
     @property
@@ -212,6 +256,9 @@ class Query(object):
         the best entry for each unique area.
         """
         if self.fallback.lacf:
+            if self._cell_area is None:
+                with self.timer.stage('validate', 'cell'):
+                    self._validate_cell(self._cell_unvalidated)
             return self._cell_area
         return []
 
@@ -219,9 +266,12 @@ class Query(object):
     def cell(self, values):
         if not values:
             values = []
-        values = list(values)
-        self._cell_unvalidated = values
+        self._cell_unvalidated = list(values)
+        self._cell = None
+        self._cell_area = None
+        self._invalidate()
 
+    def _validate_cell(self, values):
         filtered_areas = OrderedDict()
         filtered_cells = OrderedDict()
         for value in values:
@@ -256,15 +306,20 @@ class Query(object):
         If fewer than :data:`~ichnaea.api.locate.constants.MIN_WIFIS_IN_QUERY`
         unique valid Wifi networks are found, returns an empty list.
         """
+        if self._wifi is None:
+            with self.timer.stage('validate', 'wifi'):
+                self._wifi = self._validate_wifi(self._wifi_unvalidated)
         return self._wifi
 
     @wifi.setter
     def wifi(self, values):
         if not values:
             values = []
-        values = list(values)
-        self._wifi_unvalidated = values
+        self._wifi_unvalidated = list(values)
+        self._wifi = None
+        self._invalidate()
 
+    def _validate_wifi(self, values):
         filtered = OrderedDict()
         for value in values:
             valid_wifi = WifiLookup.create(**value)
@@ -277,10 +332,15 @@ class Query(object):
 
         if len(filtered) < MIN_WIFIS_IN_QUERY:
             filtered = {}
-        self._wifi = list(filtered.values())
+        return list(filtered.values())
 
     @property
     def expected_accuracy(self):
+        if self._expected_accuracy is None:
+            self._expected_accuracy = self._get_expected_accuracy()
+        return self._expected_accuracy
+
+    def _get_expected_accuracy(self):
         accuracies = [DataAccuracy.none]
 
         if self.api_type == 'region':
@@ -300,7 +360,17 @@ class Query(object):
         return min(accuracies)
 
     def json(self):
-        """Returns a JSON representation of this query."""
+        """
+        Returns a JSON representation of this query.
+
+        The returned dictionary is a shallow copy, which can be updated
+        without affecting the query.
+        """
+        if self._json is None:
+            self._json = self._get_json()
+        return dict(self._json)
+
+    def _get_json(self):
         result = {}
         if self.blue:
             result['bluetoothBeacons'] = [blue.json() for blue in self.blue]
@@ -313,7 +383,17 @@ class Query(object):
         return result
 
     def networks(self):
-        """Returns networks seen in the validated query."""
+        """
+        Returns networks seen in the validated query.
+
+        The returned value is shared between calls and must not be
+        modified.
+        """
+        if self._networks is None:
+            self._networks = self._get_networks()
+        return self._networks
+
+    def _get_networks(self):
         result = {'area': set(), 'blue': set(), 'cell': set(), 'wifi': set()}
         if self.cell_area:
             result['area'] = set([c.areaid for c in self.cell_area])
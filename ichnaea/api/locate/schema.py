@@ -6,7 +6,10 @@ import operator
 
 import colander
 
-from ichnaea.api.schema import RenamingMappingSchema
+from ichnaea.api.schema import (
+    compile_schema,
+    RenamingMappingSchema,
+)
 from ichnaea.models.base import (
     CreationMixin,
     HashableDict,
@@ -33,6 +36,8 @@ from ichnaea.models.schema import (
 class BaseLookup(HashableDict, CreationMixin, ValidationMixin):
     """A base class for lookup models."""
 
+    __slots__ = ()
+
     _valid_schema = None
     _fields = ()
     _comparators = ()
@@ -78,7 +83,9 @@ class ValidBlueLookupSchema(colander.MappingSchema, ValidatorNode):
 class BlueLookup(BaseLookup):
     """A model class representing a Bluetooth lookup."""
 
-    _valid_schema = ValidBlueLookupSchema()
+    __slots__ = ()
+
+    _valid_schema = compile_schema(ValidBlueLookupSchema())
     _fields = (
         'macAddress',
         'age',
@@ -98,6 +105,8 @@ class BlueLookup(BaseLookup):
 class BaseCellLookup(BaseLookup):
     """A base class for cell related lookup models."""
 
+    __slots__ = ()
+
     _key_fields = (
         'radioType',
         'mobileCountryCode',
@@ -273,7 +282,9 @@ class ValidCellAreaLookupSchema(ValidCellAreaKeySchema, ValidCellSignalSchema):
 class CellAreaLookup(BaseCellLookup):
     """A model class representing a cell area lookup."""
 
-    _valid_schema = ValidCellAreaLookupSchema()
+    __slots__ = ()
+
+    _valid_schema = compile_schema(ValidCellAreaLookupSchema())
     _fields = BaseCellLookup._fields
 
 
@@ -325,7 +336,9 @@ class ValidCellLookupSchema(ValidCellAreaKeySchema, ValidCellSignalSchema):
 class CellLookup(BaseCellLookup):
     """A model class representing a cell lookup."""
 
-    _valid_schema = ValidCellLookupSchema()
+    __slots__ = ()
+
+    _valid_schema = compile_schema(ValidCellLookupSchema())
     _fields = BaseCellLookup._key_fields + (
         'cellId',
         'primaryScramblingCode',
@@ -395,7 +408,9 @@ class ValidWifiLookupSchema(colander.MappingSchema, ValidatorNode):
 class WifiLookup(BaseLookup):
     """A model class representing a WiFi lookup."""
 
-    _valid_schema = ValidWifiLookupSchema()
+    __slots__ = ()
+
+    _valid_schema = compile_schema(ValidWifiLookupSchema())
     _fields = (
         'macAddress',
         'age',
@@ -428,7 +443,9 @@ class FallbackSchema(colander.MappingSchema):
 class FallbackLookup(BaseLookup):
     """A model class representing fallback lookup options."""
 
-    _valid_schema = FallbackSchema()
+    __slots__ = ()
+
+    _valid_schema = compile_schema(FallbackSchema())
     _fields = (
         'ipf',
         'lacf',
@@ -4,7 +4,10 @@ Colander schemata describing the public v1/search HTTP API.
 
 import colander
 
-from ichnaea.api.schema import RenamingMappingSchema
+from ichnaea.api.schema import (
+    compile_schema,
+    RenamingMappingSchema,
+)
 from ichnaea.api.locate.schema import (
     BaseLocateSchema,
     FallbackSchema,
@@ -84,4 +87,4 @@ class LocateV0Schema(BaseLocateSchema):
     fallbacks = FallbackSchema(missing=None)
 
 
-LOCATE_V0_SCHEMA = LocateV0Schema()
+LOCATE_V0_SCHEMA = compile_schema(LocateV0Schema())
@@ -7,7 +7,10 @@ This API is based on the `Google geolocation API
 
 import colander
 
-from ichnaea.api.schema import RenamingMappingSchema
+from ichnaea.api.schema import (
+    compile_schema,
+    RenamingMappingSchema,
+)
 from ichnaea.api.locate.schema import (
     BaseLocateSchema,
     FallbackSchema,
@@ -97,4 +100,4 @@ class LocateV1Schema(BaseLocateSchema):
         return data
 
 
-LOCATE_V1_SCHEMA = LocateV1Schema()
+LOCATE_V1_SCHEMA = compile_schema(LocateV1Schema())
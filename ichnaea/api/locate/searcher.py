@@ -91,7 +91,8 @@ class Searcher(object):
         results = self.result_list()
         for name, source in self.sources:
             if source.should_search(query, results):
-                results.add(source.search(query))
+                with query.timer.stage('search', name):
+                    results.add(source.search(query))
 
         return results.best()
 
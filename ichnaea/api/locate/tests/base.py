@@ -1,4 +1,5 @@
 import operator
+from unittest import mock
 
 import requests_mock
 import simplejson as json
@@ -24,6 +25,7 @@ from ichnaea.api.locate.result import (
     Position,
     Region,
 )
+from ichnaea.api.views import BaseAPIView
 from ichnaea.conftest import GEOIP_DATA
 from ichnaea.models import (
     BlueShard,
@@ -432,6 +434,39 @@ class CommonPositionTest(BaseLocateTest):
             app, api_key=api_key.valid_key, ip=self.test_ip, status=400)
         self.check_response(data_queues, res, 'invalid_key')
 
+    def test_stage_timing(self, app, data_queues, stats):
+        wifis = WifiShardFactory.build_batch(2)
+        query = self.model_query(wifis=wifis)
+
+        with mock.patch.object(BaseAPIView, 'server_timing', True):
+            res = self._call(app, body=query, ip=self.test_ip)
+        self.check_response(data_queues, res, 'ok', fallback='ipf')
+
+        header = res.headers['Server-Timing']
+        for name in ('preprocess', 'get_key', 'rate_limit', 'geoip.lookup',
+                     'wifi.validate', 'internal.search', 'wifi.fetch',
+                     'wifi.cluster', 'store', 'geoip.search'):
+            assert name + ';dur=' in header
+
+        metric = self.metric_type + '.timing'
+        stats.check(timer=[
+            (metric, [self.metric_path, 'stage:preprocess']),
+            (metric, [self.metric_path, 'stage:get_key']),
+            (metric, [self.metric_path, 'stage:rate_limit']),
+            (metric, [self.metric_path, 'stage:fetch', 'source:wifi']),
+            (metric, [self.metric_path, 'stage:search', 'source:internal']),
+            (metric, [self.metric_path, 'stage:search', 'source:geoip']),
+        ])
+
+    def test_stage_timing_disabled(self, app, data_queues, stats):
+        res = self._call(app, ip=self.test_ip)
+        self.check_response(data_queues, res, 'ok')
+        assert 'Server-Timing' not in res.headers
+        stats.check(timer=[
+            (self.metric_type + '.timing',
+                [self.metric_path, 'stage:get_key']),
+        ])
+
     def test_blue_not_found(self, app, data_queues, stats):
         blues = BlueShardFactory.build_batch(2)
 
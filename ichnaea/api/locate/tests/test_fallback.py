@@ -1,3 +1,4 @@
+import time
 from unittest import mock
 
 import colander
@@ -5,16 +6,17 @@ import pytest
 import requests_mock
 from redis import RedisError
 from requests.exceptions import RequestException
-import simplejson
 
 from ichnaea.api.exceptions import LocationNotFound
 from ichnaea.api.locate.constants import DataSource
 from ichnaea.api.locate.fallback import (
+    CACHE_VALUE_STRUCT,
     ExternalResult,
     FallbackCache,
     FallbackPositionSource,
     DEFAULT_SCHEMA,
     COMBAIN_V1_SCHEMA,
+    FALLBACK_VALUES,
     GOOGLEMAPS_V1_SCHEMA,
     GOOGLEMAPS_V1_OUTBOUND_SCHEMA,
     ICHNAEA_V1_OUTBOUND_SCHEMA,
@@ -512,7 +514,7 @@ class TestCache(QueryTest):
         query = self._query(cell=self.cell_model_query([cell]))
         result = ExternalResult(cell.lat, cell.lon, cell.radius, None)
         cache.set(query, result, expire=60)
-        keys = redis.keys('cache:fallback:ichnaea:v1:1:cell:*')
+        keys = redis.keys('cache:fallback:ichnaea:v1:2:cell:*')
         assert len(keys) == 1
         assert 50 < redis.ttl(keys[0]) <= 60
         assert cache.get(query) == result
@@ -537,7 +539,7 @@ class TestCache(QueryTest):
                             cell=self.cell_model_query([cell]))
         result = ExternalResult(cell.lat, cell.lon, cell.radius, None)
         unwiredlabs_cache.set(query, result, expire=60)
-        keys = redis.keys('cache:fallback:unwiredlabs:v1:1:cell:*')
+        keys = redis.keys('cache:fallback:unwiredlabs:v1:2:cell:*')
         assert len(keys) == 1
         assert 50 < redis.ttl(keys[0]) <= 60
         assert unwiredlabs_cache.get(query) == result
@@ -551,15 +553,64 @@ class TestCache(QueryTest):
         query = self._query(cell=self.cell_model_query([cell]))
         result = ExternalResult(None, None, None, None)
         cache.set(query, result)
-        keys = redis.keys('cache:fallback:ichnaea:v1:1:cell:*')
+        keys = redis.keys('cache:fallback:ichnaea:v1:2:cell:*')
         assert len(keys) == 1
-        assert redis.get(keys[0]) == b'"404"'
+        assert redis.get(keys[0]) == b'\x00'
         assert cache.get(query) == result
         stats.check(counter=[
             ('locate.fallback.cache', 1, 1,
                 [self.fallback_tag, 'status:hit']),
         ])
 
+    def test_set_cell_not_found_uncompressed(self, raven, redis, stats):
+        cache = FallbackCache(raven, redis, stats, compact_not_found=False)
+        cell = CellShardFactory.build()
+        query = self._query(cell=self.cell_model_query([cell]))
+        result = ExternalResult(None, None, None, None)
+        cache.set(query, result)
+        keys = redis.keys('cache:fallback:ichnaea:v1:2:cell:*')
+        assert len(keys) == 1
+        assert redis.get(keys[0]) == b'404'
+        assert cache.get(query) == result
+
+    def test_compact_setting(self, data_queues, geoip_db,
+                             raven, redis, stats):
+        with mock.patch('ichnaea.api.locate.fallback.FALLBACK_CACHE_COMPACT',
+                        False):
+            source = FallbackPositionSource(
+                geoip_db=geoip_db,
+                raven_client=raven,
+                redis_client=redis,
+                stats_client=stats,
+                data_queues=data_queues,
+            )
+        for cache in source.caches.values():
+            assert cache.not_found_value == b'404'
+
+    def test_set_cell_packed(self, cache, redis, stats):
+        cell = CellShardFactory.build()
+        query = self._query(cell=self.cell_model_query([cell]))
+        result = ExternalResult(cell.lat, cell.lon, 1000.0, 'lacf')
+        cache.set(query, result, expire=60)
+        keys = redis.keys('cache:fallback:ichnaea:v1:2:cell:*')
+        assert len(keys) == 1
+        assert redis.get(keys[0]) == CACHE_VALUE_STRUCT.pack(
+            cell.lat, cell.lon, 1000.0, 1)
+        assert cache.get(query) == result
+
+    def test_get_invalid_value(self, cache, raven, redis, stats):
+        cell = CellShardFactory.build()
+        query = self._query(cell=self.cell_model_query([cell]))
+        cache.set(query, ExternalResult(None, None, None, None))
+        keys = redis.keys('cache:fallback:ichnaea:v1:2:cell:*')
+        redis.set(keys[0], b'invalid')
+        assert cache.get(query) is None
+        raven.check([('error', 1)])
+        stats.check(counter=[
+            ('locate.fallback.cache', 1, 1,
+                [self.fallback_tag, 'status:failure']),
+        ])
+
     def test_get_cell_multi(self, cache, stats):
         cells = CellShardFactory.build_batch(2)
         query = self._query(cell=self.cell_model_query(cells))
@@ -754,12 +805,12 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
 
     @property
     def fallback_cached_result(self):
-        return simplejson.dumps({
-            'lat': self.fallback_model.lat,
-            'lon': self.fallback_model.lon,
-            'accuracy': float(self.fallback_model.radius),
-            'fallback': 'lacf',
-        })
+        return CACHE_VALUE_STRUCT.pack(
+            self.fallback_model.lat,
+            self.fallback_model.lon,
+            float(self.fallback_model.radius),
+            FALLBACK_VALUES.index('lacf'),
+        )
 
     def test_failed_call(self, geoip_db, http_session,
                          raven, session, source, stats):
@@ -992,7 +1043,8 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
                 self.api_key.fallback_name,
                 self.api_key.fallback_ratelimit_interval,
             )
-            redis.set(ratelimit_key, self.api_key.fallback_ratelimit)
+            # Theoretical arrival time of the next request an hour ahead.
+            redis.set(ratelimit_key, (time.time() + 3600) * 1000.0)
 
             query = self.model_query(
                 geoip_db, http_session, session, stats,
@@ -1004,7 +1056,8 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
                                       session, source, stats):
         cell = CellShardFactory.build()
         mock_redis_client = _mock_redis_client()
-        mock_redis_client.pipeline.side_effect = RedisError()
+        mock_redis_client.register_script.return_value.side_effect = \
+            RedisError()
 
         with requests_mock.Mocker() as mock_request:
             mock_request.register_uri(
@@ -1018,7 +1071,7 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
                 results = source.search(query)
                 self.check_model_results(results, None)
 
-            assert mock_redis_client.pipeline.called
+            assert mock_redis_client.register_script.return_value.called
             assert not mock_request.called
 
     def test_get_cache_redis_failure(self, geoip_db, http_session,
@@ -1053,8 +1106,7 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
         cell = CellShardFactory.build()
         mock_redis_client = _mock_redis_client()
         mock_redis_client.mget.return_value = []
-        mock_redis_client.mset.side_effect = RedisError()
-        mock_redis_client.expire.side_effect = RedisError()
+        mock_redis_client.set.side_effect = RedisError()
         mock_redis_client.execute.side_effect = RedisError()
 
         with requests_mock.Mocker() as mock_request:
@@ -1071,7 +1123,7 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
                 self.check_model_results(results, [self.fallback_model])
 
             assert mock_redis_client.mget.called
-            assert mock_redis_client.mset.called
+            assert mock_redis_client.set.called
             assert mock_request.called
 
         raven.check([('RedisError', 1)])
@@ -1137,7 +1189,7 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
                 self.check_model_results(results, [self.fallback_model])
 
             assert mock_redis_client.mget.called
-            assert not mock_redis_client.mset.called
+            assert not mock_redis_client.set.called
 
         stats.check(counter=[
             ('locate.fallback.cache', [self.fallback_tag, 'status:hit']),
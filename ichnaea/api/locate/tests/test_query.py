@@ -338,6 +338,50 @@ class TestQuery(QueryTest):
         with pytest.raises(ValueError):
             Query(api_type='something')
 
+    def test_lazy_validation(self):
+        wifis = WifiShardFactory.build_batch(2)
+        query = Query(wifi=self.wifi_model_query(wifis))
+        assert query._wifi is None
+        assert query._cell is None
+        assert len(query.wifi) == 2
+        assert query.wifi is query.wifi
+        assert query._cell is None
+
+    def test_memoized(self):
+        cells = CellShardFactory.build_batch(1)
+        query = Query(cell=self.cell_model_query(cells))
+        assert query.networks() is query.networks()
+        assert query.json() == query.json()
+        assert query.json() is not query.json()
+        query.json()['extra'] = 1
+        assert 'extra' not in query.json()
+
+    def test_invalidate(self):
+        cells = CellShardFactory.build_batch(1)
+        wifis = WifiShardFactory.build_batch(2)
+        query = Query(cell=self.cell_model_query(cells), api_type='locate')
+        assert query.expected_accuracy is DataAccuracy.medium
+        assert len(query.networks()['area']) == 1
+        assert 'wifiAccessPoints' not in query.json()
+
+        query.wifi = self.wifi_model_query(wifis)
+        assert query.expected_accuracy is DataAccuracy.high
+        assert len(query.networks()['wifi']) == 2
+        assert len(query.json()['wifiAccessPoints']) == 2
+
+        query.fallback = {'lacf': False}
+        assert query.networks()['area'] == set()
+        assert query.json()['fallbacks'] == {'ipf': True, 'lacf': False}
+
+        query.cell = []
+        query.wifi = []
+        assert query.expected_accuracy is DataAccuracy.none
+        assert query.json() == {'fallbacks': {'ipf': True, 'lacf': False}}
+
+        query.cell = self.cell_model_query(cells)
+        query.api_type = 'region'
+        assert query.expected_accuracy is DataAccuracy.low
+
 
 class TestQueryStats(QueryTest):
 
@@ -33,6 +33,7 @@ class BaseLocateView(BaseAPIView):
             http_session=self.request.registry.http_session,
             geoip_db=self.request.registry.geoip_db,
             stats_client=self.stats_client,
+            timer=self.timer,
         )
 
         searcher = getattr(self.request.registry, self.searcher)
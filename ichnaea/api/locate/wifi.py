@@ -42,17 +42,22 @@ class WifiPositionMixin(object):
     def search_wifi(self, query):
         results = self.result_list()
 
-        wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
-        for cluster in cluster_networks(wifis, query.wifi,
-                                        min_radius=WIFI_MIN_ACCURACY,
-                                        min_signal=MIN_WIFI_SIGNAL,
-                                        max_distance=MAX_WIFI_CLUSTER_METERS):
-            result = aggregate_cluster_position(
-                cluster, self.result_type, 'wifi',
-                max_networks=MAX_WIFIS_IN_CLUSTER,
-                min_accuracy=WIFI_MIN_ACCURACY,
-                max_accuracy=WIFI_MAX_ACCURACY,
-            )
+        with query.timer.stage('fetch', 'wifi'):
+            wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
+        with query.timer.stage('cluster', 'wifi'):
+            clusters = cluster_networks(
+                wifis, query.wifi,
+                min_radius=WIFI_MIN_ACCURACY,
+                min_signal=MIN_WIFI_SIGNAL,
+                max_distance=MAX_WIFI_CLUSTER_METERS)
+        for cluster in clusters:
+            with query.timer.stage('aggregate', 'wifi'):
+                result = aggregate_cluster_position(
+                    cluster, self.result_type, 'wifi',
+                    max_networks=MAX_WIFIS_IN_CLUSTER,
+                    min_accuracy=WIFI_MIN_ACCURACY,
+                    max_accuracy=WIFI_MAX_ACCURACY,
+                )
             results.add(result)
 
         return results
@@ -75,7 +80,8 @@ class WifiRegionMixin(object):
 
         now = util.utcnow()
         regions = defaultdict(int)
-        wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
+        with query.timer.stage('fetch', 'wifi'):
+            wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
         for wifi in wifis:
             regions[wifi.region] += station_score(wifi, now)
 
@@ -1,5 +1,63 @@
 """A Redis based rate limit implementation."""
+from collections import defaultdict
+from threading import Lock
+import time
+
 from redis import RedisError
+from redis.client import Script
+
+from ichnaea.config import (
+    API_USAGE_INTERVAL,
+    API_USAGE_TOLERANCE,
+)
+
+
+def configure_api_usage(redis_client, raven_client,
+                        interval=API_USAGE_INTERVAL,
+                        tolerance=API_USAGE_TOLERANCE,
+                        _api_usage=None):
+    """
+    Configure and return a :class:`~ichnaea.api.rate_limit.ApiUsageBuffer`
+    instance or `None` if buffering is disabled.
+
+    :param _api_usage: Test-only hook to provide a pre-configured buffer.
+    """
+    if _api_usage is not None:
+        return _api_usage
+    if not interval:
+        return None
+    return ApiUsageBuffer(redis_client, raven_client,
+                          interval=interval, tolerance=tolerance)
+
+
+# A generic cell rate algorithm (GCRA) implementation. The key stores
+# the theoretical arrival time (TAT) of the next request in milliseconds.
+# ARGV is the emission interval and the period, both in milliseconds.
+# The current time is taken from the Redis server, so the result doesn't
+# depend on the clocks of the web heads. Returns 1 if the request is
+# limited, otherwise 0.
+_GCRA_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+local emission = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat or tat < now then
+    tat = now
+end
+tat = tat + emission
+if tat - now > period then
+    return 1
+end
+redis.call('SET', KEYS[1], string.format('%.3f', tat),
+           'PX', math.ceil(tat - now))
+return 0
+"""
+
+# The script is registered once and loaded into each Redis server
+# on its first use.
+_GCRA = Script(None, _GCRA_SCRIPT)
 
 
 def rate_limit_exceeded(redis_client, key,
@@ -25,3 +83,159 @@ def rate_limit_exceeded(redis_client, key,
             # If we cannot connect to Redis, return error value.
             return on_error
     return False
+
+
+def gcra_rate_limit_exceeded(redis_client, key,
+                             maxreq=0, interval=1, on_error=False):
+    """
+    Return `True` if the rate limit is exceeded otherwise `False`.
+
+    Unlike :func:`~ichnaea.api.rate_limit.rate_limit_exceeded` this
+    uses a sliding window, allowing a burst of up to `maxreq` requests
+    and afterwards `maxreq` requests evenly spread over `interval`
+    seconds. The check is done atomically in one server-side script,
+    which also maintains the key's expiry.
+
+    :param redis_client: A :class:`ichnaea.cache.RedisClient`
+    :param key: The Redis key to be used.
+    :param maxreq: The maximum number of requests per interval.
+    :param interval: The interval in seconds.
+    :param on_error: If Redis could not be connected, report this
+                     as the return status.
+    """
+    if maxreq:
+        period = interval * 1000.0
+        try:
+            return _GCRA(keys=[key], args=[period / maxreq, period],
+                         client=redis_client) == 1
+        except RedisError:  # pragma: no cover
+            # If we cannot connect to Redis, return error value.
+            return on_error
+    return False
+
+
+class ApiUsageBuffer(object):
+    """
+    An in-memory, per-process aggregation of API usage data.
+
+    Unique IP addresses and daily request counts are collected locally
+    and flushed to Redis every `interval` seconds in one pipeline.
+
+    Rate limit decisions are based on the last global count returned by
+    Redis plus the requests counted locally since then. Keys whose
+    estimated count is within `tolerance` requests of their limit are
+    written to Redis on their own for every request, so the decision is
+    based on the exact global count. Once a key is known to be over its
+    limit for the day, its requests are only counted locally again.
+    """
+
+    ip_expire = 691200  # 8 days
+    rate_expire = 90000  # 25 hours
+
+    def __init__(self, redis_client, raven_client,
+                 interval=0.5, tolerance=0):
+        self.redis_client = redis_client
+        self.raven_client = raven_client
+        self.interval = interval
+        self.tolerance = tolerance
+        self._counts = defaultdict(int)
+        self._ips = defaultdict(set)
+        self._synced = {}
+        self._synced_day = None
+        self._last_flush = time.time()
+        self._lock = Lock()
+
+    def _check_day(self):
+        # Rate keys are daily, forget about older days.
+        # Needs to be called with the lock held.
+        today = time.gmtime()[:3]
+        if self._synced_day != today:
+            self._synced = {}
+            self._synced_day = today
+
+    def log_and_check(self, log_ip_key, ip, rate_key, maxreq):
+        """
+        Log the IP address and count the request.
+
+        Return `True` if the rate limit is exceeded otherwise `False`.
+        """
+        with self._lock:
+            self._check_day()
+            self._ips[log_ip_key].add(ip)
+            self._counts[rate_key] += 1
+            synced = self._synced.get(rate_key, 0)
+            count = synced + self._counts[rate_key]
+            should_flush = time.time() - self._last_flush >= self.interval
+            should_sync = bool(
+                maxreq and synced <= maxreq and
+                count > maxreq - self.tolerance)
+
+        if should_flush:
+            count = self.flush().get(rate_key, count)
+        elif should_sync:
+            count = self._flush_key(rate_key, count)
+
+        return bool(maxreq and count > maxreq)
+
+    def _flush_key(self, rate_key, count):
+        """
+        Write the locally collected count of a single rate key to Redis
+        and return its current global count.
+        """
+        with self._lock:
+            local = self._counts.pop(rate_key, 0)
+            if not local:
+                return count
+            self._synced[rate_key] = self._synced.get(rate_key, 0) + local
+
+        try:
+            with self.redis_client.pipeline() as pipe:
+                pipe.incr(rate_key, local)
+                pipe.expire(rate_key, self.rate_expire)
+                count, _ = pipe.execute()
+        except RedisError:  # pragma: no cover
+            self.raven_client.captureException()
+            return count
+
+        with self._lock:
+            self._synced[rate_key] = count
+        return count
+
+    def flush(self):
+        """
+        Write all locally collected data to Redis.
+
+        Return a dictionary of rate keys to their current global count.
+        """
+        with self._lock:
+            counts = self._counts
+            ips = self._ips
+            self._counts = defaultdict(int)
+            self._ips = defaultdict(set)
+            self._last_flush = time.time()
+            self._check_day()
+
+            for rate_key, count in counts.items():
+                self._synced[rate_key] = self._synced.get(rate_key, 0) + count
+
+        if not counts and not ips:
+            return {}
+
+        rate_keys = list(counts.keys())
+        try:
+            with self.redis_client.pipeline() as pipe:
+                for log_ip_key, values in ips.items():
+                    pipe.pfadd(log_ip_key, *values)
+                    pipe.expire(log_ip_key, self.ip_expire)
+                for rate_key in rate_keys:
+                    pipe.incr(rate_key, counts[rate_key])
+                    pipe.expire(rate_key, self.rate_expire)
+                result = pipe.execute()
+        except RedisError:  # pragma: no cover
+            self.raven_client.captureException()
+            return {}
+
+        global_counts = dict(zip(rate_keys, result[len(ips) * 2::2]))
+        with self._lock:
+            self._synced.update(global_counts)
+        return global_counts
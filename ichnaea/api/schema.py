@@ -9,9 +9,14 @@ representation to be send over the network to the backend queue.
 The locate APIs prefer to deserialize data into a consistent in-memory
 representation with all fields being present and missing values of
 `None` or empty tuples.
+
+The :func:`compile_schema` function turns a schema into an equivalent
+copy with specialized deserialization functions for its mappings and
+sequences, avoiding most of the per-field colander call overhead.
 """
 
 import calendar
+import copy
 import math
 import time
 
@@ -22,6 +27,7 @@ from ichnaea.models.constants import (
     MIN_TIMESTAMP,
     MAX_TIMESTAMP,
 )
+from ichnaea.models.schema import DefaultNode
 
 
 class BoundedFloat(colander.Float):
@@ -170,3 +176,201 @@ class OptionalStringNode(OptionalNode):
 class OptionalStringVocabularyNode(OptionalNode):
 
     schema_type = StringVocabularyNode
+
+
+def _is_leaf(node):
+    """
+    Is this a node without children, whose deserialization is done by
+    the stock SchemaNode or DefaultNode logic?
+    """
+    if node.children:
+        return False
+    if type(node).deserialize not in (colander.SchemaNode.deserialize,
+                                      DefaultNode.deserialize):
+        return False
+    if node.preparer is not None and not callable(node.preparer):
+        return False
+    for value in (node.missing, node.preparer, node.validator):
+        if isinstance(value, colander.deferred):
+            return False
+    return True
+
+
+def _compile_leaf(node):
+    """
+    Return a function equivalent to `node.deserialize` for a leaf node.
+    """
+    typ = node.typ
+    typ_deserialize = typ.deserialize
+    preparer = node.preparer
+    validator = node.validator
+    missing = node.missing
+
+    # Non-empty values of the exact target type pass through unchanged.
+    passthrough = None
+    if type(typ) is colander.Integer:
+        passthrough = int
+    elif type(typ) is colander.String and not typ.encoding:
+        passthrough = str
+
+    def deserialize(cstruct):
+        if cstruct and type(cstruct) is passthrough:
+            appstruct = cstruct
+        else:
+            appstruct = typ_deserialize(node, cstruct)
+        if preparer is not None:
+            appstruct = preparer(appstruct)
+        if appstruct is colander.null:
+            if missing is colander.required:
+                # Let colander raise the exact same error.
+                return node.deserialize(cstruct)
+            return missing
+        if validator is not None:
+            validator(node, appstruct)
+        return appstruct
+
+    if type(node).deserialize is not DefaultNode.deserialize:
+        return deserialize
+
+    def default_deserialize(cstruct):
+        try:
+            return deserialize(cstruct)
+        except colander.Invalid:
+            if missing is colander.required:
+                raise
+            return missing
+
+    return default_deserialize
+
+
+def _child_deserializer(node):
+    if _is_leaf(node):
+        return _compile_leaf(node)
+    return node.deserialize
+
+
+def _compile_mapping(typ, children):
+    """
+    Return a function equivalent to `typ.deserialize` for a mapping type
+    with `unknown = 'ignore'`, including the key renaming of the
+    :class:`RenamingMapping` type.
+    """
+    original = typ.deserialize
+    renaming = isinstance(typ, RenamingMapping)
+    fields = []
+    for num, subnode in enumerate(children):
+        to_name = subnode.name
+        if renaming:
+            to_name = getattr(subnode, 'to_name', to_name) or to_name
+        fields.append((
+            num,
+            subnode.name,
+            to_name,
+            subnode.default is colander.drop,
+            subnode.missing,
+            _child_deserializer(subnode),
+        ))
+
+    def deserialize(node, cstruct):
+        if type(cstruct) is not dict:
+            return original(node, cstruct)
+
+        error = None
+        result = {}
+        for num, name, to_name, drop_default, missing, sub in fields:
+            subval = cstruct.get(name, colander.null)
+            if (subval is colander.drop or
+                    (subval is colander.null and drop_default)):
+                sub_result = colander.drop
+            else:
+                try:
+                    sub_result = sub(subval)
+                except colander.Invalid as exc:
+                    if error is None:
+                        error = colander.Invalid(node)
+                    error.add(exc, num)
+                    continue
+
+            if renaming:
+                if sub_result is colander.drop:
+                    sub_result = missing
+                if (sub_result is colander.drop or
+                        sub_result is colander.null):
+                    continue
+                result[to_name] = sub_result
+            elif sub_result is not colander.drop:
+                result[name] = sub_result
+
+        if error is not None:
+            raise error
+
+        return result
+
+    return deserialize
+
+
+def _compile_sequence(typ, children):
+    """
+    Return a function equivalent to `typ.deserialize` for a sequence type.
+    """
+    original = typ.deserialize
+    subnode = children[0]
+    drop_default = subnode.default is colander.drop
+    sub = _child_deserializer(subnode)
+
+    def deserialize(node, cstruct, accept_scalar=None):
+        if type(cstruct) is not list:
+            return original(node, cstruct, accept_scalar=accept_scalar)
+
+        error = None
+        result = []
+        for num, subval in enumerate(cstruct):
+            if (subval is colander.drop or
+                    (subval is colander.null and drop_default)):
+                continue
+            try:
+                sub_result = sub(subval)
+            except colander.Invalid as exc:
+                if error is None:
+                    error = colander.Invalid(node)
+                error.add(exc, num)
+            else:
+                if sub_result is not colander.drop:
+                    result.append(sub_result)
+
+        if error is not None:
+            raise error
+
+        return result
+
+    return deserialize
+
+
+def compile_schema(node):
+    """
+    Return a copy of the schema node with specialized deserialization
+    functions for all of its mapping and sequence types.
+
+    The compiled schema returns the same results and raises the same
+    errors as the original one. Custom node `deserialize` methods and
+    validators are kept and still called. Only plain dictionaries and
+    lists take the fast path, all other input is handed to the original
+    colander types.
+    """
+    compiled = copy.copy(node)
+    compiled.children = [compile_schema(sub) for sub in node.children]
+
+    typ = node.typ
+    deserialize = None
+    if (type(typ) in (colander.Mapping, RenamingMapping, OptionalMapping) and
+            typ.unknown == 'ignore'):
+        deserialize = _compile_mapping(typ, compiled.children)
+    elif (type(typ) in (colander.Sequence, OptionalSequence) and
+            compiled.children):
+        deserialize = _compile_sequence(typ, compiled.children)
+
+    if deserialize is not None:
+        compiled.typ = copy.copy(typ)
+        compiled.typ.deserialize = deserialize
+
+    return compiled
@@ -5,6 +5,7 @@ Colander schemata describing the public v1/submit HTTP API.
 import colander
 
 from ichnaea.api.schema import (
+    compile_schema,
     OptionalBoundedFloatNode,
     OptionalIntNode,
     OptionalMappingSchema,
@@ -157,4 +158,4 @@ class SubmitV0Schema(OptionalMappingSchema):
         report = ReportV0Schema()
 
 
-SUBMIT_V0_SCHEMA = SubmitV0Schema()
+SUBMIT_V0_SCHEMA = compile_schema(SubmitV0Schema())
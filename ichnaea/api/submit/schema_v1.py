@@ -5,6 +5,7 @@ Colander schemata describing the public v1/geosubmit HTTP API.
 import colander
 
 from ichnaea.api.schema import (
+    compile_schema,
     OptionalIntNode,
     OptionalMappingSchema,
     OptionalSequenceSchema,
@@ -60,4 +61,4 @@ class SubmitV1Schema(OptionalMappingSchema):
         report = ReportV1Schema()
 
 
-SUBMIT_V1_SCHEMA = SubmitV1Schema()
+SUBMIT_V1_SCHEMA = compile_schema(SubmitV1Schema())
@@ -5,6 +5,7 @@ Colander schemata describing the public v2/geosubmit HTTP API.
 import colander
 
 from ichnaea.api.schema import (
+    compile_schema,
     OptionalIntNode,
     OptionalMappingSchema,
     OptionalSequenceSchema,
@@ -36,4 +37,4 @@ class SubmitV2Schema(OptionalMappingSchema):
             position = PositionSchema(missing=None)
 
 
-SUBMIT_V2_SCHEMA = SubmitV2Schema()
+SUBMIT_V2_SCHEMA = compile_schema(SubmitV2Schema())
@@ -0,0 +1,186 @@
+"""
+Incremental decoding and parsing of submit request bodies.
+
+Instead of holding the whole decompressed body and its parsed
+representation in memory, the body is read in chunks and the entries
+of its top-level `items` array are returned one at a time.
+"""
+
+import codecs
+import zlib
+
+from ichnaea import codec
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
+
+CHUNK_SIZE = 65536
+NUMBER_CHARS = '0123456789+-.eE'
+WHITESPACE = ' \t\n\r'
+
+
+def _gunzip(chunks, chunk_size):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = False
+    try:
+        for data in chunks:
+            while data:
+                pending = True
+                out = decompressor.decompress(data, chunk_size)
+                if out:
+                    yield out
+                if decompressor.eof:
+                    # Start over for concatenated gzip members.
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    pending = False
+                else:
+                    data = decompressor.unconsumed_tail
+    except zlib.error as exc:
+        raise GZIPDecodeError(repr(exc))
+    if pending:
+        raise GZIPDecodeError('Truncated gzip data')
+
+
+def iter_text(fd, gzip=False, encoding=None,
+              max_size=0, chunk_size=CHUNK_SIZE):
+    """
+    Read the file-like object in chunks and return an iterator of
+    Unicode strings, optionally decompressing gzip data on the fly.
+
+    :param max_size: The maximum size of the (decompressed) body in
+                     bytes, zero for no limit.
+
+    :raises: :exc:`~ichnaea.exceptions.GZIPDecodeError`,
+             :exc:`~ichnaea.exceptions.BodyTooLargeError`,
+             :exc:`UnicodeDecodeError`
+    """
+    chunks = iter(lambda: fd.read(chunk_size), b'')
+    if gzip:
+        chunks = _gunzip(chunks, chunk_size)
+
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')()
+    size = 0
+    for data in chunks:
+        size += len(data)
+        if max_size and size > max_size:
+            raise BodyTooLargeError(
+                'Body larger than %s bytes.' % max_size)
+        yield decoder.decode(data)
+    yield decoder.decode(b'', True)
+
+
+class _Buffer(object):
+    """A text buffer over an iterator of Unicode strings."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.eof = False
+        self.pos = 0
+        self.text = ''
+
+    def fill(self):
+        """Append the next chunk, return False at the end of input."""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        # Drop the already parsed text.
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character or '' at the end."""
+        while True:
+            text = self.text
+            pos = self.pos
+            length = len(text)
+            while pos < length and text[pos] in WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < length:
+                return text[pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expecting %r at char %s' % (char, self.pos))
+        self.pos += 1
+
+    def _complete(self, value, end):
+        text = self.text
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # A number might continue in the next chunk.
+            while end < len(text) and text[end] in NUMBER_CHARS:
+                end += 1
+        return end < len(text)
+
+    def value(self):
+        """Parse and return the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = codec.raw_decode(self.text, self.pos)
+                if self.eof or self._complete(value, end):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_items(chunks):
+    """
+    Parse JSON text given as an iterator of Unicode strings and
+    return an iterator over the entries of the top-level `items` array.
+    All other top-level values are ignored.
+
+    :raises: :exc:`ValueError` if the text isn't a well-formed JSON
+             object containing an `items` array.
+    """
+    buf = _Buffer(chunks)
+    if buf.peek() == '\ufeff':
+        buf.pos += 1
+
+    found = False
+    buf.expect('{')
+    if buf.peek() == '}':
+        buf.pos += 1
+    else:
+        while True:
+            key = buf.value()
+            if not isinstance(key, str):
+                raise ValueError('Expecting property name')
+            buf.expect(':')
+            if key == 'items' and not found:
+                found = True
+                buf.expect('[')
+                if buf.peek() == ']':
+                    buf.pos += 1
+                else:
+                    while True:
+                        yield buf.value()
+                        char = buf.peek()
+                        buf.pos += 1
+                        if char == ']':
+                            break
+                        elif char != ',':
+                            raise ValueError("Expecting ',' delimiter")
+            else:
+                buf.value()
+
+            char = buf.peek()
+            buf.pos += 1
+            if char == '}':
+                break
+            elif char != ',':
+                raise ValueError("Expecting ',' delimiter")
+
+    if buf.peek() != '':
+        raise ValueError('Extra data')
+    if not found:
+        raise ValueError('Missing items')
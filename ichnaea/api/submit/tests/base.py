@@ -5,10 +5,13 @@ from simplejson import dumps
 
 from ichnaea.api.exceptions import (
     ParseError,
+    RequestTooLarge,
     ServiceUnavailable,
 )
+from ichnaea.api.submit.views import BaseSubmitView
 from ichnaea.conftest import GEOIP_DATA
 from ichnaea.models import Radio
+from ichnaea.submit import expand_deferred
 from ichnaea.tests.factories import ApiKeyFactory
 from ichnaea import util
 
@@ -141,6 +144,125 @@ class BaseSubmitTest(object):
             [k.decode('ascii') for k in redis.keys('apiuser:*')] ==
             ['apiuser:submit:test:%s' % today.strftime('%Y-%m-%d')])
 
+    def test_stage_timing(self, app, celery):
+        with mock.patch.object(BaseSubmitView, 'server_timing', True):
+            res = self._post_one_cell(app, api_key='test')
+        header = res.headers['Server-Timing']
+        for name in ('get_key', 'rate_limit', 'preprocess'):
+            assert name + ';dur=' in header
+
+    def test_stage_timing_error(self, app, raven):
+        with mock.patch.object(BaseSubmitView, 'server_timing', True):
+            res = app.post_json(self.url, [1], status=400)
+        assert res.json == ParseError.json_body()
+        assert 'preprocess;dur=' in res.headers['Server-Timing']
+
+    def test_deferred(self, app, celery, stats):
+        cell, query = self._one_cell_query()
+        with mock.patch.object(BaseSubmitView, 'deferred_validation', True):
+            self._post(app, [query, query], api_key='test')
+
+        items = self.queue(celery).dequeue()
+        assert len(items) == 1
+        assert items[0]['api_key'] == 'test'
+        assert items[0]['deferred']['path'] == self.metric_path[5:]
+        reports = expand_deferred(items[0])
+        assert len(reports) == 2
+        cells = reports[0]['report']['cellTowers']
+        assert cells[0]['radioType'] == cell.radio.name
+        stats.check(counter=[('data.batch.upload', 1)])
+
+    def test_deferred_gzip(self, app, celery):
+        cell, query = self._one_cell_query()
+        body = util.encode_gzip(dumps({'items': [query]}))
+        headers = {'Content-Encoding': 'gzip'}
+        with mock.patch.object(BaseSubmitView, 'deferred_validation', True):
+            app.post(
+                self.url, body, headers=headers,
+                content_type='application/json', status=self.status)
+
+        items = self.queue(celery).dequeue()
+        assert items[0]['deferred']['gzip']
+        assert len(expand_deferred(items[0])) == 1
+
+    def test_deferred_empty(self, app, celery):
+        with mock.patch.object(BaseSubmitView, 'deferred_validation', True):
+            self._post(app, [])
+        # The body isn't parsed, so it is queued and expanded later.
+        items = self.queue(celery).dequeue()
+        assert expand_deferred(items[0]) == []
+
+    def test_deferred_too_large(self, app, celery):
+        cell, query = self._one_cell_query()
+        with mock.patch.object(BaseSubmitView, 'deferred_validation', True):
+            with mock.patch.object(BaseSubmitView, 'max_body_size', 20):
+                res = self._post(app, [query], status=413)
+        assert res.json == RequestTooLarge.json_body()
+        assert self.queue(celery).size() == 0
+
+    def test_deferred_errors(self, app, celery, raven):
+        headers = {'Content-Encoding': 'gzip'}
+        with mock.patch.object(BaseSubmitView, 'deferred_validation', True):
+            app.post(self.url, '', status=400)
+            app.post(self.url, '\xae', status=400)
+            app.post(self.url, 'invalid', headers=headers, status=400)
+            app.post_json(self.url, [1], status=400)
+            res = app.post_json(self.url, {}, status=400)
+        assert res.json == ParseError.json_body()
+        assert self.queue(celery).size() == 0
+
+    def test_streaming(self, app, celery, stats):
+        cell, query = self._one_cell_query()
+        with mock.patch.object(BaseSubmitView, 'streaming', True):
+            with mock.patch.object(BaseSubmitView, 'stream_batch', 2):
+                self._post(app, [query] * 5, api_key='test')
+
+        items = self.queue(celery).dequeue()
+        assert len(items) == 5
+        assert items[0]['api_key'] == 'test'
+        cells = items[0]['report']['cellTowers']
+        assert cells[0]['radioType'] == cell.radio.name
+        stats.check(counter=[('data.batch.upload', 1)])
+
+    def test_streaming_gzip(self, app, celery):
+        cell, query = self._one_cell_query()
+        body = util.encode_gzip(dumps({'items': [query]}))
+        headers = {'Content-Encoding': 'gzip'}
+        with mock.patch.object(BaseSubmitView, 'streaming', True):
+            app.post(
+                self.url, body, headers=headers,
+                content_type='application/json', status=self.status)
+        assert self.queue(celery).size() == 1
+
+    def test_streaming_too_large(self, app, celery):
+        cell, query = self._one_cell_query()
+        with mock.patch.object(BaseSubmitView, 'streaming', True):
+            with mock.patch.object(BaseSubmitView, 'max_body_size', 20):
+                res = self._post(app, [query], status=413)
+        assert res.json == RequestTooLarge.json_body()
+        assert self.queue(celery).size() == 0
+
+    def test_streaming_errors(self, app, celery, raven):
+        headers = {'Content-Encoding': 'gzip'}
+        with mock.patch.object(BaseSubmitView, 'streaming', True):
+            app.post(self.url, '', status=400)
+            app.post(self.url, '\xae', status=400)
+            app.post(self.url, 'invalid', headers=headers, status=400)
+            app.post_json(self.url, [1], status=400)
+            res = app.post_json(self.url, {}, status=400)
+        assert res.json == ParseError.json_body()
+        assert self.queue(celery).size() == 0
+
+    def test_streaming_partial(self, app, celery):
+        cell, query = self._one_cell_query()
+        body = dumps({'items': [query] * 3})[:-2]
+        with mock.patch.object(BaseSubmitView, 'streaming', True):
+            with mock.patch.object(BaseSubmitView, 'stream_batch', 2):
+                app.post(self.url, body,
+                         content_type='application/json', status=400)
+        # The valid reports of the first chunk aren't queued.
+        assert self.queue(celery).size() == 0
+
     def test_options(self, app):
         res = app.options(self.url, status=200)
         assert res.headers['Access-Control-Allow-Origin'] == '*'
@@ -0,0 +1,130 @@
+from io import BytesIO
+
+import pytest
+import simplejson
+
+from ichnaea.api.submit.schema_v1 import SUBMIT_V1_SCHEMA
+from ichnaea.api.submit.stream import (
+    iter_items,
+    iter_text,
+)
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
+from ichnaea.tests.factories import WifiShardFactory
+from ichnaea import util
+
+
+def _chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class TestIterText(object):
+
+    text = '{"items": [{"name": "caf\xe9 \U0001f600"}]}' * 20
+
+    def _read(self, body, chunk_size=7, **kw):
+        return ''.join(iter_text(BytesIO(body), chunk_size=chunk_size, **kw))
+
+    def test_plain(self):
+        assert self._read(self.text.encode('utf-8')) == self.text
+        assert self._read(b'') == ''
+
+    def test_encoding(self):
+        assert self._read(self.text.encode('utf-16'),
+                          encoding='utf-16') == self.text
+
+    def test_gzip(self):
+        body = util.encode_gzip(self.text)
+        assert self._read(body, gzip=True) == self.text
+        assert self._read(body, gzip=True, chunk_size=65536) == self.text
+
+    def test_gzip_members(self):
+        body = util.encode_gzip('{"a": ') + util.encode_gzip('1}')
+        assert self._read(body, gzip=True) == '{"a": 1}'
+
+    def test_gzip_invalid(self):
+        with pytest.raises(GZIPDecodeError):
+            self._read(b'invalid', gzip=True)
+
+    def test_gzip_truncated(self):
+        body = util.encode_gzip(self.text)
+        with pytest.raises(GZIPDecodeError):
+            self._read(body[:-10], gzip=True)
+
+    def test_max_size(self):
+        body = self.text.encode('utf-8')
+        assert self._read(body, max_size=len(body)) == self.text
+        with pytest.raises(BodyTooLargeError):
+            self._read(body, max_size=len(body) - 1)
+
+    def test_max_size_gzip(self):
+        body = util.encode_gzip('[' + '0, ' * 100000 + '0]')
+        assert len(body) < 1000
+        with pytest.raises(BodyTooLargeError):
+            self._read(body, gzip=True, max_size=10000)
+
+
+class TestIterItems(object):
+
+    valid = [
+        '{"items": []}',
+        '{"items": [1, 2.5, -3e2, true, null, "a,]}"]}',
+        ' \n{ "other": [1, {"items": [5]}], "items" :\t[{"a": [{}]}, []] }\n',
+        '{"a": 12345, "items": [12345], "b": "x"}',
+        '\ufeff{"items": [{"x": "\\u00e9\\"\\\\"}]}',
+    ]
+
+    invalid = [
+        '',
+        '[1]',
+        '{}',
+        '{"other": 1}',
+        '{"items": {}}',
+        '{"items": [1,]}',
+        '{"items": [1 2]}',
+        '{"items": [1]',
+        '{"items": [1]} x',
+        '{"items": [1] "a": 1}',
+        '{1: 2, "items": []}',
+        '{"items": [tru]}',
+    ]
+
+    def _items(self, text, size):
+        return list(iter_items(_chunked(text, size)))
+
+    def test_valid(self):
+        for text in self.valid:
+            expected = simplejson.loads(text.lstrip('\ufeff'))['items']
+            for size in (1, 2, 3, 5, 8, 1000):
+                assert self._items(text, size) == expected
+
+    def test_invalid(self):
+        for text in self.invalid:
+            for size in (1, 3, 1000):
+                with pytest.raises(ValueError):
+                    self._items(text, size)
+
+    def test_lazy(self):
+        items = iter_items(['{"items": [1, ', '2, ', 'invalid'])
+        assert next(items) == 1
+        assert next(items) == 2
+        with pytest.raises(ValueError):
+            next(items)
+
+    def test_schema_chunks(self):
+        wifis = WifiShardFactory.build_batch(5)
+        items = [{
+            'latitude': wifi.lat,
+            'longitude': wifi.lon,
+            'timestamp': 146 * 10 ** 10,
+            'wifiAccessPoints': [{'macAddress': wifi.mac}],
+        } for wifi in wifis] + [{}]
+        text = simplejson.dumps({'items': items})
+
+        parsed = self._items(text, 11)
+        node = SUBMIT_V1_SCHEMA['items']
+        chunked = node.deserialize(parsed[:3]) + node.deserialize(parsed[3:])
+        assert chunked == SUBMIT_V1_SCHEMA.deserialize(
+            simplejson.loads(text))['items']
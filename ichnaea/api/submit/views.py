@@ -2,10 +2,12 @@
 Implementation of submit specific HTTP service views.
 """
 
+import colander
 from redis import RedisError
 
 from ichnaea.api.exceptions import (
     ParseError,
+    RequestTooLarge,
     ServiceUnavailable,
     UploadSuccess,
     UploadSuccessV0,
@@ -13,14 +15,33 @@ from ichnaea.api.exceptions import (
 from ichnaea.api.submit.schema_v0 import SUBMIT_V0_SCHEMA
 from ichnaea.api.submit.schema_v1 import SUBMIT_V1_SCHEMA
 from ichnaea.api.submit.schema_v2 import SUBMIT_V2_SCHEMA
+from ichnaea.api.submit import stream
 
 from ichnaea.api.views import BaseAPIView
+from ichnaea.config import (
+    SUBMIT_DEFERRED_VALIDATION,
+    SUBMIT_MAX_BODY_SIZE,
+    SUBMIT_STREAMING,
+)
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
+from ichnaea.submit import (
+    check_body,
+    deferred_item,
+    report_items,
+)
 
 
 class BaseSubmitView(BaseAPIView):
     """Common base class for all submit related views."""
 
+    deferred_validation = SUBMIT_DEFERRED_VALIDATION
     error_on_invalidkey = False
+    max_body_size = SUBMIT_MAX_BODY_SIZE
+    stream_batch = 100  # Number of reports validated at once.
+    streaming = SUBMIT_STREAMING
     view_type = 'submit'
     success = UploadSuccess
 
@@ -34,7 +55,79 @@ class BaseSubmitView(BaseAPIView):
             tags = ['key:%s' % api_key.valid_key]
         self.stats_client.incr('data.batch.upload', tags=tags)
 
+    def preprocess_deferred(self):
+        """
+        Only do cheap structural checks of the request body.
+
+        Return the body to queue and whether or not it is gzip encoded.
+        """
+        with self.timer.stage('preprocess'):
+            gzip = self.request.headers.get('Content-Encoding') == 'gzip'
+            try:
+                body = check_body(
+                    self.request.body, gzip=gzip,
+                    encoding=self.request.charset,
+                    max_size=self.max_body_size)
+            except BodyTooLargeError:
+                raise self.prepare_exception(RequestTooLarge())
+            except (GZIPDecodeError, ValueError):
+                raise self.prepare_exception(ParseError())
+
+        return (body, gzip)
+
+    def submit_deferred(self, api_key):
+        body, gzip = self.preprocess_deferred()
+
+        if not api_key.store_sample('submit'):
+            # only store some percentage of the requests
+            return
+
+        # Queue the body, the async workers validate it.
+        self.queue.enqueue([deferred_item(
+            api_key.valid_key, self.metric_path, body,
+            gzip=gzip, charset=self.request.charset)])
+        self.emit_upload_metrics(1, api_key)
+
+    def _validate_chunk(self, api_key, items):
+        reports = self.schema['items'].deserialize(items)
+        return report_items(api_key.valid_key, reports)
+
+    def submit_streaming(self, api_key):
+        data = []
+        items = []
+        with self.timer.stage('stream'):
+            chunks = stream.iter_text(
+                self.request.body_file,
+                gzip=self.request.headers.get('Content-Encoding') == 'gzip',
+                encoding=self.request.charset,
+                max_size=self.max_body_size)
+            try:
+                for item in stream.iter_items(chunks):
+                    items.append(item)
+                    if len(items) >= self.stream_batch:
+                        data.extend(self._validate_chunk(api_key, items))
+                        items = []
+                data.extend(self._validate_chunk(api_key, items))
+            except BodyTooLargeError:
+                raise self.prepare_exception(RequestTooLarge())
+            except (GZIPDecodeError, ValueError, colander.Invalid):
+                raise self.prepare_exception(ParseError())
+
+        if not api_key.store_sample('submit'):
+            # only store some percentage of the requests
+            return
+
+        # Only queue the reports once the entire body has been parsed.
+        if data:
+            self.queue.enqueue(data)
+        self.emit_upload_metrics(len(data), api_key)
+
     def submit(self, api_key):
+        if self.deferred_validation:
+            return self.submit_deferred(api_key)
+        if self.streaming:
+            return self.submit_streaming(api_key)
+
         request_data, errors = self.preprocess_request()
 
         if not request_data:
@@ -45,21 +138,7 @@ class BaseSubmitView(BaseAPIView):
             # only store some percentage of the requests
             return
 
-        valid_key = api_key.valid_key
-        data = []
-        for report in request_data['items']:
-            source = 'gnss'
-            if report is not None:
-                position = report.get('position')
-                if position is not None:
-                    source = position.get('source', 'gnss')
-
-            data.append({
-                'api_key': valid_key,
-                'report': report,
-                'source': source,
-            })
-
+        data = report_items(api_key.valid_key, request_data['items'])
         self.queue.enqueue(data)
         self.emit_upload_metrics(len(data), api_key)
 
@@ -1,15 +1,34 @@
+import copy
+import random
 import time
+from unittest import mock
 
 import colander
 from pyramid.request import Request
 
 from ichnaea.api.key import (
+    API_CACHE_CHANNEL,
+    ApiKeyCache,
     get_key,
+    invalidate_key,
     Key,
 )
 from ichnaea.api import exceptions as api_exceptions
-from ichnaea.api.rate_limit import rate_limit_exceeded
-from ichnaea.api.schema import RenamingMapping
+from ichnaea.api.rate_limit import (
+    ApiUsageBuffer,
+    gcra_rate_limit_exceeded,
+    rate_limit_exceeded,
+)
+from ichnaea.api.locate import schema as locate_schema
+from ichnaea.api.locate.schema_v0 import LOCATE_V0_SCHEMA, LocateV0Schema
+from ichnaea.api.locate.schema_v1 import LOCATE_V1_SCHEMA, LocateV1Schema
+from ichnaea.api.schema import (
+    compile_schema,
+    RenamingMapping,
+)
+from ichnaea.api.submit.schema_v0 import SUBMIT_V0_SCHEMA, SubmitV0Schema
+from ichnaea.api.submit.schema_v1 import SUBMIT_V1_SCHEMA, SubmitV1Schema
+from ichnaea.api.submit.schema_v2 import SUBMIT_V2_SCHEMA, SubmitV2Schema
 from ichnaea.tests.factories import (
     ApiKeyFactory,
     KeyFactory,
@@ -48,6 +67,20 @@ class TestKey(object):
         assert result2 is None
         session_tracker(1)
 
+    def test_get_stats(self, session, stats):
+        api_key = ApiKeyFactory()
+        session.flush()
+
+        get_key(session, api_key.valid_key, stats_client=stats)
+        get_key(session, api_key.valid_key, stats_client=stats)
+        get_key(session, 'unknown', stats_client=stats)
+        get_key(session, 'unknown', stats_client=stats)
+        stats.check(counter=[
+            ('api.key.cache', 2, 1, ['status:miss']),
+            ('api.key.cache', 1, 1, ['status:hit']),
+            ('api.key.cache', 1, 1, ['status:negative']),
+        ])
+
     def test_allowed(self):
         def one(**kw):
             return KeyFactory(**kw)
@@ -107,6 +140,96 @@ class TestKey(object):
             allow_fallback=True, fallback_cache_expire=0).can_fallback())
 
 
+class TestApiKeyCache(object):
+
+    def test_stale(self, session, session_tracker):
+        cache = ApiKeyCache(timeout=-1.0, stale_timeout=3600.0)
+        api_key = ApiKeyFactory(maxreq=10)
+        session.flush()
+        session_tracker(1)
+
+        assert cache.get(session, api_key.valid_key).maxreq == 10
+        session_tracker(2)
+
+        # The stale value is returned, while it is refreshed.
+        api_key.maxreq = 20
+        session.flush()
+        assert cache.get(session, api_key.valid_key).maxreq == 10
+        session_tracker(4)
+        assert cache.get(session, api_key.valid_key).maxreq == 20
+        session_tracker(5)
+
+    def test_stale_expired(self, session, session_tracker):
+        cache = ApiKeyCache(timeout=-1.0, stale_timeout=0.0)
+        api_key = ApiKeyFactory(maxreq=10)
+        session.flush()
+        assert cache.get(session, api_key.valid_key).maxreq == 10
+        api_key.maxreq = 20
+        session.flush()
+        assert cache.get(session, api_key.valid_key).maxreq == 20
+
+    def test_stale_removed(self, session):
+        cache = ApiKeyCache(timeout=-1.0, stale_timeout=3600.0)
+        api_key = ApiKeyFactory()
+        session.flush()
+        assert cache.get(session, api_key.valid_key) is not None
+        session.delete(api_key)
+        session.flush()
+        assert cache.get(session, api_key.valid_key) is not None
+        assert cache.get(session, api_key.valid_key) is None
+
+    def test_negative(self, session, session_tracker):
+        cache = ApiKeyCache(size=1, negative_size=1)
+        api_key = ApiKeyFactory()
+        session.flush()
+        session_tracker(1)
+
+        assert cache.get(session, api_key.valid_key) is not None
+        assert cache.get(session, 'unknown1') is None
+        assert cache.get(session, 'unknown2') is None
+        session_tracker(4)
+        # Unknown keys don't evict known keys.
+        assert cache.get(session, api_key.valid_key) is not None
+        assert cache.get(session, 'unknown2') is None
+        session_tracker(4)
+
+    def test_invalidate(self, redis, session, session_tracker):
+        cache = ApiKeyCache()
+        cache.poll_interval = 0.0
+        cache.subscribe(redis)
+        try:
+            api_key = ApiKeyFactory(maxreq=10)
+            session.flush()
+            assert cache.get(session, api_key.valid_key).maxreq == 10
+            assert cache.get(session, 'unknown') is None
+            session_tracker(3)
+
+            api_key.maxreq = 20
+            session.flush()
+            invalidate_key(redis, api_key.valid_key)
+            invalidate_key(redis, 'unknown')
+            time.sleep(0.1)
+            assert cache.get(session, api_key.valid_key).maxreq == 20
+            assert cache.get(session, 'unknown') is None
+            session_tracker(6)
+        finally:
+            cache.unsubscribe()
+
+    def test_resubscribe(self, redis):
+        cache = ApiKeyCache()
+        cache.subscribe(redis)
+        first = cache._pubsub
+        cache.subscribe(redis)
+        try:
+            assert cache._pubsub is not first
+            assert first.connection is None
+            assert redis.execute_command(
+                'PUBSUB', 'NUMSUB', API_CACHE_CHANNEL)[1] == 1
+        finally:
+            cache.unsubscribe()
+        assert cache._pubsub is None
+
+
 class TestRenamingMapping(object):
 
     def test_to_name(self):
@@ -131,6 +254,95 @@ class TestRenamingMapping(object):
         assert 'input_name' not in output_data
 
 
+class TestCompileSchema(object):
+
+    values = [
+        None, True, False, 0, 1, -1, 3, 15, 36, 262, 2412, 65536, -80, 1.5,
+        float('inf'), 1500000000000, '', '1', 'gsm', 'GSM', 'umts', 'lte',
+        'gnss', 'abcdef123456', 'AB:CD:EF:12:34:56', 'ab-cd', '2017-06-01',
+        [], {}, [{}], ['gsm'],
+    ]
+    typed_values = [
+        (colander.Boolean, [True, False]),
+        (colander.Number, [0, 1, 3, 15, 36, 262, 2412, 65536, -80]),
+        (colander.String, ['gsm', 'lte', 'gnss', 'abcdef123456']),
+    ]
+
+    def _sample(self, rnd, node, depth=0):
+        if node.children and depth < 6 and rnd.random() < 0.9:
+            if isinstance(node.typ, colander.Sequence):
+                return [self._sample(rnd, node.children[0], depth + 1)
+                        for i in range(rnd.randint(0, 3))]
+            result = {}
+            for subnode in node.children:
+                if rnd.random() < 0.8:
+                    result[subnode.name] = self._sample(
+                        rnd, subnode, depth + 1)
+            if rnd.random() < 0.1:
+                result['unknown'] = rnd.choice(self.values)
+            return result
+        if rnd.random() < 0.7:
+            for typ, values in self.typed_values:
+                if isinstance(node.typ, typ):
+                    return rnd.choice(values)
+        return copy.deepcopy(rnd.choice(self.values))
+
+    def _deserialize(self, schema, data):
+        try:
+            return schema.deserialize(copy.deepcopy(data))
+        except colander.Invalid as exc:
+            return ('invalid', exc.asdict())
+        except Exception as exc:
+            return ('error', type(exc))
+
+    def check(self, original, compiled, runs=500):
+        assert compiled is not original
+        rnd = random.Random(42)
+        with mock.patch('time.time', return_value=1500000000.0):
+            for i in range(runs):
+                data = self._sample(rnd, original)
+                expected = self._deserialize(original, data)
+                assert self._deserialize(compiled, data) == expected
+
+    def test_compiled(self):
+        compiled = compile_schema(SubmitV1Schema())
+        assert 'deserialize' in vars(compiled.typ)
+        assert 'deserialize' in vars(compiled['items'].typ)
+        assert 'deserialize' not in vars(SubmitV1Schema().typ)
+
+    def test_renaming(self):
+        class SampleSchema(colander.MappingSchema):
+            schema_type = RenamingMapping
+
+            first = colander.SchemaNode(
+                colander.Integer(), missing=None, to_name='second')
+            second = colander.SchemaNode(
+                colander.Integer(), missing=colander.drop)
+
+        self.check(SampleSchema(), compile_schema(SampleSchema()))
+
+    def test_invalid(self):
+        for data in (None, 'abc', 1, [], (), {'items': 'abc'}):
+            assert (self._deserialize(SUBMIT_V1_SCHEMA, data) ==
+                    self._deserialize(SubmitV1Schema(), data))
+
+    def test_locate(self):
+        self.check(LocateV0Schema(), LOCATE_V0_SCHEMA)
+        self.check(LocateV1Schema(), LOCATE_V1_SCHEMA)
+
+    def test_lookups(self):
+        for name in ('ValidBlueLookupSchema', 'ValidCellAreaLookupSchema',
+                     'ValidCellLookupSchema', 'ValidWifiLookupSchema',
+                     'FallbackSchema'):
+            schema_class = getattr(locate_schema, name)
+            self.check(schema_class(), compile_schema(schema_class()))
+
+    def test_submit(self):
+        self.check(SubmitV0Schema(), SUBMIT_V0_SCHEMA)
+        self.check(SubmitV1Schema(), SUBMIT_V1_SCHEMA)
+        self.check(SubmitV2Schema(), SUBMIT_V2_SCHEMA)
+
+
 class TestExceptions(object):
 
     def _check(self, error, status,
@@ -172,6 +384,11 @@ class TestExceptions(object):
         response = self._check(error, 400)
         assert b'parseError' in response.body
 
+    def test_request_too_large(self):
+        error = api_exceptions.RequestTooLarge
+        response = self._check(error, 413)
+        assert b'requestTooLarge' in response.body
+
     def test_upload_success(self):
         error = api_exceptions.UploadSuccess
         response = self._check(error, 200)
@@ -230,3 +447,114 @@ class TestLimiter(object):
             maxreq=0,
             expire=1,
         )
+
+
+class TestGCRALimiter(object):
+
+    rate_key = 'fallback_ratelimit:gcra:fall:60'
+
+    def test_maxrequests(self, redis):
+        for i in range(5):
+            assert not gcra_rate_limit_exceeded(
+                redis, self.rate_key, maxreq=5, interval=60)
+        assert gcra_rate_limit_exceeded(
+            redis, self.rate_key, maxreq=5, interval=60)
+        # limited requests don't consume any capacity
+        assert gcra_rate_limit_exceeded(
+            redis, self.rate_key, maxreq=5, interval=60)
+
+    def test_expiry(self, redis):
+        assert not gcra_rate_limit_exceeded(
+            redis, self.rate_key, maxreq=5, interval=60)
+        # one request keeps the key around for one emission interval
+        assert 0 < redis.pttl(self.rate_key) <= 12000
+
+    def test_sliding(self, redis):
+        for i in range(2):
+            assert not gcra_rate_limit_exceeded(
+                redis, self.rate_key, maxreq=2, interval=1)
+        assert gcra_rate_limit_exceeded(
+            redis, self.rate_key, maxreq=2, interval=1)
+        # capacity for one request is back after half the interval,
+        # move the stored arrival time back instead of waiting
+        redis.set(self.rate_key, float(redis.get(self.rate_key)) - 600.0)
+        assert not gcra_rate_limit_exceeded(
+            redis, self.rate_key, maxreq=2, interval=1)
+        assert gcra_rate_limit_exceeded(
+            redis, self.rate_key, maxreq=2, interval=1)
+
+    def test_no_limit(self):
+        broken_redis = None
+        assert not gcra_rate_limit_exceeded(
+            broken_redis, self.rate_key, maxreq=0, interval=1)
+
+
+class TestApiUsageBuffer(object):
+
+    ip_key = 'apiuser:locate:key_a:2015-01-01'
+    rate_key = 'apilimit:key_a:v1.geolocate:20150101'
+
+    def test_buffered(self, raven, redis):
+        usage = ApiUsageBuffer(redis, raven, interval=3600.0)
+        for ip in ('127.0.0.1', '127.0.0.2', '127.0.0.1'):
+            assert not usage.log_and_check(
+                self.ip_key, ip, self.rate_key, 0)
+        assert redis.get(self.rate_key) is None
+        assert redis.pfcount(self.ip_key) == 0
+
+        assert usage.flush() == {self.rate_key: 3}
+        assert int(redis.get(self.rate_key)) == 3
+        assert redis.pfcount(self.ip_key) == 2
+        assert 0 < redis.ttl(self.rate_key) <= usage.rate_expire
+        assert 0 < redis.ttl(self.ip_key) <= usage.ip_expire
+
+    def test_interval(self, raven, redis):
+        usage = ApiUsageBuffer(redis, raven, interval=0.0)
+        assert not usage.log_and_check(
+            self.ip_key, '127.0.0.1', self.rate_key, 0)
+        assert int(redis.get(self.rate_key)) == 1
+
+    def test_limit(self, raven, redis):
+        usage = ApiUsageBuffer(redis, raven, interval=3600.0)
+        for i in range(3):
+            assert not usage.log_and_check(
+                self.ip_key, '127.0.0.1', self.rate_key, 3)
+        assert redis.get(self.rate_key) is None
+        assert usage.log_and_check(
+            self.ip_key, '127.0.0.1', self.rate_key, 3)
+        assert int(redis.get(self.rate_key)) == 4
+
+    def test_limit_global(self, raven, redis):
+        usage = ApiUsageBuffer(redis, raven, interval=3600.0, tolerance=2)
+        redis.set(self.rate_key, 5)
+        # Within the tolerance, the global count is checked.
+        assert usage.log_and_check(
+            self.ip_key, '127.0.0.1', self.rate_key, 2)
+        assert int(redis.get(self.rate_key)) == 6
+        # The synced global count is used for the next requests.
+        for i in range(2):
+            assert not usage.log_and_check(
+                self.ip_key, '127.0.0.1', self.rate_key, 10)
+        assert int(redis.get(self.rate_key)) == 6
+        assert not usage.log_and_check(
+            self.ip_key, '127.0.0.1', self.rate_key, 10)
+        assert int(redis.get(self.rate_key)) == 9
+
+    def test_limit_single_key(self, raven, redis):
+        usage = ApiUsageBuffer(redis, raven, interval=3600.0, tolerance=2)
+        other_key = 'apilimit:key_b:v1.geolocate:20150101'
+        assert not usage.log_and_check(
+            self.ip_key, '127.0.0.1', other_key, 10)
+        redis.set(self.rate_key, 5)
+        # Only the key close to its limit is written to Redis.
+        assert usage.log_and_check(
+            self.ip_key, '127.0.0.1', self.rate_key, 2)
+        assert int(redis.get(self.rate_key)) == 6
+        assert redis.get(other_key) is None
+        assert redis.pfcount(self.ip_key) == 0
+        # Once the key is over its limit, it is counted locally again.
+        for i in range(3):
+            assert usage.log_and_check(
+                self.ip_key, '127.0.0.1', self.rate_key, 2)
+        assert int(redis.get(self.rate_key)) == 6
+        assert usage.flush() == {self.rate_key: 9, other_key: 1}
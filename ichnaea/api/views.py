@@ -5,7 +5,6 @@ Implementation of a API specific HTTP service view.
 import colander
 from ipaddress import ip_address
 from redis import RedisError
-import simplejson as json
 
 from ichnaea.api.exceptions import (
     DailyLimitExceeded,
@@ -17,7 +16,10 @@ from ichnaea.api.key import (
     Key,
     validated_key,
 )
+from ichnaea import codec
+from ichnaea.config import API_SERVER_TIMING
 from ichnaea.exceptions import GZIPDecodeError
+from ichnaea.log import StageTimer
 from ichnaea import util
 from ichnaea.webapp.view import BaseView
 
@@ -29,13 +31,16 @@ class BaseAPIView(BaseView):
     ip_log_and_rate_limit = True  # Count unique IP addresses and track limits?
     metric_path = None  # Dotted URL path, for example v1.submit.
     schema = None  # An instance of a colander schema to validate the data.
+    server_timing = API_SERVER_TIMING  # Add a Server-Timing header?
     view_type = None  # The type of view, for example submit or locate.
 
     def __init__(self, request):
         super(BaseAPIView, self).__init__(request)
+        self.api_usage = request.registry.api_usage
         self.raven_client = request.registry.raven_client
         self.redis_client = request.registry.redis_client
         self.stats_client = request.registry.stats_client
+        self.timer = StageTimer()
 
     def parse_apikey(self):
         try:
@@ -76,6 +81,11 @@ class BaseAPIView(BaseView):
             time=now.strftime('%Y%m%d')
         )
 
+        if self.api_usage is not None:
+            # Aggregate data locally and only occasionally talk to Redis.
+            return self.api_usage.log_and_check(
+                log_ip_key, ip, rate_key, maxreq)
+
         should_limit = False
         try:
             with self.redis_client.pipeline() as pipe:
@@ -92,6 +102,10 @@ class BaseAPIView(BaseView):
         return should_limit
 
     def preprocess_request(self):
+        with self.timer.stage('preprocess'):
+            return self._preprocess_request()
+
+    def _preprocess_request(self):
         errors = []
 
         request_content = self.request.body
@@ -104,7 +118,7 @@ class BaseAPIView(BaseView):
 
         request_data = {}
         try:
-            request_data = json.loads(
+            request_data = codec.loads(
                 request_content, encoding=self.request.charset)
         except ValueError as exc:
             errors.append({'name': None, 'description': repr(exc)})
@@ -120,8 +134,23 @@ class BaseAPIView(BaseView):
 
         return (validated_data, errors)
 
+    def _add_server_timing(self, request, response):
+        if self.timer.durations:
+            response.headers['Server-Timing'] = self.timer.header()
+
     def __call__(self):
         """Execute the view and return a response."""
+        if self.server_timing:
+            # Use a callback, so error responses and responses not
+            # based on request.response get the header as well.
+            self.request.add_response_callback(self._add_server_timing)
+        try:
+            return self._call()
+        finally:
+            self.timer.send(self.stats_client, self.view_type + '.timing',
+                            tags=['path:' + self.metric_path])
+
+    def _call(self):
         api_key = None
         api_key_text = self.parse_apikey()
         skip_check = False
@@ -133,7 +162,11 @@ class BaseAPIView(BaseView):
 
         if api_key_text is not None:
             try:
-                api_key = get_key(self.request.db_session, api_key_text)
+                with self.timer.stage('get_key'):
+                    api_key = get_key(
+                        self.request.db_session, api_key_text,
+                        database=self.request.registry.db,
+                        stats_client=self.stats_client)
             except Exception:
                 # if we cannot connect to backend DB, skip api key check
                 skip_check = True
@@ -145,7 +178,10 @@ class BaseAPIView(BaseView):
 
             # Potentially avoid overhead of Redis connection.
             if self.ip_log_and_rate_limit:
-                if self.log_ip_and_rate_limited(valid_key, api_key.maxreq):
+                with self.timer.stage('rate_limit'):
+                    limited = self.log_ip_and_rate_limited(
+                        valid_key, api_key.maxreq)
+                if limited:
                     raise self.prepare_exception(DailyLimitExceeded())
 
         elif skip_check:
@@ -2,13 +2,31 @@
 Contains celery specific one time configuration code.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 from kombu import Queue
 from kombu.serialization import register
-import simplejson
 
+from ichnaea.async.task import TaskTrigger
 from ichnaea.cache import configure_redis
+from ichnaea import codec
+from ichnaea.config import (
+    DATA_QUEUE_ADAPTIVE,
+    DATA_QUEUE_ADAPTIVE_FACTOR,
+    DATA_QUEUE_BACKEND,
+    DATA_QUEUE_BINARY,
+    DATA_QUEUE_FRAMES,
+    DATA_QUEUE_PARTITIONS,
+    DATA_QUEUE_RELIABLE,
+    DATA_QUEUE_TRIGGER,
+    EXPORT_CONCURRENCY,
+)
 from ichnaea.db import configure_db
 from ichnaea.geoip import configure_geoip
+from ichnaea.http import (
+    configure_http_session,
+    configure_s3,
+)
 from ichnaea.log import (
     configure_raven,
     configure_stats,
@@ -19,7 +37,11 @@ from ichnaea.models import (
     DataMap,
     WifiShard,
 )
-from ichnaea.queue import DataQueue
+from ichnaea.queue import (
+    BatchController,
+    DataQueue,
+    StreamDataQueue,
+)
 
 TASK_QUEUES = (
     Queue('celery_blue', routing_key='celery_blue'),
@@ -34,8 +56,8 @@ TASK_QUEUES = (
 )
 
 register('internal_json',
-         simplejson.dumps,
-         simplejson.loads,
+         codec.dumps,
+         codec.loads,
          content_type='application/x-internaljson',
          content_encoding='utf-8')
 
@@ -52,6 +74,14 @@ def configure_celery(celery_app):
     celery_app.config_from_object('ichnaea.async.settings')
 
 
+def _update_queue(key, redis_client, json=True, reliable=False):
+    if DATA_QUEUE_BACKEND == 'stream':
+        return StreamDataQueue(key, redis_client, batch=500, json=json,
+                               partitions=DATA_QUEUE_PARTITIONS)
+    return DataQueue(key, redis_client, batch=500, json=json,
+                     reliable=reliable)
+
+
 def configure_data(redis_client):
     """
     Configure fixed set of data queues.
@@ -59,25 +89,63 @@ def configure_data(redis_client):
     data_queues = {
         # *_incoming need to be the exact same as in webapp.config
         'update_incoming': DataQueue('update_incoming', redis_client,
-                                     batch=100, compress=True),
+                                     batch=100, compress=True,
+                                     frames=DATA_QUEUE_FRAMES),
     }
     for key in ('update_cellarea', ):
         data_queues[key] = DataQueue(key, redis_client, batch=100, json=False)
     for shard_id in BlueShard.shards().keys():
         key = 'update_blue_' + shard_id
-        data_queues[key] = DataQueue(key, redis_client, batch=500)
+        data_queues[key] = _update_queue(key, redis_client,
+                                         json=not DATA_QUEUE_BINARY,
+                                         reliable=DATA_QUEUE_RELIABLE)
     for shard_id in DataMap.shards().keys():
         key = 'update_datamap_' + shard_id
-        data_queues[key] = DataQueue(key, redis_client, batch=500, json=False)
+        data_queues[key] = _update_queue(key, redis_client, json=False)
     for shard_id in CellShard.shards().keys():
         key = 'update_cell_' + shard_id
-        data_queues[key] = DataQueue(key, redis_client, batch=500)
+        data_queues[key] = _update_queue(key, redis_client,
+                                         json=not DATA_QUEUE_BINARY,
+                                         reliable=DATA_QUEUE_RELIABLE)
     for shard_id in WifiShard.shards().keys():
         key = 'update_wifi_' + shard_id
-        data_queues[key] = DataQueue(key, redis_client, batch=500)
+        data_queues[key] = _update_queue(key, redis_client,
+                                         json=not DATA_QUEUE_BINARY,
+                                         reliable=DATA_QUEUE_RELIABLE)
     return data_queues
 
 
+def configure_controllers(data_queues, factor=DATA_QUEUE_ADAPTIVE_FACTOR):
+    """
+    Set up the data queues to adapt their batch sizes, between their
+    configured batch size divided and multiplied by the factor.
+    """
+    for queue in data_queues.values():
+        queue.controller = BatchController(
+            max(queue.batch // factor, 1), queue.batch * factor,
+            batch=queue.batch)
+
+
+def configure_triggers(celery_app, data_queues, raven_client=None):
+    """
+    Set up the data queues to schedule their processing tasks, when
+    data is put into them.
+    """
+    celery_app.loader.import_default_modules()
+    for key, queue in data_queues.items():
+        if not isinstance(queue, DataQueue):
+            continue
+        if key in ('update_incoming', 'update_cellarea'):
+            name, kwargs = (key, None)
+        else:
+            # Sharded queues, like update_wifi_0.
+            name, shard_id = key.rsplit('_', 1)
+            kwargs = {'shard_id': shard_id}
+        queue.trigger = TaskTrigger(
+            celery_app, 'ichnaea.data.tasks.' + name,
+            kwargs=kwargs, raven_client=raven_client)
+
+
 def init_beat(beat, celery_app):
     """
     Configure the passed in celery beat app, usually stored in
@@ -89,8 +157,9 @@ def init_beat(beat, celery_app):
 
 
 def init_worker(celery_app,
-                _db=None, _geoip_db=None,
-                _raven_client=None, _redis_client=None, _stats_client=None):
+                _db=None, _geoip_db=None, _http_session=None,
+                _raven_client=None, _redis_client=None, _s3_client=None,
+                _stats_client=None):
     """
     Configure the passed in celery app, usually stored in
     :data:`ichnaea.async.app.celery_app`.
@@ -118,10 +187,22 @@ def init_worker(celery_app,
     celery_app.geoip_db = configure_geoip(
         raven_client=raven_client, _client=_geoip_db)
 
+    # connection pools and threads shared by all exports
+    pool_size = max(EXPORT_CONCURRENCY, 20)
+    celery_app.http_session = configure_http_session(
+        size=pool_size, _session=_http_session)
+    celery_app.s3_client = configure_s3(size=pool_size, _client=_s3_client)
+    celery_app.export_pool = ThreadPoolExecutor(
+        max_workers=max(EXPORT_CONCURRENCY, 1))
+
     # configure data queues
     celery_app.all_queues = all_queues = set([q.name for q in TASK_QUEUES])
 
     celery_app.data_queues = data_queues = configure_data(redis_client)
+    if DATA_QUEUE_ADAPTIVE:
+        configure_controllers(data_queues)
+    if DATA_QUEUE_TRIGGER:
+        configure_triggers(celery_app, data_queues, raven_client=raven_client)
     all_queues = all_queues.union(
         set([queue.key for queue in data_queues.values() if queue.key]))
 
@@ -141,6 +222,11 @@ def shutdown_worker(celery_app):
     del celery_app.stats_client
     celery_app.geoip_db.close()
     del celery_app.geoip_db
+    celery_app.http_session.close()
+    del celery_app.http_session
+    del celery_app.s3_client
+    celery_app.export_pool.shutdown()
+    del celery_app.export_pool
 
     del celery_app.all_queues
     del celery_app.data_queues
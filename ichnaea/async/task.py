@@ -141,11 +141,24 @@ class BaseTask(Task):
         """
         return redis_pipeline(self.redis_client, execute=execute)
 
+    @property
+    def export_pool(self):
+        """
+        Exposes a :class:`~concurrent.futures.ThreadPoolExecutor`
+        for parallel exports.
+        """
+        return self.app.export_pool
+
     @property
     def geoip_db(self):  # pragma: no cover
         """Exposes a :class:`~ichnaea.geoip.GeoIPWrapper`."""
         return self.app.geoip_db
 
+    @property
+    def http_session(self):
+        """Exposes a :class:`requests.Session`."""
+        return self.app.http_session
+
     @property
     def raven_client(self):  # pragma: no cover
         """Exposes a :class:`~raven.Client`."""
@@ -156,7 +169,38 @@ class BaseTask(Task):
         """Exposes a :class:`~ichnaea.cache.RedisClient`."""
         return self.app.redis_client
 
+    @property
+    def s3_client(self):
+        """Exposes a :class:`botocore.client.S3` client."""
+        return self.app.s3_client
+
     @property
     def stats_client(self):
         """Exposes a :class:`~ichnaea.log.StatsClient`."""
         return self.app.stats_client
+
+
+class TaskTrigger(object):
+    """
+    A :class:`~ichnaea.queue.DataQueue` trigger, which schedules the
+    named task to process the queue.
+    """
+
+    def __init__(self, celery_app, name, kwargs=None, raven_client=None):
+        self.celery_app = celery_app
+        self.name = name
+        self.kwargs = kwargs
+        self.raven_client = raven_client
+
+    def __call__(self, countdown=0):
+        task = self.celery_app.tasks[self.name]
+        expires = task.expires
+        if expires is not None:
+            expires += countdown
+        try:
+            task.apply_async(kwargs=self.kwargs,
+                             countdown=countdown or None, expires=expires)
+        except Exception:  # pragma: no cover
+            # The queued data is still processed by the periodic tasks.
+            if self.raven_client is not None:
+                self.raven_client.captureException()
@@ -2,9 +2,15 @@ from inspect import getmembers
 import os
 import shutil
 import tempfile
+from unittest import mock
 
 from celery import signals
 
+from ichnaea.async.config import (
+    configure_controllers,
+    configure_data,
+    configure_triggers,
+)
 from ichnaea.async.task import BaseTask
 
 
@@ -59,3 +65,38 @@ class TestWorkerConfig(object):
         # assert 'redis' in celery.conf['result_backend']
         assert celery.conf['CELERY_ALWAYS_EAGER']
         assert 'redis' in celery.conf['CELERY_RESULT_BACKEND']
+
+
+class TestControllers(object):
+
+    def test_configure(self, redis):
+        data_queues = configure_data(redis)
+        configure_controllers(data_queues, factor=5)
+        controller = data_queues['update_incoming'].controller
+        assert (controller.min_batch, controller.max_batch) == (20, 500)
+        assert controller.batch == 100
+        controller = data_queues['update_wifi_0'].controller
+        assert (controller.min_batch, controller.max_batch) == (100, 2500)
+        assert controller.batch == 500
+
+
+class TestTrigger(object):
+
+    def test_configure(self, celery, redis):
+        data_queues = configure_data(redis)
+        configure_triggers(celery, data_queues)
+        trigger = data_queues['update_incoming'].trigger
+        assert trigger.name == 'ichnaea.data.tasks.update_incoming'
+        assert trigger.kwargs is None
+        trigger = data_queues['update_cell_lte'].trigger
+        assert trigger.name == 'ichnaea.data.tasks.update_cell'
+        assert trigger.kwargs == {'shard_id': 'lte'}
+        trigger = data_queues['update_datamap_ne'].trigger
+        assert trigger.name == 'ichnaea.data.tasks.update_datamap'
+        assert trigger.kwargs == {'shard_id': 'ne'}
+
+        with mock.patch.object(celery.tasks[trigger.name],
+                               'apply_async') as apply_async:
+            trigger(countdown=10)
+        apply_async.assert_called_once_with(
+            kwargs={'shard_id': 'ne'}, countdown=10, expires=40)
@@ -0,0 +1,108 @@
+"""
+Functions for encoding and decoding JSON.
+
+All JSON handling goes through this module, so the underlying library
+can be selected in one place via the `JSON_LIBRARY` setting. The
+default is simplejson; ujson is a faster C-based alternative that is
+used if it is selected and installed.
+
+Both codecs return Unicode strings from :func:`dumps`, accept Unicode
+strings or bytes in :func:`loads` and decode bytes embedded in the
+encoded data as UTF-8. Decoding errors are raised as `ValueError`
+subclasses.
+
+:func:`raw_decode` decodes a single value from a position inside a
+larger string. ujson has no such interface, so it always uses
+simplejson.
+"""
+
+import simplejson
+
+from ichnaea.config import JSON_LIBRARY
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+class SimplejsonCodec(object):
+    """A JSON codec based on the simplejson library."""
+
+    name = 'simplejson'
+
+    _decoder = simplejson.JSONDecoder()
+
+    def dumps(self, value):
+        return simplejson.dumps(value, encoding='utf-8')
+
+    def loads(self, value, encoding=None):
+        return simplejson.loads(value, encoding=encoding)
+
+    def raw_decode(self, value, pos=0):
+        return self._decoder.raw_decode(value, pos)
+
+
+class UjsonCodec(object):
+    """A JSON codec based on the ujson library."""
+
+    name = 'ujson'
+
+    def _default(self, value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        raise TypeError(repr(value) + ' is not JSON serializable')
+
+    def dumps(self, value):
+        return ujson.dumps(value,
+                           default=self._default,
+                           escape_forward_slashes=False)
+
+    def loads(self, value, encoding=None):
+        if isinstance(value, bytes):
+            value = value.decode(encoding or 'utf-8')
+        if value.startswith('\ufeff'):
+            value = value[1:]
+        return ujson.loads(value)
+
+    def raw_decode(self, value, pos=0):
+        return SimplejsonCodec._decoder.raw_decode(value, pos)
+
+
+def create_codec(library=JSON_LIBRARY):
+    """
+    Return a codec for the named library, falling back to simplejson
+    if the library isn't installed.
+    """
+    if library == 'ujson' and ujson is not None:
+        return UjsonCodec()
+    return SimplejsonCodec()
+
+
+CODEC = create_codec()
+
+
+def dumps(value):
+    """Encode the value as JSON and return a Unicode string."""
+    return CODEC.dumps(value)
+
+
+def loads(value, encoding=None):
+    """
+    Decode JSON from a Unicode string or bytes. Bytes are decoded
+    using the given encoding, defaulting to UTF-8.
+    """
+    return CODEC.loads(value, encoding=encoding)
+
+
+def raw_decode(value, pos=0):
+    """
+    Decode the JSON value starting at position `pos` of the Unicode
+    string. Return the value and the position after it.
+    """
+    return CODEC.raw_decode(value, pos)
+
+
+def load(fd):
+    """Decode JSON from an open file."""
+    return CODEC.loads(fd.read())
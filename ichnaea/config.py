@@ -30,6 +30,21 @@ VERSION_INFO = {
     'version': VERSION,
 }
 
+# Buffer API usage counters in memory and flush them to Redis every
+# given number of seconds. Disabled if set to zero.
+API_USAGE_INTERVAL = float(os.environ.get('API_USAGE_INTERVAL', '0'))
+API_USAGE_TOLERANCE = int(os.environ.get('API_USAGE_TOLERANCE', '0'))
+
+# Add a Server-Timing header with a per-stage breakdown of the
+# request duration to API responses.
+API_SERVER_TIMING = os.environ.get(
+    'API_SERVER_TIMING', 'false').lower() in ('1', 'true')
+
+# Number of known and unknown API keys cached per web worker.
+API_KEY_CACHE_SIZE = int(os.environ.get('API_KEY_CACHE_SIZE', '500'))
+API_KEY_CACHE_NEGATIVE_SIZE = int(
+    os.environ.get('API_KEY_CACHE_NEGATIVE_SIZE', '1000'))
+
 ASSET_BUCKET = os.environ.get('ASSET_BUCKET')
 ASSET_URL = os.environ.get('ASSET_URL')
 
@@ -75,12 +90,20 @@ ALEMBIC_CFG.set_section_option(
 ALEMBIC_CFG.set_section_option(
     'alembic', 'sqlalchemy.url', DB_DDL_URI)
 
+# One of simplejson or ujson
+JSON_LIBRARY = os.environ.get('JSON_LIBRARY', 'simplejson')
+
 GEOIP_PATH = os.environ.get('GEOIP_PATH')
 if not GEOIP_PATH:
     GEOIP_PATH = os.path.join(HERE, 'tests/data/GeoIP2-City-Test.mmdb')
 
 MAP_TOKEN = os.environ.get('MAP_TOKEN')
 
+# Store the not found marker of the fallback cache as a single byte
+# instead of the readable b'404'.
+FALLBACK_CACHE_COMPACT = os.environ.get(
+    'FALLBACK_CACHE_COMPACT', 'true').lower() in ('1', 'true')
+
 REDIS_HOST = os.environ.get('REDIS_HOST')
 REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
 REDIS_DB = '1' if TESTING else '0'
@@ -91,6 +114,69 @@ if REDIS_HOST and not REDIS_URI:
 SENTRY_DSN = os.environ.get('SENTRY_DSN')
 STATSD_HOST = os.environ.get('STATSD_HOST')
 
+# Only do structural checks of submitted data in the web tier and
+# leave its full validation to the async workers, which keep at most
+# the given number of reports per request.
+SUBMIT_DEFERRED_VALIDATION = os.environ.get(
+    'SUBMIT_DEFERRED_VALIDATION', 'false').lower() in ('1', 'true')
+SUBMIT_DEFERRED_MAX_ITEMS = int(
+    os.environ.get('SUBMIT_DEFERRED_MAX_ITEMS', '10000'))
+
+# Parse and validate submitted data incrementally in chunks.
+SUBMIT_STREAMING = os.environ.get(
+    'SUBMIT_STREAMING', 'false').lower() in ('1', 'true')
+
+# Limit the (decompressed) size of deferred and streamed request
+# bodies to the given bytes.
+SUBMIT_MAX_BODY_SIZE = int(
+    os.environ.get('SUBMIT_MAX_BODY_SIZE', str(20 * 1024 * 1024)))
+
+# Queue observations for the station updates as compact binary records
+# instead of JSON.
+DATA_QUEUE_BINARY = os.environ.get(
+    'DATA_QUEUE_BINARY', 'false').lower() in ('1', 'true')
+
+# Combine the binary observations of each station and source in a
+# batch into one partial aggregate record.
+DATA_QUEUE_AGGREGATE = os.environ.get(
+    'DATA_QUEUE_AGGREGATE', 'false').lower() in ('1', 'true')
+
+# Store batches of incoming reports in compressed frames, using one of
+# the `zlib` or `report` frame codecs.
+DATA_QUEUE_FRAMES = os.environ.get('DATA_QUEUE_FRAMES') or None
+
+# Keep batches of observations for the station updates in Redis until
+# they are committed to the database.
+DATA_QUEUE_RELIABLE = os.environ.get(
+    'DATA_QUEUE_RELIABLE', 'false').lower() in ('1', 'true')
+
+# Queue backend for the station and datamap updates, either `list` or
+# `stream`. The stream backend requires Redis 5.0 or later and splits
+# each queue into the given number of partitions.
+DATA_QUEUE_BACKEND = os.environ.get('DATA_QUEUE_BACKEND', 'list')
+DATA_QUEUE_PARTITIONS = int(os.environ.get('DATA_QUEUE_PARTITIONS', '4'))
+
+# Schedule the processing tasks when data is queued, with the periodic
+# tasks only running as a fallback.
+DATA_QUEUE_TRIGGER = os.environ.get(
+    'DATA_QUEUE_TRIGGER', 'false').lower() in ('1', 'true')
+
+# Adapt the batch size of the async worker queues to their backlog and
+# processing time, between the configured batch size divided and
+# multiplied by the given factor.
+DATA_QUEUE_ADAPTIVE = os.environ.get(
+    'DATA_QUEUE_ADAPTIVE', 'false').lower() in ('1', 'true')
+DATA_QUEUE_ADAPTIVE_FACTOR = int(
+    os.environ.get('DATA_QUEUE_ADAPTIVE_FACTOR', '5'))
+
+# Store each report for all exports once in a shared Redis stream,
+# instead of copying it into a queue per export. Requires Redis 6.2.
+DATA_QUEUE_EXPORT_LOG = os.environ.get(
+    'DATA_QUEUE_EXPORT_LOG', 'false').lower() in ('1', 'true')
+
+# Number of batches a single export task uploads in parallel.
+EXPORT_CONCURRENCY = int(os.environ.get('EXPORT_CONCURRENCY', '1'))
+
 if os.path.isfile(VERSION_FILE):
     with open(VERSION_FILE, 'r') as fd:
         data = simplejson.load(fd)
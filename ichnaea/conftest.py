@@ -15,6 +15,7 @@ from sqlalchemy import (
 import webtest
 
 from ichnaea.api.key import API_CACHE
+from ichnaea.data.export import EXPORT_CONFIGS
 from ichnaea.api.locate.searcher import (
     configure_position_searcher,
     configure_region_searcher,
@@ -40,7 +41,10 @@ from ichnaea.log import (
     configure_stats,
 )
 from ichnaea.models import _Model
-from ichnaea.queue import DataQueue
+from ichnaea.queue import (
+    BufferedDataQueue,
+    DataQueue,
+)
 from ichnaea.webapp.config import (
     main,
     shutdown_worker as shutdown_app,
@@ -223,6 +227,7 @@ def session(db):
             db.session_factory.configure(bind=db.engine)
 
     API_CACHE.clear()
+    EXPORT_CONFIGS.clear()
 
 
 @pytest.fixture(scope='function')
@@ -242,6 +247,7 @@ def sync_session(sync_db):
             sync_db.session_factory.configure(bind=sync_db.engine)
 
     API_CACHE.clear()
+    EXPORT_CONFIGS.clear()
 
 
 @pytest.fixture(scope='function')
@@ -285,6 +291,9 @@ def data_queues(redis_client):
         'update_incoming': DataQueue('update_incoming', redis_client,
                                      batch=100, compress=True),
     }
+    # Flush every item right away, so tests can check the queue.
+    data_queues['update_incoming_buffered'] = BufferedDataQueue(
+        data_queues['update_incoming'], batch=1)
     yield data_queues
 
 
@@ -328,6 +337,12 @@ def redis_client():
     redis_client.close()
 
 
+@pytest.fixture(scope='session')
+def redis_version(redis_client):
+    version = redis_client.info()['redis_version']
+    return tuple(int(part) for part in version.split('.')[:2])
+
+
 @pytest.fixture(scope='function')
 def redis(redis_client):
     yield redis_client
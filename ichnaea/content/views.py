@@ -16,8 +16,8 @@ from pyramid.renderers import get_renderer
 from pyramid.response import FileResponse
 from pyramid.response import Response
 from pyramid.view import view_config
-import simplejson
 
+from ichnaea import codec
 from ichnaea.config import (
     ASSET_BUCKET,
     ASSET_URL,
@@ -167,12 +167,12 @@ class ContentViews(object):
         cache_key = self.redis_client.cache_keys[cache_key]
         cached = self.redis_client.get(cache_key)
         if cached:
-            return simplejson.loads(cached)
+            return codec.loads(cached)
         return None
 
     def _set_cache(self, cache_key, data, ex=3600):
         cache_key = self.redis_client.cache_keys[cache_key]
-        self.redis_client.set(cache_key, simplejson.dumps(data), ex=ex)
+        self.redis_client.set(cache_key, codec.dumps(data), ex=ex)
 
     @view_config(renderer='templates/homepage.pt', http_cache=3600)
     def homepage_view(self):
@@ -1,8 +1,10 @@
 from collections import defaultdict
+import time
 
 import numpy
 from sqlalchemy import delete, select
 
+from ichnaea.db import bulk_upsert
 from ichnaea.geocalc import (
     circle_radius,
 )
@@ -27,11 +29,14 @@ class CellAreaUpdater(object):
         self.utcnow = util.utcnow()
 
     def __call__(self):
+        start = time.time()
         areaids = self.queue.dequeue()
 
         with self.task.db_session() as session:
-            for areaid in set(areaids):
-                self.update_area(session, areaid)
+            self.update_areas(session, set(areaids))
+
+        self.queue.adapt(time.time() - start,
+                         stats_client=self.task.stats_client)
 
         if self.queue.ready():  # pragma: no cover
             self.task.apply_countdown()
@@ -63,7 +68,33 @@ class CellAreaUpdater(object):
 
         return region
 
+    def update_areas(self, session, areaids):
+        # Combine the writes for all areas into a few statements.
+        deleted = []
+        values = []
+        for areaid in sorted(areaids):
+            area = self.update_area(session, areaid)
+            if area is None:
+                deleted.append(areaid)
+            else:
+                values.append(area)
+
+        if deleted:
+            session.execute(
+                delete(self.area_table)
+                .where(self.area_table.c.areaid.in_(deleted))
+            )
+
+        if values:
+            bulk_upsert(session, self.area_table, values, update=(
+                'modified', 'lat', 'lon', 'radius', 'region',
+                'avg_cell_radius', 'num_cells', 'last_seen'))
+
     def update_area(self, session, areaid):
+        """
+        Return the new values of the area based on all its cells, or
+        None if the area no longer has any cells.
+        """
         # Select all cells in this area and derive a bounding box for them
         radio, mcc, mnc, lac = decode_cellarea(areaid)
         load_fields = ('cellid', 'lat', 'lon', 'radius', 'region', 'last_seen',
@@ -84,27 +115,9 @@ class CellAreaUpdater(object):
 
         if len(cells) == 0:
             # If there are no more underlying cells, delete the area entry
-            session.execute(
-                delete(self.area_table)
-                .where(self.area_table.c.areaid == areaid)
-            )
-            return
+            return None
 
         # Otherwise update the area entry based on all the cells
-        area = session.execute(
-            select([self.area_table.c.areaid,
-                    self.area_table.c.modified,
-                    self.area_table.c.lat,
-                    self.area_table.c.lon,
-                    self.area_table.c.radius,
-                    self.area_table.c.region,
-                    self.area_table.c.avg_cell_radius,
-                    self.area_table.c.num_cells,
-                    self.area_table.c.last_seen,
-                    ])
-            .where(self.area_table.c.areaid == areaid)
-        ).fetchone()
-
         cell_extremes = numpy.array([
             (numpy.nan if cell.max_lat is None else cell.max_lat,
              numpy.nan if cell.max_lon is None else cell.max_lon)
@@ -140,39 +153,19 @@ class CellAreaUpdater(object):
         if cell_last_seen:
             last_seen = max(cell_last_seen)
 
-        if area is None:
-            session.execute(
-                self.area_table.insert(
-                    mysql_on_duplicate='num_cells = num_cells'  # no-op
-                ).values(
-                    areaid=areaid,
-                    radio=radio,
-                    mcc=mcc,
-                    mnc=mnc,
-                    lac=lac,
-                    created=self.utcnow,
-                    modified=self.utcnow,
-                    lat=ctr_lat,
-                    lon=ctr_lon,
-                    radius=radius,
-                    region=region,
-                    avg_cell_radius=avg_cell_radius,
-                    num_cells=num_cells,
-                    last_seen=last_seen,
-                )
-            )
-        else:
-            session.execute(
-                self.area_table.update()
-                .where(self.area_table.c.areaid == areaid)
-                .values(
-                    modified=self.utcnow,
-                    lat=ctr_lat,
-                    lon=ctr_lon,
-                    radius=radius,
-                    region=region,
-                    avg_cell_radius=avg_cell_radius,
-                    num_cells=num_cells,
-                    last_seen=last_seen,
-                )
-            )
+        return {
+            'areaid': areaid,
+            'radio': radio,
+            'mcc': mcc,
+            'mnc': mnc,
+            'lac': lac,
+            'created': self.utcnow,
+            'modified': self.utcnow,
+            'lat': ctr_lat,
+            'lon': ctr_lon,
+            'radius': radius,
+            'region': region,
+            'avg_cell_radius': avg_cell_radius,
+            'num_cells': num_cells,
+            'last_seen': last_seen,
+        }
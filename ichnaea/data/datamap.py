@@ -1,7 +1,9 @@
 from datetime import timedelta
+import time
 
 from sqlalchemy import delete, select
 
+from ichnaea.db import bulk_upsert
 from ichnaea.models.content import (
     DataMap,
     encode_datamap_grid,
@@ -50,47 +52,38 @@ class DataMapUpdater(object):
             .where(self.shard_table.c.grid.in_(grids))
         ).fetchall()
 
-        outdated = set()
         skip = set()
         for row in rows:
-            grid = encode_datamap_grid(*row.grid)
             if row.modified == today:
-                skip.add(grid)
-            else:
-                outdated.add(grid)
+                skip.add(encode_datamap_grid(*row.grid))
 
-        new_values = []
-        update_values = []
+        values = []
         for grid in grids:
             if grid in skip:
                 continue
-            elif grid in outdated:
-                update_values.append(
-                    {'grid': grid, 'modified': today})
-            else:
-                new_values.append(
-                    {'grid': grid, 'created': today, 'modified': today})
-
-        if new_values:
-            # do a batch insert of new grids
-            stmt = self.shard.__table__.insert(
-                mysql_on_duplicate='modified = modified'  # no-op
-            )
-            session.execute(stmt.values(new_values))
-
-        if update_values:
-            # do a batch update of grids
-            session.bulk_update_mappings(self.shard, update_values)
+            values.append({'grid': grid, 'created': today, 'modified': today})
+
+        if values:
+            # insert new grids and update the modified date of outdated
+            # grids, keeping their created date
+            bulk_upsert(session, self.shard_table, values,
+                        update=('modified', ))
 
     def __call__(self):
+        start = time.time()
         queue = self.task.app.data_queues['update_datamap_' + self.shard_id]
-        grids = queue.dequeue()
-        grids = list(set(grids))
+        batch = queue.reserve(stats_client=self.task.stats_client)
+        grids = list(set(batch.items))
         if not grids or not self.shard:
+            queue.ack(batch.token)
+            queue.adapt(time.time() - start,
+                        stats_client=self.task.stats_client)
             return 0
 
         with self.task.db_session() as session:
             self._update_shards(session, grids)
+        queue.ack(batch.token)
+        queue.adapt(time.time() - start, stats_client=self.task.stats_client)
 
         if queue.ready():  # pragma: no cover
             self.task.apply_countdown(kwargs={'shard_id': self.shard_id})
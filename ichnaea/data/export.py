@@ -1,4 +1,6 @@
 from collections import defaultdict
+import gzip
+from io import BytesIO
 import re
 import time
 from urllib.parse import urlparse
@@ -10,10 +12,15 @@ import botocore.exceptions
 import redis.exceptions
 import requests
 import requests.exceptions
-import simplejson
 from sqlalchemy import select
 import sqlalchemy.exc
 
+from ichnaea import codec
+from ichnaea.config import (
+    DATA_QUEUE_AGGREGATE,
+    DATA_QUEUE_EXPORT_LOG,
+    EXPORT_CONCURRENCY,
+)
 from ichnaea.data import _web_content_enabled
 from ichnaea.models import (
     ApiKey,
@@ -30,11 +37,84 @@ from ichnaea.models import (
     WifiReport,
     WifiShard,
 )
+from ichnaea.models.config import (
+    EXPORT_LOG_KEY,
+    export_log,
+)
 from ichnaea.models.content import encode_datamap_grid
+from ichnaea.queue import ready_queues
+from ichnaea.submit import expand_deferred
 from ichnaea import util
 
 WHITESPACE = re.compile('\s', flags=re.UNICODE)
 
+# Reload the export configs from the database every minute.
+EXPORT_CONFIG_TIMEOUT = 60
+
+
+def gzip_reports(reports, compresslevel=6):
+    """
+    Return a file object holding the gzipped JSON upload body for the
+    reports. The reports are encoded and compressed one at a time, so
+    the uncompressed body is never held in memory.
+    """
+    out = BytesIO()
+    with gzip.GzipFile(None, 'wb',
+                       compresslevel=compresslevel, fileobj=out) as gzip_file:
+        gzip_file.write(b'{"items": [')
+        for i, report in enumerate(reports):
+            if i:
+                gzip_file.write(b', ')
+            gzip_file.write(codec.dumps(report).encode('utf-8'))
+        gzip_file.write(b']}')
+    out.seek(0)
+    return out
+
+
+class ExportConfigCache(object):
+    """
+    A per-process cache of all
+    :class:`~ichnaea.models.config.ExportConfig` rows.
+
+    The configs are reloaded after `timeout` seconds.
+
+    The first time an s3 export is loaded, the partitions it might have
+    from before the partition set was maintained are added to the set,
+    see :meth:`~ichnaea.models.config.ExportConfig.index_partitions`.
+    """
+
+    def __init__(self, timeout=EXPORT_CONFIG_TIMEOUT):
+        self.timeout = timeout
+        self.clear()
+
+    def clear(self):
+        self._configs = None
+        self._expires = 0.0
+        self._indexed = set()
+
+    def all(self, session, redis_client):
+        """Return a list of all export configs."""
+        now = time.time()
+        if self._configs is None or now >= self._expires:
+            configs = ExportConfig.all(session)
+            for config in configs:
+                if config.name not in self._indexed:
+                    config.index_partitions(redis_client)
+                    self._indexed.add(config.name)
+            self._configs = configs
+            self._expires = now + self.timeout
+        return self._configs
+
+    def get(self, session, redis_client, name):
+        """Return the export config with the given name or None."""
+        for config in self.all(session, redis_client):
+            if config.name == name:
+                return config
+        return None
+
+
+EXPORT_CONFIGS = ExportConfigCache()
+
 
 class IncomingQueue(object):
     """
@@ -45,15 +125,28 @@ class IncomingQueue(object):
     It distributes the data into the configured export queues,
     checks those queues and if they contain enough or old enough data
     schedules an async export task to process the data in each queue.
+
+    If `shared` is set, the data is stored once in a single queue read
+    by all exports, instead of a copy per export queue.
     """
 
+    shared = DATA_QUEUE_EXPORT_LOG
+
     def __init__(self, task):
         self.task = task
 
     def __call__(self, export_task):
+        start = time.time()
         redis_client = self.task.redis_client
         data_queue = self.task.app.data_queues['update_incoming']
-        data = data_queue.dequeue()
+        data = []
+        for item in data_queue.dequeue():
+            if 'deferred' in item:
+                # Submissions queued without validation in the web tier.
+                data.extend(expand_deferred(
+                    item, stats_client=self.task.stats_client))
+            else:
+                data.append(item)
 
         grouped = defaultdict(list)
         for item in data:
@@ -63,24 +156,46 @@ class IncomingQueue(object):
             })
 
         with self.task.db_session(commit=False) as session:
-            export_configs = ExportConfig.all(session)
+            export_configs = EXPORT_CONFIGS.all(session, redis_client)
 
         with self.task.redis_pipeline() as pipe:
             for (api_key, source), items in grouped.items():
-                for config in export_configs:
-                    if config.allowed(api_key, source):
-                        queue_key = config.queue_key(api_key, source)
-                        queue = config.queue(queue_key, redis_client)
-                        queue.enqueue(items, pipe=pipe)
+                configs = [config for config in export_configs
+                           if config.allowed(api_key, source)]
+                if self.shared:
+                    if configs:
+                        for item in items:
+                            item['source'] = source
+                        export_log(redis_client).enqueue(items, pipe=pipe)
+                    continue
 
-        for config in export_configs:
-            # Check all queues if they now contain enough data or
-            # old enough data to be ready for processing.
-            for queue_key in config.partitions(redis_client):
-                queue = config.queue(queue_key, redis_client)
-                if queue.ready():
-                    export_task.delay(config.name, queue_key)
+                for config in configs:
+                    queue_key = config.queue_key(api_key, source)
+                    queue = config.queue(queue_key, redis_client)
+                    queue.enqueue(items, pipe=pipe)
+                    config.add_partition(pipe, queue_key)
 
+        if self.shared:
+            export_log(redis_client).trim(
+                [config.name for config in export_configs])
+
+        # Check all queues if they now contain enough data or
+        # old enough data to be ready for processing.
+        partitions = []
+        queues = []
+        for config in export_configs:
+            for queue_key in config.partitions(redis_client,
+                                               shared=self.shared):
+                partitions.append((config.name, queue_key))
+                queues.append(config.queue(queue_key, redis_client))
+
+        ready = ready_queues(redis_client, queues)
+        for (name, queue_key), queue_ready in zip(partitions, ready):
+            if queue_ready:
+                export_task.delay(name, queue_key)
+
+        data_queue.adapt(time.time() - start,
+                         stats_client=self.task.stats_client)
         if data_queue.ready():  # pragma: no cover
             self.task.apply_countdown()
 
@@ -91,6 +206,8 @@ class ReportExporter(object):
     _retries = 3
     _retry_wait = 1.0
 
+    concurrency = EXPORT_CONCURRENCY  # Number of batches sent in parallel.
+
     def __init__(self, task, config, queue_key):
         self.task = task
         self.config = config
@@ -101,7 +218,7 @@ class ReportExporter(object):
     @staticmethod
     def export(task, name, queue_key):
         with task.db_session(commit=False) as session:
-            config = ExportConfig.get(session, name)
+            config = EXPORT_CONFIGS.get(session, task.redis_client, name)
 
         exporter_types = {
             'dummy': DummyExporter,
@@ -114,30 +231,61 @@ class ReportExporter(object):
             exporter_type(task, config, queue_key)()
 
     def __call__(self):
-        queue_items = self.queue.dequeue()
-        if not queue_items:  # pragma: no cover
-            return
+        batches = []
+        for i in range(max(self.concurrency, 1)):
+            if i and not self.queue.ready():
+                break
+            batch = self.queue.reserve(stats_client=self.task.stats_client)
+            if not batch.items:
+                break
+            batches.append(batch)
 
-        success = False
+        if not batches:  # pragma: no cover
+            return
+        elif len(batches) == 1:
+            success = self._process(batches[0])
+        else:
+            # Upload the batches in parallel threads.
+            success = all(list(
+                self.task.export_pool.map(self._process, batches)))
+
+        if success:
+            if self.queue.ready():
+                self.task.apply_countdown(
+                    args=[self.config.name, self.queue_key])
+            else:
+                self.config.prune_partition(
+                    self.task.redis_client, self.queue_key)
+
+    def _process(self, batch):
+        queue_items = batch.items
+        if self.queue_key == EXPORT_LOG_KEY:
+            # The shared queue contains the data for all exports.
+            queue_items = [item for item in queue_items
+                           if self.config.allowed(item['api_key'],
+                                                  item['source'])]
+
+        if not queue_items:
+            # Nothing in this part of the shared queue is for us.
+            self.queue.ack(batch.token)
+            return True
+        return self._export(batch, queue_items)
+
+    def _export(self, batch, queue_items):
         for i in range(self._retries):
             try:
                 with self.task.stats_client.timed('data.export.upload',
                                                   tags=self.stats_tags):
                     self.send(queue_items)
-
-                success = True
             except self._retriable:
-                success = False
                 time.sleep(self._retry_wait * (i ** 2 + 1))
+                continue
 
-            if success:
-                self.task.stats_client.incr(
-                    'data.export.batch', tags=self.stats_tags)
-                break
-
-        if success and self.queue.ready():
-            self.task.apply_countdown(
-                args=[self.config.name, self.queue_key])
+            self.task.stats_client.incr(
+                'data.export.batch', tags=self.stats_tags)
+            self.queue.ack(batch.token)
+            return True
+        return False
 
     def send(self, queue_items):
         raise NotImplementedError()
@@ -166,10 +314,9 @@ class GeosubmitExporter(ReportExporter):
             'User-Agent': 'ichnaea',
         }
 
-        response = requests.post(
+        response = self.task.http_session.post(
             self.config.url,
-            data=util.encode_gzip(simplejson.dumps({'items': reports}),
-                                  compresslevel=5),
+            data=gzip_reports(reports, compresslevel=5),
             headers=headers,
             timeout=60.0,
         )
@@ -191,9 +338,21 @@ class S3Exporter(ReportExporter):
     )
 
     def send(self, queue_items):
-        # ignore metadata
-        reports = [item['report'] for item in queue_items]
-
+        if self.queue_key == EXPORT_LOG_KEY:
+            grouped = defaultdict(list)
+            for item in queue_items:
+                grouped[(item['source'], item['api_key'] or 'no_key')].append(
+                    item['report'])
+        else:
+            # strip away queue prefix again
+            parts = self.queue_key.split(':')
+            grouped = {(parts[1], parts[2]): [
+                item['report'] for item in queue_items]}
+
+        for (source, api_key), reports in sorted(grouped.items()):
+            self.upload(source, api_key, reports)
+
+    def upload(self, source, api_key, reports):
         _, bucketname, path = urlparse(self.config.url)[:3]
         # s3 key names start without a leading slash
         path = path.lstrip('/')
@@ -202,25 +361,15 @@ class S3Exporter(ReportExporter):
 
         year, month, day = util.utcnow().timetuple()[:3]
 
-        # strip away queue prefix again
-        parts = self.queue_key.split(':')
-        source = parts[1]
-        api_key = parts[2]
-
         obj_name = path.format(
             source=source, api_key=api_key, year=year, month=month, day=day)
         obj_name += uuid.uuid1().hex + '.json.gz'
 
         try:
-            data = util.encode_gzip(simplejson.dumps({'items': reports}),
-                                    compresslevel=7)
-
-            s3 = boto3.resource('s3')
-            bucket = s3.Bucket(bucketname)
-
-            obj = bucket.Object(obj_name)
-            obj.put(
-                Body=data,
+            self.task.s3_client.put_object(
+                Bucket=bucketname,
+                Key=obj_name,
+                Body=gzip_reports(reports, compresslevel=7),
                 ContentEncoding='gzip',
                 ContentType='application/json',
             )
@@ -362,6 +511,11 @@ class InternalExporter(ReportExporter):
     )
     transform = InternalTransform()
 
+    # The database updates aren't safe to run in parallel.
+    concurrency = 1
+    # Queue partial aggregates instead of single binary observations.
+    aggregate = DATA_QUEUE_AGGREGATE
+
     def send(self, queue_items):
         api_keys = set()
         api_keys_known = set()
@@ -418,29 +572,56 @@ class InternalExporter(ReportExporter):
                 metrics[api_key]['report_drop'] += 1
 
         with self.task.redis_pipeline() as pipe:
-            self.queue_observations(pipe, observations)
+            queues = self.queue_observations(pipe, observations)
             if _web_content_enabled and positions:
-                self.process_datamap(pipe, positions)
+                queues.extend(self.process_datamap(pipe, positions))
+
+        for queue in queues:
+            queue.notify()
 
         self.emit_metrics(api_keys_known, metrics)
 
     def queue_observations(self, pipe, observations):
-        for datatype, shard_model, shard_key, queue_prefix in (
-                ('blue', BlueShard, 'mac', 'update_blue_'),
-                ('cell', CellShard, 'cellid', 'update_cell_'),
-                ('wifi', WifiShard, 'mac', 'update_wifi_')):
+        queues = []
+        for datatype, obs_model, shard_model, shard_key, queue_prefix in (
+                ('blue', BlueObservation, BlueShard, 'mac', 'update_blue_'),
+                ('cell', CellObservation, CellShard, 'cellid',
+                 'update_cell_'),
+                ('wifi', WifiObservation, WifiShard, 'mac', 'update_wifi_')):
 
             queued_obs = defaultdict(list)
             for obs in observations[datatype]:
                 # group by sharded queue
                 shard_id = shard_model.shard_id(getattr(obs, shard_key))
                 queue_id = queue_prefix + shard_id
-                queued_obs[queue_id].append(obs.to_json())
+                queued_obs[queue_id].append(obs)
 
             for queue_id, values in queued_obs.items():
-                # enqueue values for each queue
+                # enqueue values for each queue, as JSON or binary records,
+                # keyed by station to keep their order in partitioned queues
                 queue = self.task.app.data_queues[queue_id]
-                queue.enqueue(values, pipe=pipe)
+                keys = [getattr(obs, shard_key) for obs in values]
+                if queue.json:
+                    values = [obs.to_json() for obs in values]
+                elif self.aggregate:
+                    values, keys = self.aggregate_observations(
+                        obs_model, values)
+                else:
+                    values = [obs.to_binary() for obs in values]
+                queue.enqueue(values, pipe=pipe, keys=keys)
+                queues.append(queue)
+        return queues
+
+    def aggregate_observations(self, obs_model, observations):
+        """
+        Combine the observations into one partial aggregate per station
+        and source. Returns the binary partial records and their keys.
+        """
+        partials = obs_model.merge_partials(obs_model.to_partials(
+            obs_model.decode_binary(
+                [obs.to_binary() for obs in observations])))
+        return (obs_model.encode_partials(partials),
+                obs_model.binary_keys(partials))
 
     def emit_metrics(self, api_keys_known, metrics):
         for api_key, key_metrics in metrics.items():
@@ -515,6 +696,9 @@ class InternalExporter(ReportExporter):
             shards[DataMap.shard_id(lat, lon)].add(
                 encode_datamap_grid(lat, lon))
 
+        queues = []
         for shard_id, values in shards.items():
             queue = self.task.app.data_queues['update_datamap_' + shard_id]
             queue.enqueue(list(values), pipe=pipe)
+            queues.append(queue)
+        return queues
@@ -1,8 +1,42 @@
 from collections import defaultdict
 from datetime import timedelta
+import time
 
+from ichnaea.async.config import TASK_QUEUES
+from ichnaea import codec
+from ichnaea.config import DATA_QUEUE_EXPORT_LOG
+from ichnaea.data.export import EXPORT_CONFIGS
+from ichnaea.models.config import export_log
+from ichnaea.queue import (
+    DataQueue,
+    QueueSample,
+    sample_queues,
+)
 from ichnaea import util
 
+QUEUE_SAMPLES_KEY = 'monitor:queue_samples'
+
+
+def monitored_queues(redis_client, data_queues, export_configs=(),
+                     shared=DATA_QUEUE_EXPORT_LOG):
+    """
+    Return all Redis queues: the Celery task queues, the given data
+    queues and the queues of the given export configs.
+
+    :param shared: Also return the stream shared by all exports?
+    """
+    queues = [DataQueue(queue.name, redis_client) for queue in TASK_QUEUES]
+    queues.extend(queue for queue in data_queues.values()
+                  if isinstance(queue, DataQueue))
+    export_keys = set()
+    for config in export_configs:
+        export_keys.update(config.partitions(redis_client, shared=False))
+    for key in sorted(export_keys):
+        queues.append(DataQueue(key, redis_client))
+    if shared:
+        queues.append(export_log(redis_client))
+    return queues
+
 
 class ApiKeyLimits(object):
 
@@ -56,3 +90,55 @@ class ApiUsers(object):
             self.task.stats_client.gauge(
                 '%s.user' % api_type, value,
                 tags=['key:%s' % api_name, 'interval:%s' % interval])
+
+
+class QueueSize(object):
+    """
+    Emit the size, data age and enqueue and dequeue rates of all
+    Redis queues as gauges.
+
+    The rates are calculated against the samples taken by the previous
+    run, which are kept in Redis.
+    """
+
+    def __init__(self, task):
+        self.task = task
+
+    def _previous(self, redis_client):
+        data = redis_client.get(QUEUE_SAMPLES_KEY)
+        if not data:
+            return (None, {})
+        data = codec.loads(data)
+        samples = [QueueSample(*value) for value in data['samples']]
+        return (data['time'], dict((sample.key, sample)
+                                   for sample in samples))
+
+    def __call__(self):
+        redis_client = self.task.redis_client
+        with self.task.db_session(commit=False) as session:
+            export_configs = EXPORT_CONFIGS.all(session, redis_client)
+        queues = monitored_queues(
+            redis_client, self.task.app.data_queues, export_configs)
+        now = time.time()
+        samples = sample_queues(redis_client, queues)
+
+        previous_time, previous = self._previous(redis_client)
+        duration = now - previous_time if previous_time else 0
+
+        stats_client = self.task.stats_client
+        for sample in samples:
+            tags = ['queue:' + sample.key]
+            enqueue, dequeue = sample.rates(
+                previous.get(sample.key), duration)
+            stats_client.gauge('queue', sample.size, tags=tags)
+            stats_client.gauge('queue.age', sample.age, tags=tags)
+            stats_client.gauge('queue.enqueue', int(round(enqueue)),
+                               tags=tags)
+            stats_client.gauge('queue.dequeue', int(round(dequeue)),
+                               tags=tags)
+
+        redis_client.set(QUEUE_SAMPLES_KEY, codec.dumps({
+            'time': now,
+            'samples': [list(sample) for sample in samples],
+        }), ex=86400)
+        return samples
@@ -10,17 +10,22 @@ from pymysql.constants.ER import (
 )
 from sqlalchemy.exc import InternalError as SQLInternalError
 
+from ichnaea.db import bulk_update
 from ichnaea.geocalc import (
     circle_radius,
     distance,
 )
 from ichnaea.geocode import GEOCODER
+from ichnaea import codec
 from ichnaea.models import (
     decode_cellid,
     encode_cellarea,
     BlueObservation,
+    BlueShard,
     CellObservation,
+    CellShard,
     WifiObservation,
+    WifiShard,
     ReportSource,
     station_blocked,
     StatCounter,
@@ -31,15 +36,78 @@ from ichnaea.models.constants import (
     CELL_MAX_RADIUS,
     WIFI_MAX_RADIUS,
 )
+from ichnaea.models.observation import haversine
 from ichnaea import util
 
+# The haversine distance differs by less than 0.6% from the exact
+# ellipsoid distance, only check distances close to a limit exactly.
+HAVERSINE_MARGIN = 0.01
+
+# Fields added to the partial aggregates of the combined observations
+# of each station.
+ROW_FIELDS = [
+    ('total', '<u8'),
+    ('first', '<i8'),
+    ('last', '<i8'),
+    ('consistent', '?'),
+    ('confirm', '?'),
+    ('reject', '?'),
+]
+
+
+def within_distance(approx, max_dist, exact):
+    """
+    Return a boolean array, which is True for all approximate
+    distances not larger than the maximum distance. Distances close
+    to the limit are checked by calling `exact` with their index.
+    """
+    result = approx <= max_dist
+    close = numpy.flatnonzero(
+        numpy.abs(approx - max_dist) <= max_dist * HAVERSINE_MARGIN)
+    for i in close:
+        result[i] = exact(i) <= max_dist
+    return result
+
 
 class StationState(object):
+    """
+    The state of a single station and its new observations, given as
+    a dictionary of one row of combined observations, see
+    :meth:`StationUpdater.aggregate_observations`.
+    """
 
     MAX_DIST_METERS = None
     MAX_OLD_WEIGHT = 10000.0
     MAX_OLD_DAYS = 365
 
+    TRANSITIONS = {
+        # (station_state, obs_state)
+        ('none', 'gnss_consistent'): 'new',
+        ('none', 'query_consistent'): 'new',
+        ('none', 'gnss_inconsistent'): 'new_block',
+        ('none', 'query_inconsistent'): 'new_block',
+        ('no_position', 'gnss_consistent'): 'change',
+        ('no_position', 'query_consistent'): 'change',
+        ('no_position', 'gnss_inconsistent'): None,
+        ('no_position', 'query_inconsistent'): None,
+        ('agree_gnss_position', 'gnss_consistent'): 'change',
+        ('agree_gnss_position', 'query_consistent'): 'confirm',
+        ('agree_gnss_position', 'gnss_inconsistent'): 'block',
+        ('agree_gnss_position', 'query_inconsistent'): 'block',
+        ('agree_query_position', 'gnss_consistent'): 'replace',
+        ('agree_query_position', 'query_consistent'): 'change',
+        ('agree_query_position', 'gnss_inconsistent'): 'block',
+        ('agree_query_position', 'query_inconsistent'): 'block',
+        ('disagree_position', 'gnss_consistent'): 'block',
+        ('disagree_position', 'query_consistent'): 'block',
+        ('disagree_position', 'gnss_inconsistent'): 'block',
+        ('disagree_position', 'query_inconsistent'): 'block',
+        ('disagree_old_position', 'gnss_consistent'): 'replace',
+        ('disagree_old_position', 'query_consistent'): 'replace',
+        ('disagree_old_position', 'gnss_inconsistent'): 'block',
+        ('disagree_old_position', 'query_inconsistent'): 'block',
+    }
+
     def __init__(self, station_key, station,
                  source, observations, now, today):
         self.station_key = station_key
@@ -71,6 +139,11 @@ class StationState(object):
         station_state = 'none'
         if self.station:
             if self.has_position():
+                if (not self.confirm_station_obs() and
+                        not self.observations['reject']):
+                    # Combined observations might all be close to the
+                    # station or not, leave the station unchanged.
+                    return None
                 if self.confirm_station_obs():
                     if (self.station.source is ReportSource.query):
                         station_source = 'query'
@@ -98,48 +171,13 @@ class StationState(object):
             else:
                 obs_state = 'query_inconsistent'
 
-        transitions = {
-            # (station_state, obs_state)
-            ('none', 'gnss_consistent'): self.new,
-            ('none', 'query_consistent'): self.new,
-            ('none', 'gnss_inconsistent'): self.new_block,
-            ('none', 'query_inconsistent'): self.new_block,
-            ('no_position', 'gnss_consistent'): self.change,
-            ('no_position', 'query_consistent'): self.change,
-            ('no_position', 'gnss_inconsistent'): None,
-            ('no_position', 'query_inconsistent'): None,
-            ('agree_gnss_position', 'gnss_consistent'): self.change,
-            ('agree_gnss_position', 'query_consistent'): self.confirm,
-            ('agree_gnss_position', 'gnss_inconsistent'): self.block,
-            ('agree_gnss_position', 'query_inconsistent'): self.block,
-            ('agree_query_position', 'gnss_consistent'): self.replace,
-            ('agree_query_position', 'query_consistent'): self.change,
-            ('agree_query_position', 'gnss_inconsistent'): self.block,
-            ('agree_query_position', 'query_inconsistent'): self.block,
-            ('disagree_position', 'gnss_consistent'): self.block,
-            ('disagree_position', 'query_consistent'): self.block,
-            ('disagree_position', 'gnss_inconsistent'): self.block,
-            ('disagree_position', 'query_inconsistent'): self.block,
-            ('disagree_old_position', 'gnss_consistent'): self.replace,
-            ('disagree_old_position', 'query_consistent'): self.replace,
-            ('disagree_old_position', 'gnss_inconsistent'): self.block,
-            ('disagree_old_position', 'query_inconsistent'): self.block,
-        }
-        return transitions.get((station_state, obs_state))
+        transition = self.TRANSITIONS.get((station_state, obs_state))
+        if transition is None:
+            return None
+        return getattr(self, transition)
 
     def confirm_station_obs(self):
-        confirm = False
-        if self.has_position():
-            # station with position
-            confirm = True
-            for obs in self.observations:
-                obs_distance = distance(obs.lat, obs.lon,
-                                        self.station.lat, self.station.lon)
-                if obs_distance > self.MAX_DIST_METERS:
-                    confirm = False
-                    break
-
-        return confirm
+        return bool(self.has_position() and self.observations['confirm'])
 
     def confirm(self):
         if self.station and self.station.last_seen == self.today:
@@ -152,7 +190,7 @@ class StationState(object):
 
     def block(self):
         # block and _change values need to have the exact same dict keys,
-        # as they get combined into one bulk_update_mappings calls.
+        # as they get combined into the same bulk upsert statements.
         values = self.submit_key()
         values.update({
             'last_seen': None, 'modified': self.now,
@@ -170,11 +208,11 @@ class StationState(object):
 
     def _change(self, update=True):
         # block and _change values need to have the exact same dict keys,
-        # as they get combined into one bulk_update_mappings calls.
+        # as they get combined into the same bulk upsert statements.
         if update:
             data = self.aggregate_station_obs()
         else:
-            data = self.obs_data
+            data = self.obs_position()
         values = self.submit_key()
         values.update({
             'last_seen': self.today, 'modified': self.now,
@@ -197,7 +235,7 @@ class StationState(object):
         return ('replace', self._change(update=False))
 
     def new(self):
-        data = self.obs_data
+        data = self.obs_position()
         values = self.submit_key()
         values.update({
             'created': self.now, 'last_seen': self.today,
@@ -227,55 +265,47 @@ class StationState(object):
         return (min(samples, 4294967295), min(weight, 1000000000.0))
 
     def aggregate_obs(self):
-        positions = numpy.array(
-            [(obs.lat, obs.lon) for obs in self.observations],
-            dtype=numpy.double)
-
-        max_lat, max_lon = positions.max(axis=0)
-        min_lat, min_lon = positions.min(axis=0)
-
-        box_distance = distance(min_lat, min_lon, max_lat, max_lon)
-        if box_distance > self.MAX_DIST_METERS:
+        obs = self.observations
+        if not obs['consistent']:
             return None
 
-        weights = numpy.array(
-            [obs.weight for obs in self.observations],
-            dtype=numpy.double)
-
-        lat, lon = numpy.average(positions, axis=0, weights=weights)
-        lat = float(lat)
-        lon = float(lon)
-        radius = circle_radius(lat, lon, max_lat, max_lon, min_lat, min_lon)
-        region = GEOCODER.region(lat, lon)
-
         samples, weight = self.bounded_samples_weight(
-            len(self.observations), float(weights.sum()))
+            obs['samples'], obs['weight'])
 
         return {
-            'positions': positions, 'weights': weights,
-            'lat': lat, 'lon': lon,
-            'max_lat': float(max_lat), 'min_lat': float(min_lat),
-            'max_lon': float(max_lon), 'min_lon': float(min_lon),
-            'radius': radius, 'region': region,
+            'lat': obs['lat'], 'lon': obs['lon'],
+            'max_lat': obs['max_lat'], 'min_lat': obs['min_lat'],
+            'max_lon': obs['max_lon'], 'min_lon': obs['min_lon'],
             'samples': samples, 'weight': weight,
         }
 
+    def obs_position(self):
+        """
+        Add the radius and region of the new observations, which are
+        only needed if they replace the station position.
+        """
+        data = self.obs_data
+        if 'region' not in data:
+            data['radius'] = circle_radius(
+                data['lat'], data['lon'], data['max_lat'], data['max_lon'],
+                data['min_lat'], data['min_lon'])
+            data['region'] = GEOCODER.region(data['lat'], data['lon'])
+        return data
+
     def aggregate_station_obs(self):
         station = self.station
         obs_data = self.obs_data
 
-        def get_nan(name):
-            value = getattr(station, name, None)
-            return numpy.nan if value is None else value
-
-        positions = numpy.append(obs_data['positions'], [
-            (get_nan('lat'), get_nan('lon')),
-            (get_nan('max_lat'), get_nan('max_lon')),
-            (get_nan('min_lat'), get_nan('min_lon')),
-        ], axis=0)
+        def bounds(names):
+            values = [obs_data['max_' + names[0]], obs_data['min_' + names[0]]]
+            for name in names:
+                value = getattr(station, name, None)
+                if value is not None:
+                    values.append(value)
+            return (max(values), min(values))
 
-        max_lat, max_lon = numpy.nanmax(positions, axis=0)
-        min_lat, min_lon = numpy.nanmin(positions, axis=0)
+        max_lat, min_lat = bounds(('lat', 'max_lat', 'min_lat'))
+        max_lon, min_lon = bounds(('lon', 'max_lon', 'min_lon'))
 
         if station.lat is None or station.lon is None:
             old_weight = 0.0
@@ -351,11 +381,9 @@ class CellState(StationState):
         if self.station:
             psc = self.station.psc
 
-        if self.observations:
-            pscs = [obs.psc for obs in self.observations
-                    if obs.psc is not None]
-            if pscs:
-                psc = pscs[-1]
+        obs_psc = self.observations['psc']
+        if obs_psc != numpy.iinfo(numpy.int16).min:
+            psc = obs_psc
         values['psc'] = psc
         return values
 
@@ -363,6 +391,7 @@ class CellState(StationState):
 class StationUpdater(object):
 
     obs_model = None
+    station_model = None
     station_state = None
     station_type = None
     stat_obs_key = None
@@ -386,7 +415,8 @@ class StationUpdater(object):
         pass
 
     def queue_area_updates(self, pipe, updated_areas):  # pragma: no cover
-        pass
+        """Queue the area updates and return the area queue."""
+        return None
 
     def stat_count(self, type_, action, count):
         if count > 0:
@@ -406,11 +436,10 @@ class StationUpdater(object):
         self.stat_count('station', 'confirm', stats_counter['confirm'])
         self.stat_count('station', 'new', stats_counter['new'])
 
-    def query_stations(self, session, shard, shard_values):
+    def query_stations(self, session, shard, keys):
         blocklist = {}
         stations = {}
 
-        keys = list(shard_values.keys())
         rows = self.query_shard(session, shard, keys)
         for row in rows:
             unique_key = row.unique_key
@@ -419,37 +448,27 @@ class StationUpdater(object):
 
         return (blocklist, stations)
 
-    def update_shard(self, session, shard, shard_values, stats_counter):
+    def update_shard(self, session, shard, rows, records, stats_counter):
         updated_areas = set()
         new_data = defaultdict(list)
-        blocklist, stations = self.query_stations(
-            session, shard, shard_values)
+        keys = self.obs_model.binary_keys(rows)
+        blocklist, stations = self.query_stations(session, shard, keys)
 
-        for station_key, observations in shard_values.items():
-            # Count all observations.
-            stats_counter['obs'] += len(observations)
+        # Count all observations.
+        stats_counter['obs'] += int(rows['total'].sum())
+        self.confirm_observations(
+            rows, records, [stations.get(key) for key in keys])
 
+        names = rows.dtype.names
+        for station_key, values in zip(keys, rows.tolist()):
             if blocklist.get(station_key, False):
                 # Drop observations for blocklisted stations.
                 continue
 
-            grouped_obs = {ReportSource.gnss: [], ReportSource.query: []}
-            for obs in observations:
-                if obs.source is ReportSource.query:
-                    grouped_obs[obs.source].append(obs)
-                else:
-                    # treat fused, fixed as gnss
-                    grouped_obs[ReportSource.gnss].append(obs)
-
-            station = stations.get(station_key, None)
-            source = ReportSource.gnss
-            if not grouped_obs[source]:
-                # Only query observations.
-                source = ReportSource.query
-
+            row = dict(zip(names, values))
             state = self.station_state(
-                station_key, station, source, grouped_obs[source],
-                self.now, self.today)
+                station_key, stations.get(station_key, None),
+                ReportSource(row['source']), row, self.now, self.today)
 
             transition = state.transition()
             if transition is not None:
@@ -483,34 +502,181 @@ class StationUpdater(object):
                 mysql_on_duplicate='block_count = block_count').values(
                 new_data['new_block']))
 
-        updates = new_data['block'] + new_data['change'] + new_data['replace']
+        # Only update existing stations, so stations deleted in the
+        # meantime aren't recreated from partial rows.
+        updates = (new_data['block'] + new_data['change'] +
+                   new_data['replace'] + new_data['confirm'])
         if updates:
-            session.bulk_update_mappings(shard, updates)
-
-        if new_data['confirm']:
-            session.bulk_update_mappings(shard, new_data['confirm'])
+            bulk_update(session, shard.__table__, updates)
 
         return updated_areas
 
-    def shard_observations(self, observations):
-        sharded_obs = {}
+    def decode_observations(self, observations):
+        """
+        Decode queued observations into a NumPy structured array of
+        partial aggregates.
+
+        The queue can contain partial aggregates, binary records, JSON
+        encoded bytes or already decoded JSON values. The latter two are
+        converted into binary records first.
+        """
+        partials = []
+        values = []
         for obs in observations:
+            if isinstance(obs, bytes):
+                if self.obs_model.is_partial(obs):
+                    partials.append(obs)
+                    continue
+                if self.obs_model.is_binary(obs):
+                    values.append(obs)
+                    continue
+                obs = codec.loads(obs)
             obs = self.obs_model.from_json(obs)
             if obs is not None:
-                if not obs.weight:
-                    # Filter out observations with too little weight.
-                    continue
-                shard = obs.shard_model
-                if shard not in sharded_obs:
-                    sharded_obs[shard] = defaultdict(list)
-                sharded_obs[shard][obs.unique_key].append(obs)
-        return sharded_obs
+                values.append(obs.to_binary())
+        records = self.obs_model.to_partials(
+            self.obs_model.decode_binary(values))
+        if partials:
+            records = numpy.concatenate(
+                (records, self.obs_model.decode_partials(partials)))
+        return records
+
+    def aggregate_observations(self, records):
+        """
+        Combine the observations of all stations at once into one row
+        per station.
+
+        Fused and fixed observations count as gnss. If there are gnss
+        observations for a station, its query observations are ignored.
+        Each row holds the combined partial aggregate, the number of all
+        observations of the station, the range of the sorted records it
+        combines and if the observations are consistent with each other.
+
+        Returns the sorted records and the rows.
+        """
+        query = records['source'] == int(ReportSource.query)
+        records['source'] = numpy.where(
+            query, int(ReportSource.query), int(ReportSource.gnss))
+        records, starts = self.obs_model.group_partials(records)
+        groups = self.obs_model.reduce_partials(records, starts)
+        ends = numpy.append(starts[1:], len(records))
+
+        # The groups are already sorted by key and the gnss group sorts
+        # first, if a station has one.
+        _, first = self.obs_model.group_partials(groups, by_source=False)
+
+        rows = numpy.zeros(
+            len(first), dtype=numpy.dtype(groups.dtype.descr + ROW_FIELDS))
+        for name in groups.dtype.names:
+            rows[name] = groups[name][first]
+        if len(first):
+            rows['total'] = numpy.add.reduceat(groups['samples'], first)
+        rows['first'] = starts[first]
+        rows['last'] = ends[first]
+
+        max_dist = self.station_state.MAX_DIST_METERS
+        rows['consistent'] = within_distance(
+            haversine(rows['min_lat'], rows['min_lon'],
+                      rows['max_lat'], rows['max_lon']),
+            max_dist, lambda i: distance(
+                rows['min_lat'][i], rows['min_lon'][i],
+                rows['max_lat'][i], rows['max_lon'][i]))
+        return (records, rows)
+
+    def confirm_observations(self, rows, records, stations):
+        """
+        Check for all rows at once, if every observation is close to
+        the position of the existing station.
+
+        Each record combines one or more observations. Their distance
+        is bounded by the farthest corner of the record's bounding box
+        and by the distance of its center plus its spread, the smaller
+        bound has to be within the limit to confirm the station. The
+        distance of the center is a lower bound, which has to exceed
+        the limit to reject the observations. For single observations
+        all bounds are exact and one of the two is always true.
+        """
+        rows['confirm'] = False
+        rows['reject'] = False
+        positions = numpy.array(
+            [(station.lat, station.lon)
+             if station and station.lat is not None and
+             station.lon is not None else (numpy.nan, numpy.nan)
+             for station in stations], dtype=numpy.double).reshape(-1, 2)
+        index = numpy.flatnonzero(~numpy.isnan(positions[:, 0]))
+        if not len(index):
+            return
+
+        # Repeat the station position for each of its records.
+        first = rows['first'][index]
+        counts = rows['last'][index] - first
+        offsets = numpy.cumsum(counts) - counts
+        obs = records[numpy.repeat(first - offsets, counts) +
+                      numpy.arange(counts.sum())]
+        lat = numpy.repeat(positions[index, 0], counts)
+        lon = numpy.repeat(positions[index, 1], counts)
+
+        center = haversine(obs['lat'], obs['lon'], lat, lon)
+        upper = numpy.minimum(
+            numpy.maximum.reduce([
+                haversine(obs[lat_name], obs[lon_name], lat, lon)
+                for lat_name in ('min_lat', 'max_lat')
+                for lon_name in ('min_lon', 'max_lon')]),
+            center + obs['spread'])
+
+        def exact(i, bound='upper'):
+            station_lat, station_lon = positions[index[i]]
+            record = records[rows['first'][index[i]]:rows['last'][index[i]]]
+            result = 0.0
+            for j in range(len(record)):
+                dist = distance(record['lat'][j], record['lon'][j],
+                                station_lat, station_lon)
+                if bound == 'upper':
+                    dist = min(dist + record['spread'][j], max(
+                        distance(record[lat_name][j], record[lon_name][j],
+                                 station_lat, station_lon)
+                        for lat_name in ('min_lat', 'max_lat')
+                        for lon_name in ('min_lon', 'max_lon')))
+                result = max(result, dist)
+            return result
+
+        max_dist = self.station_state.MAX_DIST_METERS
+        rows['confirm'][index] = within_distance(
+            numpy.maximum.reduceat(upper, offsets), max_dist, exact)
+        rows['reject'][index] = ~within_distance(
+            numpy.maximum.reduceat(center, offsets), max_dist,
+            lambda i: exact(i, bound='lower'))
+
+    def shard_observations(self, observations):
+        """
+        Return the sorted records and a mapping of each station shard
+        to the rows of combined observations for its stations.
+        """
+        records = self.decode_observations(observations)
+        # Filter out observations with too little weight.
+        records = records[records['weight'] != 0.0]
+        records, rows = self.aggregate_observations(records)
+
+        indices = defaultdict(list)
+        for i, key in enumerate(self.obs_model.binary_keys(rows)):
+            indices[self.station_model.shard_model(key)].append(i)
+
+        sharded_obs = {}
+        for shard, shard_indices in indices.items():
+            sharded_obs[shard] = rows[shard_indices]
+        return (records, sharded_obs)
 
     def __call__(self):
-        sharded_obs = self.shard_observations(self.data_queue.dequeue())
+        start = time.time()
+        batch = self.data_queue.reserve(stats_client=self.task.stats_client)
+        records, sharded_obs = self.shard_observations(batch.items)
         if not sharded_obs:
+            self.data_queue.ack(batch.token)
+            self.data_queue.adapt(time.time() - start,
+                                  stats_client=self.task.stats_client)
             return
 
+        conflicts = 0
         success = False
         for i in range(self._retries):
             try:
@@ -518,15 +684,16 @@ class StationUpdater(object):
                 updated_areas = set()
 
                 with self.task.db_session() as session:
-                    for shard, shard_values in sharded_obs.items():
+                    for shard, rows in sharded_obs.items():
                         updated_areas.update(self.update_shard(
-                            session, shard, shard_values, stats_counter))
+                            session, shard, rows, records, stats_counter))
 
                 success = True
             except SQLInternalError as exc:
                 if (isinstance(exc.orig, PyMysqlInternalError) and
                         exc.orig.args[0] in self._retriable):
                     success = False
+                    conflicts += 1
                     time.sleep(self._retry_wait * (i ** 2 + 1))
                 else:  # pragma: no cover
                     raise
@@ -534,13 +701,21 @@ class StationUpdater(object):
             if success:
                 break
 
+        self.data_queue.adapt(time.time() - start, conflicts=conflicts,
+                              stats_client=self.task.stats_client)
         if success:
+            area_queue = None
             with self.task.redis_pipeline() as pipe:
                 if updated_areas:
-                    self.queue_area_updates(pipe, updated_areas)
+                    area_queue = self.queue_area_updates(pipe, updated_areas)
 
                 self.emit_stats(pipe, stats_counter)
+                # Only acknowledge the batch after the DB commit,
+                # otherwise it is delivered again.
+                self.data_queue.ack(batch.token, pipe=pipe)
 
+            if area_queue is not None:
+                area_queue.notify()
             if self.data_queue.ready():  # pragma: no cover
                 self.task.apply_countdown(kwargs={'shard_id': self.shard_id})
 
@@ -555,6 +730,7 @@ class MacUpdater(StationUpdater):
 class BlueUpdater(MacUpdater):
 
     obs_model = BlueObservation
+    station_model = BlueShard
     queue_prefix = 'update_blue_'
     station_state = BlueState
     station_type = 'blue'
@@ -565,6 +741,7 @@ class BlueUpdater(MacUpdater):
 class WifiUpdater(MacUpdater):
 
     obs_model = WifiObservation
+    station_model = WifiShard
     queue_prefix = 'update_wifi_'
     station_state = WifiState
     station_type = 'wifi'
@@ -575,6 +752,7 @@ class WifiUpdater(MacUpdater):
 class CellUpdater(StationUpdater):
 
     obs_model = CellObservation
+    station_model = CellShard
     queue_prefix = 'update_cell_'
     station_state = CellState
     station_type = 'cell'
@@ -591,3 +769,4 @@ class CellUpdater(StationUpdater):
     def queue_area_updates(self, pipe, updated_areas):
         data_queue = self.data_queues['update_cellarea']
         data_queue.enqueue(list(updated_areas), pipe=pipe)
+        return data_queue
@@ -2,6 +2,7 @@ from datetime import timedelta
 
 from sqlalchemy import delete, func, select
 
+from ichnaea.db import bulk_upsert
 from ichnaea.models import (
     BlueShard,
     CellArea,
@@ -139,27 +140,17 @@ class StatRegion(object):
         ).fetchall()
         region_stats = set([row.region for row in rows])
 
-        inserts = []
-        updates = []
-        for region, values in stats.items():
-            data = {
+        values = []
+        for region, counts in stats.items():
+            values.append({
                 'region': region,
-                'gsm': values['gsm'],
-                'wcdma': values['wcdma'],
-                'lte': values['lte'],
-                'blue': values['blue'],
-                'wifi': values['wifi'],
-            }
-            if region in region_stats:
-                updates.append(data)
-            else:
-                inserts.append(data)
-
-        if inserts:
-            session.bulk_insert_mappings(RegionStat, inserts)
-
-        if updates:
-            session.bulk_update_mappings(RegionStat, updates)
+                'gsm': counts['gsm'],
+                'wcdma': counts['wcdma'],
+                'lte': counts['lte'],
+                'blue': counts['blue'],
+                'wifi': counts['wifi'],
+            })
+        bulk_upsert(session, RegionStat.__table__, values)
 
         obsolete_regions = list(region_stats - set(stats.keys()))
         if obsolete_regions:
@@ -11,6 +11,7 @@ from celery.schedules import crontab
 
 from ichnaea.async.app import celery_app
 from ichnaea.async.task import BaseTask
+from ichnaea.config import DATA_QUEUE_TRIGGER
 from ichnaea.data import _cell_export_enabled
 from ichnaea.data import _web_content_enabled
 from ichnaea.data import area
@@ -23,6 +24,13 @@ from ichnaea.data import stats
 from ichnaea import models
 
 
+def _queue_schedule(seconds):
+    # With enqueue-side triggers, the periodic runs are only a fallback.
+    if DATA_QUEUE_TRIGGER:
+        seconds *= 5
+    return timedelta(seconds=seconds)
+
+
 @celery_app.task(base=BaseTask, bind=True, queue='celery_export',
                  expires=2700, _schedule=crontab(minute=3),
                  _enabled=_cell_export_enabled)
@@ -49,8 +57,14 @@ def monitor_api_users(self):
     monitor.ApiUsers(self)()
 
 
+@celery_app.task(base=BaseTask, bind=True, queue='celery_monitor',
+                 expires=57, _schedule=timedelta(seconds=60))
+def monitor_queue_size(self):
+    monitor.QueueSize(self)()
+
+
 @celery_app.task(base=BaseTask, bind=True, queue='celery_reports',
-                 _countdown=2, expires=20, _schedule=timedelta(seconds=32))
+                 _countdown=2, expires=20, _schedule=_queue_schedule(32))
 def update_incoming(self):
     export.IncomingQueue(self)(export_reports)
 
@@ -62,28 +76,28 @@ def export_reports(self, name, queue_key):
 
 
 @celery_app.task(base=BaseTask, bind=True, queue='celery_blue',
-                 _countdown=5, expires=30, _schedule=timedelta(seconds=48),
+                 _countdown=5, expires=30, _schedule=_queue_schedule(48),
                  _shard_model=models.BlueShard)
 def update_blue(self, shard_id=None):
     station.BlueUpdater(self, shard_id=shard_id)()
 
 
 @celery_app.task(base=BaseTask, bind=True, queue='celery_cell',
-                 _countdown=5, expires=30, _schedule=timedelta(seconds=41),
+                 _countdown=5, expires=30, _schedule=_queue_schedule(41),
                  _shard_model=models.CellShard)
 def update_cell(self, shard_id=None):
     station.CellUpdater(self, shard_id=shard_id)()
 
 
 @celery_app.task(base=BaseTask, bind=True, queue='celery_wifi',
-                 _countdown=5, expires=30, _schedule=timedelta(seconds=40),
+                 _countdown=5, expires=30, _schedule=_queue_schedule(40),
                  _shard_model=models.WifiShard)
 def update_wifi(self, shard_id=None):
     station.WifiUpdater(self, shard_id=shard_id)()
 
 
 @celery_app.task(base=BaseTask, bind=True, queue='celery_cell',
-                 _countdown=5, expires=30, _schedule=timedelta(seconds=44))
+                 _countdown=5, expires=30, _schedule=_queue_schedule(44))
 def update_cellarea(self):
     area.CellAreaUpdater(self)()
 
@@ -97,7 +111,7 @@ def cleanup_datamap(self, shard_id=None):
 
 
 @celery_app.task(base=BaseTask, bind=True, queue='celery_content',
-                 _countdown=2, expires=30, _schedule=timedelta(seconds=47),
+                 _countdown=2, expires=30, _schedule=_queue_schedule(47),
                  _shard_model=models.DataMap,
                  _enabled=_web_content_enabled)
 def update_datamap(self, shard_id=None):
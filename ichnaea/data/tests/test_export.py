@@ -1,12 +1,16 @@
 import time
 from unittest import mock
 
-import boto3
+import pytest
 import requests_mock
 import simplejson
 
 from ichnaea.data.export import (
     DummyExporter,
+    EXPORT_CONFIGS,
+    gzip_reports,
+    IncomingQueue,
+    InternalExporter,
     InternalTransform,
 )
 from ichnaea.data.tasks import (
@@ -18,8 +22,15 @@ from ichnaea.data.tasks import (
 from ichnaea.models import (
     BlueShard,
     CellShard,
+    ExportConfig,
+    WifiObservation,
     WifiShard,
 )
+from ichnaea.models.config import (
+    EXPORT_LOG_KEY,
+    export_log,
+)
+from ichnaea.submit import deferred_item
 from ichnaea.tests.factories import (
     ApiKeyFactory,
     BlueShardFactory,
@@ -128,6 +139,30 @@ class TestExporter(BaseExportTest):
                 ('queue_export_query', 1)]:
             assert self.queue_length(redis, queue_key) == num
 
+    def test_deferred(self, celery, redis, session, stats):
+        ExportConfigFactory(name='test', batch=10)
+        session.flush()
+
+        wifis = WifiShardFactory.build_batch(2)
+        body = simplejson.dumps({'items': [{
+            'latitude': wifi.lat,
+            'longitude': wifi.lon,
+            'wifiAccessPoints': [{'macAddress': wifi.mac}],
+        } for wifi in wifis]})
+        self.queue(celery).enqueue([
+            deferred_item('test', 'v1.geosubmit',
+                          util.encode_gzip(body), gzip=True),
+            deferred_item('test', 'v1.geosubmit', '{"items": [invalid'),
+        ])
+        update_incoming.delay().get()
+        stats.check(counter=[('data.batch.drop', 1, 1, ['key:test'])])
+
+        assert self.queue_length(redis, 'queue_export_test') == 2
+        items = ExportConfig.get(session, 'test').queue(
+            'queue_export_test', redis).dequeue()
+        assert ([item['report']['position']['latitude'] for item in items] ==
+                [wifi.lat for wifi in wifis])
+
     def test_retry(self, celery, redis, session):
         ExportConfigFactory(name='test', batch=1)
         session.flush()
@@ -150,6 +185,89 @@ class TestExporter(BaseExportTest):
 
         assert self.queue_length(redis, 'queue_export_test') == 0
 
+    def test_config_cache(self, celery, redis, session):
+        ExportConfigFactory(name='test', batch=3)
+        session.flush()
+        self.add_reports(celery, 1)
+        update_incoming.delay().get()
+        assert self.queue_length(redis, 'queue_export_test') == 1
+
+        # Changes are picked up once the cache expires.
+        ExportConfigFactory(name='new', batch=3)
+        session.flush()
+        self.add_reports(celery, 1)
+        update_incoming.delay().get()
+        assert self.queue_length(redis, 'queue_export_test') == 2
+        assert self.queue_length(redis, 'queue_export_new') == 0
+
+        EXPORT_CONFIGS._expires = 0.0
+        self.add_reports(celery, 1)
+        update_incoming.delay().get()
+        assert self.queue_length(redis, 'queue_export_test') == 0
+        assert self.queue_length(redis, 'queue_export_new') == 1
+        assert (sorted(config.name for config in
+                       EXPORT_CONFIGS.all(session, redis)) == ['new', 'test'])
+
+    def test_concurrency(self, celery, redis, session):
+        ExportConfigFactory(name='test', batch=2)
+        session.flush()
+        self.add_reports(celery, 7)
+
+        sizes = []
+
+        def mock_send(self, queue_items):
+            sizes.append(len(queue_items))
+
+        with mock.patch.object(DummyExporter, 'concurrency', 3):
+            with mock.patch.object(DummyExporter, 'send', mock_send):
+                update_incoming.delay().get()
+
+        assert sizes == [2, 2, 2]
+        assert self.queue_length(redis, 'queue_export_test') == 1
+
+    def test_shared(self, celery, redis, redis_version, session):
+        if redis_version < (6, 2):
+            pytest.skip('The export log requires Redis 6.2')
+        ExportConfigFactory(name='test', batch=3,
+                            skip_keys=frozenset(['export_source']))
+        ExportConfigFactory(name='everything', batch=5)
+        ExportConfigFactory(name='query', batch=2,
+                            skip_sources=frozenset(['gnss']))
+        session.flush()
+
+        self.add_reports(celery, 4)
+        self.add_reports(celery, 2, api_key=None, source='gnss')
+        self.add_reports(celery, 1, api_key='test', source='query')
+        with mock.patch.object(IncomingQueue, 'shared', True):
+            update_incoming.delay().get()
+
+        # Each report is stored once, no matter how many exports use it.
+        assert export_log(redis).size() == 7
+        for queue_key in ('queue_export_test', 'queue_export_everything',
+                          'queue_export_query'):
+            assert self.queue_length(redis, queue_key) == 0
+
+        # Every export has read the part of the log it needs.
+        for name, num in [('test', 1), ('everything', 2), ('query', 1)]:
+            queue = ExportConfig.get(session, name).queue(
+                EXPORT_LOG_KEY, redis)
+            assert queue.size() == num
+
+
+class TestGzipReports(object):
+
+    def test_empty(self):
+        body = gzip_reports([])
+        assert simplejson.loads(util.decode_gzip(body.read())) == {
+            'items': []}
+
+    def test_reports(self):
+        reports = [{'position': {'latitude': 1.5}}, {'wifiAccessPoints': []}]
+        body = gzip_reports(reports, compresslevel=5)
+        assert body.tell() == 0
+        assert simplejson.loads(util.decode_gzip(body.read())) == {
+            'items': reports}
+
 
 class TestGeosubmit(BaseExportTest):
 
@@ -203,7 +321,7 @@ class TestGeosubmit(BaseExportTest):
 
 class TestS3(BaseExportTest):
 
-    def test_upload(self, celery, session, stats):
+    def test_upload(self, celery, redis, session, stats):
         ExportConfigFactory(
             name='backup', batch=3, schema='s3',
             url='s3://bucket/backups/{source}/{api_key}/{year}/{month}/{day}')
@@ -215,32 +333,25 @@ class TestS3(BaseExportTest):
         self.add_reports(celery, 3, api_key='e5444-794', source='fused')
         self.add_reports(celery, 3, api_key=None)
 
-        mock_conn = mock.MagicMock()
-        mock_bucket = mock.MagicMock()
-        mock_obj = mock.MagicMock()
-        mock_conn.return_value.Bucket.return_value = mock_bucket
-        mock_bucket.Object.return_value = mock_obj
-
-        with mock.patch.object(boto3, 'resource', mock_conn):
+        mock_client = mock.MagicMock()
+        with mock.patch.object(celery, 's3_client', mock_client):
             update_incoming.delay().get()
 
-        obj_calls = mock_bucket.Object.call_args_list
-        put_calls = mock_obj.put.call_args_list
-        assert len(obj_calls) == 4
+        put_calls = mock_client.put_object.call_args_list
         assert len(put_calls) == 4
 
         keys = []
         test_export = None
-        for obj_call, put_call in zip(obj_calls, put_calls):
-            s3_key = obj_call[0][0]
+        for put_call in put_calls:
+            s3_key = put_call[1]['Key']
+            assert put_call[1]['Bucket'] == 'bucket'
             assert s3_key.startswith('backups/')
             assert s3_key.endswith('.json.gz')
-            assert put_call[1]['Body']
             assert put_call[1]['ContentType'] == 'application/json'
             assert put_call[1]['ContentEncoding'] == 'gzip'
             keys.append(s3_key)
             if 'test' in s3_key:
-                test_export = put_call[1]['Body']
+                test_export = put_call[1]['Body'].getvalue()
 
         # extract second and third path segment from key names
         groups = [tuple(key.split('/')[1:3]) for key in keys]
@@ -264,6 +375,45 @@ class TestS3(BaseExportTest):
             ('data.export.upload', 4, ['key:backup']),
         ])
 
+        # All partitions have been exported and removed from the index.
+        assert redis.smembers('export_partitions:backup') == set()
+
+    def test_upload_shared(self, celery, redis_version, session, stats):
+        if redis_version < (6, 2):
+            pytest.skip('The export log requires Redis 6.2')
+        ExportConfigFactory(
+            name='backup', batch=3, schema='s3',
+            url='s3://bucket/backups/{source}/{api_key}/{year}/{month}/{day}')
+        ApiKeyFactory(valid_key='e5444-794')
+        session.flush()
+
+        self.add_reports(celery, 3)
+        self.add_reports(celery, 3, api_key='e5444-794', source='fused')
+        self.add_reports(celery, 3, api_key=None)
+
+        mock_client = mock.MagicMock()
+        with mock.patch.object(celery, 's3_client', mock_client):
+            with mock.patch.object(IncomingQueue, 'shared', True):
+                update_incoming.delay().get()
+
+        # The shared queue is read in batches, which are uploaded
+        # as one object per source and api key.
+        groups = set()
+        num = 0
+        for put_call in mock_client.put_object.call_args_list:
+            s3_key = put_call[1]['Key']
+            groups.add(tuple(s3_key.split('/')[1:3]))
+            uploaded_text = util.decode_gzip(put_call[1]['Body'].getvalue())
+            num += len(simplejson.loads(uploaded_text)['items'])
+
+        assert num == 9
+        assert (groups ==
+                set([('gnss', 'test'), ('gnss', 'no_key'),
+                     ('fused', 'e5444-794')]))
+        stats.check(counter=[
+            ('data.export.batch', 3, 1, ['key:backup']),
+        ])
+
 
 class TestInternalTransform(object):
 
@@ -558,6 +708,52 @@ class TestInternal(BaseExportTest):
         assert wifi.mac == wifi_data['macAddress']
         assert wifi.samples == 1
 
+    def test_wifi_binary(self, celery, session):
+        reports = self.add_reports(celery, cell_factor=0, wifi_factor=1)
+        wifi_data = reports[0]['wifiAccessPoints'][0]
+        shard_id = WifiShard.shard_id(wifi_data['macAddress'])
+        queue = celery.data_queues['update_wifi_' + shard_id]
+        with mock.patch.object(queue, 'json', False):
+            self._update_all(session, datamap_only=True)
+            values = queue.dequeue()
+            assert len(values) == 1
+            assert WifiObservation.is_binary(values[0])
+
+            queue.enqueue(values)
+            update_wifi.delay(shard_id=shard_id).get()
+
+        shard = WifiShard.shard_model(wifi_data['macAddress'])
+        wifis = session.query(shard).all()
+        assert len(wifis) == 1
+        assert wifis[0].mac == wifi_data['macAddress']
+        assert wifis[0].samples == 1
+
+    def test_wifi_aggregate(self, celery, session, stats):
+        wifi = WifiShardFactory.build()
+        self.add_reports(celery, 3, cell_factor=0, wifi_factor=1,
+                         wifi_key=wifi.mac, lat=wifi.lat, lon=wifi.lon)
+        shard_id = WifiShard.shard_id(wifi.mac)
+        queue = celery.data_queues['update_wifi_' + shard_id]
+        with mock.patch.object(queue, 'json', False):
+            with mock.patch.object(InternalExporter, 'aggregate', True):
+                self._update_all(session, datamap_only=True)
+            values = queue.dequeue()
+            assert len(values) == 1
+            assert WifiObservation.is_partial(values[0])
+
+            queue.enqueue(values)
+            update_wifi.delay(shard_id=shard_id).get()
+
+        shard = WifiShard.shard_model(wifi.mac)
+        wifis = session.query(shard).all()
+        assert len(wifis) == 1
+        assert wifis[0].mac == wifi.mac
+        assert wifis[0].samples == 3
+        stats.check(counter=[
+            ('data.observation.upload', 1, 3, ['type:wifi', 'key:test']),
+            ('data.observation.insert', 1, 3, ['type:wifi']),
+        ])
+
     def test_wifi_duplicated(self, celery, session):
         self.add_reports(celery, cell_factor=0, wifi_factor=1)
         # duplicate the wifi entry inside the report
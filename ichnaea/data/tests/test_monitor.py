@@ -1,9 +1,18 @@
 from datetime import timedelta
 
+from ichnaea import codec
+from ichnaea.data.monitor import (
+    monitored_queues,
+    QUEUE_SAMPLES_KEY,
+)
 from ichnaea.data.tasks import (
     monitor_api_key_limits,
     monitor_api_users,
+    monitor_queue_size,
 )
+from ichnaea.models import ExportConfig
+from ichnaea.models.config import EXPORT_LOG_KEY
+from ichnaea.tests.factories import ExportConfigFactory
 from ichnaea import util
 
 
@@ -110,3 +119,75 @@ class TestMonitorAPIUsers(object):
 
         # the too old key was deleted manually
         assert not redis.exists('apiuser:submit:test:' + days_7)
+
+
+class TestMonitorQueueSize(object):
+
+    def test_empty(self, celery, stats):
+        monitor_queue_size.delay().get()
+        stats.check(gauge=[
+            ('queue', 1, 0, ['queue:celery_default']),
+            ('queue', 1, 0, ['queue:update_incoming']),
+            ('queue.age', 1, 0, ['queue:update_incoming']),
+        ])
+
+    def test_monitored_queues(self, redis):
+        configs = [
+            ExportConfig(name='backup', schema='s3'),
+            ExportConfig(name='test', schema='dummy'),
+        ]
+        with redis.pipeline() as pipe:
+            configs[0].add_partition(pipe, 'queue_export_backup:gnss:a')
+            pipe.execute()
+        # Unrelated keys aren't monitored.
+        redis.rpush('queue_export_other', b'1')
+
+        keys = [queue.key for queue in monitored_queues(
+            redis, {}, configs, shared=False)]
+        assert 'celery_default' in keys
+        assert keys[-2:] == ['queue_export_backup:gnss:a',
+                             'queue_export_test']
+        assert 'queue_export_other' not in keys
+
+        keys = [queue.key for queue in monitored_queues(
+            redis, {}, configs, shared=True)]
+        assert keys[-1] == EXPORT_LOG_KEY
+
+    def test_queues(self, celery, redis, session, stats):
+        ExportConfigFactory(name='test', schema='s3')
+        session.flush()
+        redis.lpush('celery_cell', 1, 2)
+        celery.data_queues['update_incoming'].enqueue([{'a': 1}])
+        celery.data_queues['update_wifi_0'].enqueue([b'1', b'2', b'3'])
+        export_queue = 'queue_export_test:gnss:test'
+        redis.rpush(export_queue, b'1')
+
+        monitor_queue_size.delay().get()
+        stats.check(gauge=[
+            ('queue', 1, 2, ['queue:celery_cell']),
+            ('queue', 1, 1, ['queue:update_incoming']),
+            ('queue', 1, 3, ['queue:update_wifi_0']),
+            ('queue', 1, 1, ['queue:' + export_queue]),
+            ('queue.enqueue', 1, 0, ['queue:update_wifi_0']),
+        ])
+        assert redis.exists(QUEUE_SAMPLES_KEY)
+
+    def test_rates(self, celery, redis, stats):
+        queue = celery.data_queues['update_wifi_0']
+        queue.enqueue([b'1', b'2', b'3'])
+        monitor_queue_size.delay().get()
+
+        # Pretend the first sample was taken ten seconds ago.
+        data = codec.loads(redis.get(QUEUE_SAMPLES_KEY))
+        data['time'] -= 10.0
+        redis.set(QUEUE_SAMPLES_KEY, codec.dumps(data))
+
+        queue.enqueue([b'%d' % i for i in range(100)])
+        queue.dequeue(batch=53)
+        stats._clear()
+        monitor_queue_size.delay().get()
+        stats.check(gauge=[
+            ('queue', 1, 50, ['queue:update_wifi_0']),
+            ('queue.enqueue', 1, 10, ['queue:update_wifi_0']),
+            ('queue.dequeue', 1, 5, ['queue:update_wifi_0']),
+        ])
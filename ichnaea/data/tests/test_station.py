@@ -2,17 +2,29 @@ from collections import defaultdict
 from datetime import timedelta
 from unittest import mock
 
+from pymysql.constants.ER import LOCK_DEADLOCK
+from pymysql.err import InternalError as PyMysqlInternalError
 import pytest
 from sqlalchemy import text
+from sqlalchemy.exc import InternalError as SQLInternalError
 
+from ichnaea import codec
 from ichnaea.db import configure_db
-from ichnaea.data.station import CellUpdater
+from ichnaea.data.station import (
+    CellUpdater,
+    StationUpdater,
+    WifiUpdater,
+)
 from ichnaea.data.tasks import (
     update_blue,
     update_cell,
     update_wifi,
 )
-from ichnaea.geocalc import destination
+from ichnaea.geocalc import (
+    destination,
+    latitude_add,
+    longitude_add,
+)
 from ichnaea.models import (
     decode_cellid,
     encode_cellarea,
@@ -30,6 +42,10 @@ from ichnaea.models.constants import (
     CELL_MAX_RADIUS,
     WIFI_MAX_RADIUS,
 )
+from ichnaea.queue import (
+    DataQueue,
+    StreamDataQueue,
+)
 from ichnaea.tests.factories import (
     BlueObservationFactory,
     BlueShardFactory,
@@ -59,7 +75,10 @@ class BaseStationTest(object):
 
         for shard_id, values in sharded_obs.items():
             queue = celery.data_queues[self.queue_prefix + shard_id]
-            queue.enqueue([value.to_json() for value in values])
+            if queue.json:
+                queue.enqueue([value.to_json() for value in values])
+            else:
+                queue.enqueue([value.to_binary() for value in values])
             task.delay(shard_id=shard_id).get()
 
 
@@ -277,6 +296,105 @@ class StationTest(BaseStationTest):
             ('data.station.new', 2, [self.type_tag]),
         ])
 
+    def test_new_binary(self, celery, session):
+        obs = self.make_obs()
+        shard_id = self.shard_model.shard_id(getattr(obs[0], self.unique_key))
+        queue = celery.data_queues[self.queue_prefix + shard_id]
+        with mock.patch.object(queue, 'json', False):
+            # JSON encoded observations queued before the switch.
+            queue.enqueue([codec.dumps(obs[0].to_json()).encode('utf-8')])
+            self.queue_and_update(celery, obs[1:])
+
+        station = self.get_station(session, obs[0])
+        assert round(station.lat, 7) == round(obs[0].lat, 7)
+        assert round(station.lon, 7) == round(obs[0].lon, 7)
+        assert station.samples == 3
+        assert station.source == ReportSource.gnss
+        assert round(station.weight, 2) == 3.0
+
+    def test_new_partial(self, celery, session, stats):
+        obs = self.obs_factory.build()
+        observations = [
+            self.obs_factory(lat=obs.lat + 0.0001, **self.key(obs)),
+            self.obs_factory(lat=obs.lat - 0.0003, **self.key(obs)),
+            self.obs_factory(lon=obs.lon + 0.0002, **self.key(obs)),
+            self.obs_factory(lon=obs.lon - 0.0004, **self.key(obs)),
+        ]
+        obs_model = type(obs)
+        partials = obs_model.merge_partials(obs_model.to_partials(
+            obs_model.decode_binary(
+                [value.to_binary() for value in observations])))
+        assert len(partials) == 1
+
+        shard_id = self.shard_model.shard_id(getattr(obs, self.unique_key))
+        queue = celery.data_queues[self.queue_prefix + shard_id]
+        with mock.patch.object(queue, 'json', False):
+            # One partial aggregate and one single observation.
+            queue.enqueue(obs_model.encode_partials(partials))
+            self.queue_and_update(celery, [obs])
+
+        station = self.get_station(session, obs)
+        assert round(station.lat, 7) == round(obs.lat - 0.00004, 7)
+        assert round(station.max_lat, 7) == round(obs.lat + 0.0001, 7)
+        assert round(station.min_lat, 7) == round(obs.lat - 0.0003, 7)
+        assert round(station.lon, 7) == round(obs.lon - 0.00004, 7)
+        assert round(station.max_lon, 7) == round(obs.lon + 0.0002, 7)
+        assert round(station.min_lon, 7) == round(obs.lon - 0.0004, 7)
+        assert station.radius == 38
+        assert station.samples == 5
+        assert round(station.weight, 2) == 5.0
+
+        stats.check(counter=[
+            ('data.observation.insert', 1, 5, [self.type_tag]),
+        ])
+
+    def test_reliable(self, celery, redis, session, stats):
+        obs = self.make_obs()
+        shard_id = self.shard_model.shard_id(getattr(obs[0], self.unique_key))
+        key = self.queue_prefix + shard_id
+        queue = DataQueue(key, redis, batch=500, reliable=True)
+        deadlock = SQLInternalError(
+            'statement', {}, PyMysqlInternalError(LOCK_DEADLOCK, 'Deadlock'))
+
+        with mock.patch.dict(celery.data_queues, {key: queue}):
+            with mock.patch.object(StationUpdater, '_retry_wait', 0.0):
+                with mock.patch.object(StationUpdater, 'update_shard',
+                                       side_effect=deadlock):
+                    self.queue_and_update(celery, obs)
+
+            # The batch is kept after all retries failed.
+            assert self.get_station(session, obs[0]) is None
+            tokens = redis.zrange(queue.processing_key, 0, -1)
+            assert len(tokens) == 1
+
+            # Expire the batch, so the next update delivers it again.
+            redis.zadd(queue.processing_key, 0, tokens[0])
+            self.queue_and_update(celery, obs[:1])
+
+            assert queue.size() == 1
+            assert redis.zcard(queue.processing_key) == 0
+            station = self.get_station(session, obs[0])
+            assert station.samples == 3
+
+        stats.check(counter=[
+            ('queue.redeliver', 1, 3, ['queue:' + key]),
+        ])
+
+    def test_stream(self, celery, redis, redis_version, session):
+        if redis_version < (5, 0):
+            pytest.skip('Redis Streams require Redis 5.0')
+        obs = self.make_obs()
+        shard_id = self.shard_model.shard_id(getattr(obs[0], self.unique_key))
+        key = self.queue_prefix + shard_id
+        queue = StreamDataQueue(key, redis, batch=500, partitions=2)
+
+        with mock.patch.dict(celery.data_queues, {key: queue}):
+            self.queue_and_update(celery, obs)
+            assert queue.size() == 0
+
+        station = self.get_station(session, obs[0])
+        assert station.samples == 3
+
     def test_new_block(self, celery, session):
         for source in (ReportSource.gnss, ReportSource.query):
             obs = self.make_obs(source=source, distance=1.0)
@@ -361,6 +479,26 @@ class StationTest(BaseStationTest):
         self.check_dates(
             station, self.ten_days.date(), self.ten_days.date(), self.today)
 
+    def test_confirm_deleted(self, celery, session):
+        obs = self.obs_factory.build(source=ReportSource.query)
+        self.station_factory(
+            created=self.ten_days, modified=self.ten_days,
+            last_seen=self.ten_days.date(), **self.key(obs))
+        session.commit()
+        query_stations = StationUpdater.query_stations
+
+        def delete_stations(updater, session, shard, keys):
+            result = query_stations(updater, session, shard, keys)
+            # The station is deleted after it has been read.
+            session.execute(shard.__table__.delete())
+            return result
+
+        with mock.patch.object(StationUpdater, 'query_stations',
+                               delete_stations):
+            self.queue_and_update(celery, [obs])
+        # The confirmation doesn't recreate the station.
+        assert self.get_station(session, obs) is None
+
     def test_block_half_consistent_obs(self, celery, session):
         for obs_source in (ReportSource.gnss, ReportSource.query):
             for station_source in (ReportSource.gnss, ReportSource.query):
@@ -699,3 +837,86 @@ class TestCell(StationTest):
             assert station.samples == 3
             assert station.source == source
             assert round(station.weight, 3) == 9.245
+
+
+class TestAggregate(object):
+
+    def test_aggregate(self, celery):
+        obs_factory = WifiObservationFactory.build
+        obs = obs_factory(source=ReportSource.gnss)
+        other = obs_factory(source=ReportSource.query)
+        observations = [
+            obs,
+            obs_factory(mac=obs.mac, lat=obs.lat + 0.0002, lon=obs.lon,
+                        source=ReportSource.fused),
+            obs_factory(mac=obs.mac, lat=obs.lat, lon=obs.lon + 0.1,
+                        source=ReportSource.query),
+            other,
+            obs_factory(mac=other.mac, lat=other.lat + 0.1, lon=other.lon,
+                        source=ReportSource.query),
+        ]
+        updater = WifiUpdater(
+            update_wifi, shard_id=WifiShard.shard_id(obs.mac))
+        records, rows = updater.aggregate_observations(
+            updater.decode_observations(
+                [value.to_binary() for value in observations]))
+        assert len(records) == 5
+        assert len(rows) == 2
+
+        keys = WifiUpdater.obs_model.binary_keys(rows)
+        first, second = (keys.index(obs.mac), keys.index(other.mac))
+        assert rows['source'][first] == ReportSource.gnss
+        assert rows['samples'][first] == 2
+        assert rows['total'][first] == 3
+        assert round(rows['lat'][first], 7) == round(obs.lat + 0.0001, 7)
+        assert rows['consistent'][first]
+        assert rows['source'][second] == ReportSource.query
+        assert rows['total'][second] == 2
+        assert not rows['consistent'][second]
+
+        near = WifiShardFactory.build(
+            mac=obs.mac, lat=obs.lat + 0.0001, lon=obs.lon)
+        far = WifiShardFactory.build(
+            mac=other.mac, lat=other.lat + 0.1, lon=other.lon)
+        stations = [None, None]
+        stations[first] = near
+        stations[second] = far
+        updater.confirm_observations(rows, records, stations)
+        assert rows['confirm'][first]
+        assert not rows['confirm'][second]
+
+        near.lat = obs.lat + 0.1
+        updater.confirm_observations(rows, records, stations)
+        assert not rows['confirm'][first]
+
+    def test_confirm_partial(self, celery):
+        station = WifiShardFactory.build()
+        max_dist = WifiUpdater.station_state.MAX_DIST_METERS
+        updater = WifiUpdater(
+            update_wifi, shard_id=WifiShard.shard_id(station.mac))
+        obs_model = updater.obs_model
+
+        def obs(north, east):
+            return WifiObservationFactory.build(
+                mac=station.mac, source=ReportSource.gnss,
+                lat=latitude_add(station.lat, station.lon, north * max_dist),
+                lon=longitude_add(station.lat, station.lon, east * max_dist))
+
+        def check(observations):
+            partials = obs_model.merge_partials(obs_model.to_partials(
+                obs_model.decode_binary(
+                    [value.to_binary() for value in observations])))
+            records, rows = updater.aggregate_observations(
+                updater.decode_observations(
+                    obs_model.encode_partials(partials)))
+            updater.confirm_observations(rows, records, [station])
+            return (bool(rows['confirm'][0]), bool(rows['reject'][0]))
+
+        assert check([obs(0.5, 0.0), obs(0.4, 0.3)]) == (True, False)
+        assert check([obs(1.5, 0.0), obs(1.4, 0.3)]) == (False, True)
+        # Both observations are close, but a corner of their bounding
+        # box isn't, so the station is neither confirmed nor rejected.
+        assert check([obs(0.97, 0.0), obs(0.9, 0.35)]) == (False, False)
+        # Single observations are either confirmed or rejected.
+        assert check([obs(0.97, 0.35)]) == (False, True)
+        assert check([obs(0.9, 0.35)]) == (True, False)
@@ -1,12 +1,17 @@
 """Database related functionality."""
 
+from collections import defaultdict
 from contextlib import contextmanager
 from pymysql.err import DatabaseError
 
 from sqlalchemy import (
+    and_,
+    case,
     create_engine,
     exc,
     event,
+    literal,
+    or_,
 )
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import sessionmaker
@@ -48,6 +53,90 @@ def on_duplicate(insert, compiler, **kw):
 
 Insert.argument_for('mysql', 'on_duplicate', None)
 
+UPSERT_CHUNK_SIZE = 500
+UPDATE_CHUNK_SIZE = 100
+
+
+def _group_rows(table, rows):
+    # Group rows by their columns, each group ordered by primary key.
+    primary_key = [column.name for column in table.primary_key.columns]
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[tuple(sorted(row.keys()))].append(row)
+
+    for columns, group in sorted(grouped.items()):
+        group.sort(key=lambda row: [row[name] for name in primary_key])
+        yield (columns, group)
+
+
+def bulk_upsert(session, table, rows, update=None,
+                chunk_size=UPSERT_CHUNK_SIZE):
+    """
+    Insert or update many rows with a few multi-row
+    `INSERT ... ON DUPLICATE KEY UPDATE` statements, instead of one
+    `UPDATE` statement per row.
+
+    Rows with the same columns are combined into statements of at
+    most `chunk_size` rows, ordered by primary key so concurrent
+    upserts lock the rows in the same order.
+
+    :param table: The :class:`sqlalchemy.schema.Table`.
+    :param rows: A list of dicts of column names to values.
+    :param update: The columns to update for existing rows, defaults
+                   to all given columns not part of the primary key.
+    """
+    primary_key = [column.name for column in table.primary_key.columns]
+    for columns, group in _group_rows(table, rows):
+        if update is None:
+            names = [name for name in columns if name not in primary_key]
+        else:
+            names = [name for name in update if name in columns]
+        if names:
+            on_duplicate = ', '.join(
+                ['%s = VALUES(%s)' % (name, name) for name in names])
+        else:
+            on_duplicate = '%s = %s' % (primary_key[0], primary_key[0])
+
+        stmt = table.insert(mysql_on_duplicate=on_duplicate)
+        for i in range(0, len(group), chunk_size):
+            session.execute(stmt.values(group[i:i + chunk_size]))
+
+
+def bulk_update(session, table, rows, chunk_size=UPDATE_CHUNK_SIZE):
+    """
+    Update many existing rows with a few multi-row `UPDATE` statements,
+    which set each column via a `CASE` expression over the primary key.
+
+    Unlike :func:`bulk_upsert` this never inserts rows, so rows deleted
+    in the meantime stay deleted. Rows with the same columns are
+    combined into statements of at most `chunk_size` rows.
+
+    :param table: The :class:`sqlalchemy.schema.Table`.
+    :param rows: A list of dicts of column names to values, including
+                 the primary key columns.
+    """
+    primary_key = list(table.primary_key.columns)
+    key_names = [column.name for column in primary_key]
+    for columns, group in _group_rows(table, rows):
+        names = [name for name in columns if name not in key_names]
+        if not names:
+            continue
+
+        for i in range(0, len(group), chunk_size):
+            chunk = group[i:i + chunk_size]
+            matches = [and_(*[column == row[column.name]
+                              for column in primary_key])
+                       for row in chunk]
+            values = {}
+            for name in names:
+                column = table.c[name]
+                values[name] = case(
+                    [(match, literal(row[name], column.type))
+                     for match, row in zip(matches, chunk)],
+                    else_=column)
+            session.execute(
+                table.update().where(or_(*matches)).values(values))
+
 
 def configure_db(type_=None, uri=None, transport='default', _db=None):
     """
@@ -14,3 +14,7 @@ class BaseServiceError(Exception):
 
 class GZIPDecodeError(BaseClientError):
     """Exception raised by GZIP decoding."""
+
+
+class BodyTooLargeError(BaseClientError):
+    """Exception raised if a request body exceeds the size limit."""
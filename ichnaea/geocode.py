@@ -11,9 +11,9 @@ import genc
 import mobile_codes
 from shapely import geometry
 from shapely import prepared
-import simplejson
 from rtree import index
 
+from ichnaea import codec
 from ichnaea import geocalc
 from ichnaea import util
 
@@ -57,7 +57,7 @@ class Geocoder(object):
         self._radii = {}
 
         with util.gzip_open(regions_file, 'r') as fd:
-            regions_data = simplejson.load(fd)
+            regions_data = codec.load(fd)
 
         genc_regions = frozenset([rec.alpha2 for rec in genc.REGIONS])
         for feature in regions_data['features']:
@@ -69,7 +69,7 @@ class Geocoder(object):
                 self._radii[code] = feature['properties']['radius']
 
         with util.gzip_open(buffer_file, 'r') as fd:
-            buffer_data = simplejson.load(fd)
+            buffer_data = codec.load(fd)
 
         i = 0
         envelopes = []
@@ -1,5 +1,7 @@
-"""Setup and configuration of a HTTP/S connection pool."""
+"""Setup and configuration of HTTP/S connection pools."""
 
+import boto3
+import botocore.config
 import certifi
 from requests.adapters import HTTPAdapter
 from requests.sessions import Session
@@ -33,3 +35,20 @@ def configure_http_session(size=20, max_retries=1, _session=None):
     session.max_redirects = 1
     session.verify = certifi.where()
     return session
+
+
+def configure_s3(size=20, _client=None):
+    """
+    Return a thread-safe S3 client with a connection pool of the
+    given size.
+
+    :param size: The connection pool and maximum size.
+    :type size: int
+
+    :param _client: Test-only hook to provide a pre-configured client.
+    """
+    if _client is not None:
+        return _client
+
+    return boto3.client(
+        's3', config=botocore.config.Config(max_pool_connections=size))
@@ -1,5 +1,9 @@
 """Functionality related to statsd, sentry and freeform logging."""
-from collections import deque
+from collections import (
+    deque,
+    OrderedDict,
+)
+from contextlib import contextmanager
 import logging
 from logging.config import dictConfig
 import time
@@ -178,6 +182,48 @@ def log_tween_factory(handler, registry):
     return log_tween
 
 
+class StageTimer(object):
+    """
+    Collects the time spent in the named stages of a single request.
+
+    Each stage can be qualified by a source, for example the network
+    type or search source. Durations of repeated stages with the same
+    name and source are added up.
+    """
+
+    def __init__(self):
+        self.durations = OrderedDict()
+
+    @contextmanager
+    def stage(self, name, source=None):
+        """Measure the time spent inside the context as a stage."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            key = (name, source)
+            self.durations[key] = (
+                self.durations.get(key, 0.0) + time.time() - start)
+
+    def send(self, stats_client, metric, tags=()):
+        """Emit one timer per stage, tagged by stage and source."""
+        for (name, source), duration in self.durations.items():
+            stage_tags = list(tags) + ['stage:' + name]
+            if source:
+                stage_tags.append('source:' + source)
+            stats_client.timing(
+                metric, int(round(duration * 1000)), tags=stage_tags)
+
+    def header(self):
+        """Return the stage durations as a `Server-Timing` header value."""
+        parts = []
+        for (name, source), duration in self.durations.items():
+            if source:
+                name = source + '.' + name
+            parts.append('%s;dur=%.1f' % (name, duration * 1000))
+        return ', '.join(parts)
+
+
 class DebugRavenClient(RavenClient):
     """An in-memory raven client with an inspectable message queue."""
 
@@ -240,7 +286,7 @@ class DebugStatsClient(StatsClient):
 
     def __init__(self, *args, **kw):
         super(DebugStatsClient, self).__init__(*args, **kw)
-        self.msgs = deque(maxlen=100)
+        self.msgs = deque(maxlen=1000)
 
     def _clear(self):
         self.msgs.clear()
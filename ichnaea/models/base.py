@@ -2,6 +2,8 @@
 Model and schema related common classes.
 """
 
+import operator
+
 import colander
 from sqlalchemy.ext.declarative import (
     declared_attr,
@@ -28,38 +30,43 @@ class BaseModel(object):
 _Model = declarative_base(cls=BaseModel)
 
 
-class HashableDict(object):
+class HashableDict(tuple):
     """
     A class representing a unique combination of fields, much like a
     namedtuple. Instances of this class can be used as dictionary keys.
+
+    Instances are immutable tuples of the field values in the order of
+    the _fields definition and have no per-instance `__dict__`. All
+    subclasses and mixins need to declare empty `__slots__` to keep it
+    that way.
     """
 
+    __slots__ = ()
     _fields = ()
 
-    def __init__(self, **kw):
-        for field in self._fields:
-            if field in kw:
-                setattr(self, field, kw[field])
-            else:
-                setattr(self, field, None)
+    def __new__(cls, **kw):
+        return tuple.__new__(cls, [kw.get(field) for field in cls._fields])
+
+    def __init_subclass__(cls, **kw):
+        super(HashableDict, cls).__init_subclass__(**kw)
+        # Add read-only accessors for the field positions of this class.
+        for index, field in enumerate(cls._fields):
+            if field not in cls.__dict__:
+                setattr(cls, field, property(operator.itemgetter(index)))
+
+    def __getnewargs_ex__(self):
+        return ((), dict(zip(self._fields, self)))
 
     def __eq__(self, other):
         if isinstance(other, HashableDict):
-            return self.__dict__ == other.__dict__
+            return (self._fields == other._fields and
+                    tuple.__eq__(self, other))
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
-    def __hash__(self):
-        """
-        Returns a hash of a tuple of the instance values in the same
-        order as the _fields definition.
-        """
-        value = ()
-        for field in self._fields:
-            value += (getattr(self, field, None), )
-        return hash(value)
+    __hash__ = tuple.__hash__
 
 
 class ValidationMixin(object):
@@ -67,6 +74,8 @@ class ValidationMixin(object):
     A mixin to tie a class and its valid colander schema together.
     """
 
+    __slots__ = ()
+
     _valid_schema = None
 
     @classmethod
@@ -90,6 +99,8 @@ class CreationMixin(ValidationMixin):
     keyword arguments before creating an instance of the class.
     """
 
+    __slots__ = ()
+
     @classmethod
     def create(cls, _raise_invalid=False, **kw):
         """
@@ -2,6 +2,8 @@
 This module contains database models for tables storing configuration.
 """
 
+from redis import RedisError
+from redis.client import Script
 from sqlalchemy import (
     Column,
     String,
@@ -10,9 +12,35 @@ from sqlalchemy.dialects.mysql import (
     INTEGER as Integer,
 )
 
+from ichnaea.config import DATA_QUEUE_EXPORT_LOG
 from ichnaea.models.base import _Model
 from ichnaea.models.sa_types import SetColumn
-from ichnaea.queue import DataQueue
+from ichnaea.queue import (
+    DataQueue,
+    StreamDataQueue,
+)
+
+# The key of the stream shared by all exports.
+EXPORT_LOG_KEY = 'export_log'
+
+# Remove the queue from the partition set, if the queue is empty.
+_PRUNE_PARTITION_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return redis.call('SREM', KEYS[1], KEYS[2])
+end
+return 0
+"""
+_PRUNE_PARTITION = Script(None, _PRUNE_PARTITION_SCRIPT)
+
+
+def export_log(redis_client, group=None, batch=0):
+    """
+    Return the queue shared by all exports, optionally as read by the
+    consumer group of one export.
+    """
+    return StreamDataQueue(EXPORT_LOG_KEY, redis_client,
+                           batch=batch, compress=False, json=True,
+                           partitions=1, group=group)
 
 
 class ExportConfig(_Model):
@@ -49,13 +77,57 @@ class ExportConfig(_Model):
         skip_sources = self.skip_sources or ()
         return api_key not in skip_keys and source not in skip_sources
 
-    def partitions(self, redis_client):
+    @property
+    def partitions_key(self):
+        # The set of all non-empty partitions of an s3 export.
+        return 'export_partitions:' + self.name
+
+    @property
+    def partitions_indexed_key(self):
+        # Marks the partitions of an s3 export as indexed.
+        return 'export_partitions_indexed:' + self.name
+
+    def add_partition(self, pipe, queue_key):
+        if self.schema == 's3':
+            pipe.sadd(self.partitions_key, queue_key)
+
+    def prune_partition(self, redis_client, queue_key):
+        if self.schema == 's3' and queue_key != EXPORT_LOG_KEY:
+            _PRUNE_PARTITION(keys=[self.partitions_key, queue_key],
+                             client=redis_client)
+
+    def index_partitions(self, redis_client):
+        """
+        Add partitions created before the partition set was maintained
+        to the set, by scanning the entire Redis keyspace.
+
+        This is a one-time migration, the first caller sets a marker
+        key in Redis and all later calls return right away.
+        """
+        if self.schema != 's3' or not redis_client.set(
+                self.partitions_indexed_key, 1, nx=True):
+            return
+        try:
+            keys = list(redis_client.scan_iter(
+                match='queue_export_%s:*' % self.name, count=100))
+            if keys:
+                redis_client.sadd(self.partitions_key, *keys)
+        except RedisError:  # pragma: no cover
+            # Let a later call retry the migration.
+            redis_client.delete(self.partitions_indexed_key)
+            raise
+
+    def partitions(self, redis_client, shared=DATA_QUEUE_EXPORT_LOG):
         if self.schema == 's3':
             # e.g. ['queue_export_something:api_key']
-            return [key.decode('utf-8') for key in
-                    redis_client.scan_iter(
-                        match='queue_export_%s:*' % self.name, count=100)]
-        return ['queue_export_' + self.name]
+            result = sorted(key.decode('utf-8') for key in
+                            redis_client.smembers(self.partitions_key))
+        else:
+            result = ['queue_export_' + self.name]
+        if shared:
+            # The per-export queues might still contain older data.
+            result.append(EXPORT_LOG_KEY)
+        return result
 
     def queue_key(self, api_key, source='gnss'):
         if self.schema == 's3':
@@ -65,5 +137,7 @@ class ExportConfig(_Model):
         return 'queue_export_' + self.name
 
     def queue(self, queue_key, redis_client):
+        if queue_key == EXPORT_LOG_KEY:
+            return export_log(redis_client, group=self.name, batch=self.batch)
         return DataQueue(queue_key, redis_client,
                          batch=self.batch, compress=False, json=True)
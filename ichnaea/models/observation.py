@@ -1,7 +1,9 @@
 import math
 import operator
+import struct
 
 import colander
+import numpy
 
 from ichnaea.geocode import GEOCODER
 from ichnaea.models import (
@@ -24,6 +26,8 @@ from ichnaea.models.base import (
 )
 from ichnaea.models.mac import (
     channel_frequency,
+    decode_mac,
+    encode_mac,
     MacNode,
 )
 from ichnaea.models.schema import (
@@ -34,10 +38,83 @@ from ichnaea.models.schema import (
 )
 from ichnaea.models.wifi import WifiShard
 
+BINARY_VERSION = 1
+PARTIAL_VERSION = 2
+_BINARY_TYPES = {
+    'B': 'u1',
+    'b': 'i1',
+    'h': '<i2',
+    'i': '<i4',
+    'I': '<u4',
+    'd': '<f8',
+}
+_BINARY_FIELDS = (
+    ('lat', 'd'),
+    ('lon', 'd'),
+    ('accuracy', 'd'),
+    ('speed', 'd'),
+    ('age', 'i'),
+    ('signal', 'h'),
+    ('source', 'b'),
+)
+_PARTIAL_FIELDS = (
+    ('source', 'b'),
+    ('samples', 'I'),
+    ('weight', 'd'),
+    ('lat', 'd'),
+    ('lon', 'd'),
+    ('min_lat', 'd'),
+    ('max_lat', 'd'),
+    ('min_lon', 'd'),
+    ('max_lon', 'd'),
+    # Upper bound of the distance in meters of any observation to the
+    # weighted center (lat, lon).
+    ('spread', 'd'),
+)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Return the approximate distance in meters between arrays of points,
+    on a sphere with the mean earth radius.
+    """
+    lat1, lon1, lat2, lon2 = (
+        numpy.radians(value) for value in (lat1, lon1, lat2, lon2))
+    dist = (numpy.sin((lat2 - lat1) / 2.0) ** 2 +
+            numpy.cos(lat1) * numpy.cos(lat2) *
+            numpy.sin((lon2 - lon1) / 2.0) ** 2)
+    return 2.0 * 6371009.0 * numpy.arcsin(numpy.fmin(1.0, numpy.sqrt(dist)))
+
+
+def _binary_layout(key, size, extra=(), fields=_BINARY_FIELDS):
+    """
+    Return a struct and a matching NumPy dtype for a binary record
+    starting with a version byte and the key bytes.
+    """
+    fields = (('version', 'B'), (key, '%ss' % size)) + fields + extra
+    fmt = '<' + ''.join([code for _, code in fields])
+    dtype = [(key, 'u1', (size, )) if name == key else
+             (name, _BINARY_TYPES[code]) for name, code in fields]
+    return (struct.Struct(fmt), numpy.dtype(dtype))
+
+
+def _binary_int(value, code):
+    if value is None:
+        return -2 ** (struct.calcsize(code) * 8 - 1)
+    return int(value)
+
+
+def _binary_float(value):
+    if value is None:
+        return float('nan')
+    return value
+
 
 class BaseReport(HashableDict, CreationMixin, ValidationMixin):
     """A base class for reports."""
 
+    __slots__ = ()
+
     _comparators = ()
 
     def better(self, other):
@@ -52,7 +129,28 @@ class BaseReport(HashableDict, CreationMixin, ValidationMixin):
 
 
 class BaseObservation(object):
-    """A base class for observations."""
+    """
+    A base class for observations.
+
+    Observations can be encoded as compact binary records, with a fixed
+    layout of a version byte, the key bytes and the values needed to
+    calculate the observation weight. Missing integer values are stored
+    as the minimum value of their type, missing float values as NaN.
+
+    Many observations of the same station and source can be combined
+    into one partial aggregate record, holding the weighted mean
+    position, the bounding box, the weight sum and the number of
+    observations. Partial records start with a different version byte
+    and keep the last known value of the extra binary fields.
+    """
+
+    __slots__ = ()
+
+    _binary_key = None  # (field name, size in bytes)
+    _binary_struct = None
+    _binary_dtype = None
+    _binary_extra = ()
+    _partial_dtype = None
 
     @classmethod
     def _from_json_value(cls, dct):
@@ -80,6 +178,175 @@ class BaseObservation(object):
     def to_json(self):
         return self._to_json_value()
 
+    @classmethod
+    def _array_dtype(cls):
+        return numpy.dtype(cls._binary_dtype.descr + [('weight', '<f8')])
+
+    @classmethod
+    def _decode_binary_key(cls, value):  # pragma: no cover
+        raise NotImplementedError()
+
+    def _encode_binary_key(self):  # pragma: no cover
+        raise NotImplementedError()
+
+    @classmethod
+    def _weights(cls, records):  # pragma: no cover
+        raise NotImplementedError()
+
+    def to_binary(self):
+        """Return the observation encoded as a binary record."""
+        values = [BINARY_VERSION, self._encode_binary_key()]
+        for name, code in _BINARY_FIELDS + self._binary_extra:
+            value = getattr(self, name, None)
+            if code == 'd':
+                values.append(_binary_float(value))
+            else:
+                values.append(_binary_int(value, code))
+        return self._binary_struct.pack(*values)
+
+    @staticmethod
+    def is_binary(value):
+        """Is the value a binary record, as opposed to JSON?"""
+        return value[:1] == bytes((BINARY_VERSION, ))
+
+    @classmethod
+    def decode_binary(cls, values):
+        """
+        Decode a list of binary records into a NumPy structured array,
+        with an additional `weight` column for the observation weights.
+        """
+        result = numpy.zeros(len(values), dtype=cls._array_dtype())
+        if values:
+            records = numpy.frombuffer(
+                b''.join(values), dtype=cls._binary_dtype)
+            for name in cls._binary_dtype.names:
+                result[name] = records[name]
+            result['weight'] = cls._weights(result)
+        return result
+
+    @classmethod
+    def binary_keys(cls, records):
+        """
+        Return the list of unique keys for a structured array of
+        decoded binary or partial records.
+        """
+        name, size = cls._binary_key
+        value = records[name].tobytes()
+        return [cls._decode_binary_key(value[i:i + size])
+                for i in range(0, len(value), size)]
+
+    @staticmethod
+    def is_partial(value):
+        """Is the value a partial aggregate record?"""
+        return value[:1] == bytes((PARTIAL_VERSION, ))
+
+    @classmethod
+    def to_partials(cls, records):
+        """
+        Convert a structured array of decoded binary records into
+        partial aggregates of one observation each.
+        """
+        name, _ = cls._binary_key
+        result = numpy.zeros(len(records), dtype=cls._partial_dtype)
+        result['version'] = PARTIAL_VERSION
+        for field in (name, 'source', 'weight', 'lat', 'lon'):
+            result[field] = records[field]
+        for field, _ in cls._binary_extra:
+            result[field] = records[field]
+        result['samples'] = 1
+        result['min_lat'] = result['max_lat'] = records['lat']
+        result['min_lon'] = result['max_lon'] = records['lon']
+        return result
+
+    @classmethod
+    def group_partials(cls, partials, by_source=True):
+        """
+        Sort the partial aggregates by key and optionally by source,
+        keeping the order of partials within the same group.
+
+        Returns the sorted partials and the index of the first partial
+        of each group.
+        """
+        name, size = cls._binary_key
+        group_keys = partials[name]
+        if by_source:
+            size += 1
+            group_keys = numpy.concatenate(
+                (group_keys, partials['source'].view('u1')[:, None]),
+                axis=1)
+        group_keys = numpy.ascontiguousarray(group_keys).view(
+            'V%s' % size).ravel()
+        order = numpy.argsort(group_keys, kind='mergesort')
+        partials = partials[order]
+        group_keys = group_keys[order]
+        starts = numpy.flatnonzero(group_keys[1:] != group_keys[:-1]) + 1
+        if len(partials):
+            starts = numpy.insert(starts, 0, 0)
+        return (partials, starts)
+
+    @classmethod
+    def reduce_partials(cls, partials, starts):
+        """
+        Combine sorted partial aggregates into one per group, given
+        the index of the first partial of each group.
+        """
+        result = partials[starts].copy()
+        if not len(starts):
+            return result
+        weights = partials['weight']
+        result['weight'] = numpy.add.reduceat(weights, starts)
+        result['samples'] = numpy.add.reduceat(partials['samples'], starts)
+        for field in ('lat', 'lon'):
+            result[field] = numpy.add.reduceat(
+                partials[field] * weights, starts) / result['weight']
+        # The observations of each partial are within its spread of its
+        # center, so within the center distance plus spread of the
+        # combined center.
+        groups = numpy.repeat(numpy.arange(len(starts)), numpy.diff(
+            numpy.append(starts, len(partials))))
+        result['spread'] = numpy.maximum.reduceat(
+            haversine(partials['lat'], partials['lon'],
+                      result['lat'][groups], result['lon'][groups]) +
+            partials['spread'], starts)
+        for field, func in (('min_lat', numpy.minimum),
+                            ('max_lat', numpy.maximum),
+                            ('min_lon', numpy.minimum),
+                            ('max_lon', numpy.maximum)):
+            result[field] = func.reduceat(partials[field], starts)
+        for field, _ in cls._binary_extra:
+            # Keep the last value which isn't missing.
+            values = partials[field]
+            missing = numpy.iinfo(values.dtype).min
+            last = numpy.maximum.reduceat(numpy.where(
+                values != missing, numpy.arange(len(values)), -1), starts)
+            result[field] = numpy.where(last >= 0, values[last], missing)
+        return result
+
+    @classmethod
+    def merge_partials(cls, partials):
+        """
+        Combine the partial aggregates for the same key and source
+        into one. Partials without any weight are dropped.
+        """
+        partials = partials[partials['weight'] > 0.0]
+        return cls.reduce_partials(*cls.group_partials(partials))
+
+    @classmethod
+    def encode_partials(cls, partials):
+        """Return a list of binary values for the partial aggregates."""
+        value = partials.tobytes()
+        size = cls._partial_dtype.itemsize
+        return [value[i:i + size] for i in range(0, len(value), size)]
+
+    @classmethod
+    def decode_partials(cls, values):
+        """
+        Decode a list of binary partial aggregates into a NumPy
+        structured array.
+        """
+        return numpy.frombuffer(
+            b''.join(values), dtype=cls._partial_dtype).copy()
+
 
 class ValidReportSchema(colander.MappingSchema, ValidatorNode):
     """A schema which validates the fields present in a report."""
@@ -127,6 +394,8 @@ class ValidReportSchema(colander.MappingSchema, ValidatorNode):
 class Report(BaseReport):
     """A class for report data."""
 
+    __slots__ = ()
+
     _max_observation_accuracy = constants.MAX_OBSERVATION_ACCURACY
     _valid_schema = ValidReportSchema()
     _fields = (
@@ -146,7 +415,7 @@ class Report(BaseReport):
     def combine(cls, *reports):
         values = {}
         for report in reports:
-            values.update(report.__dict__)
+            values.update(zip(report._fields, report))
         return cls(**values)
 
     @property
@@ -185,6 +454,32 @@ class Report(BaseReport):
             return 0.0
         return min(math.sqrt(5.0 / speed), 1.0)
 
+    @classmethod
+    def _base_weights(cls, records):
+        """
+        Return the base weights for a structured array of records,
+        matching the :attr:`base_weight` of each record.
+        """
+        accuracy = numpy.fmax(numpy.abs(records['accuracy']), 10.0)
+        accuracy_weights = numpy.where(
+            accuracy > cls._max_observation_accuracy,
+            0.0, numpy.sqrt(10 / accuracy))
+
+        age = records['age']
+        missing = age == numpy.iinfo(age.dtype).min
+        age = numpy.fmax(numpy.abs(age.astype(numpy.double)), 2000.0)
+        age[missing] = 2000.0
+        age_weights = numpy.where(
+            age > constants.MAX_OBSERVATION_AGE,
+            0.0, numpy.fmin(numpy.sqrt(2000.0 / age), 1.0))
+
+        speed = numpy.fmax(numpy.abs(records['speed']), 1.0)
+        speed_weights = numpy.where(
+            speed > constants.MAX_OBSERVATION_SPEED,
+            0.0, numpy.fmin(numpy.sqrt(5.0 / speed), 1.0))
+
+        return accuracy_weights * age_weights * speed_weights
+
 
 class ValidBlueReportSchema(colander.MappingSchema, ValidatorNode):
     """A schema which validates the Bluetooth specific fields in a report."""
@@ -207,6 +502,8 @@ class ValidBlueReportSchema(colander.MappingSchema, ValidatorNode):
 class BlueReport(BaseReport):
     """A class for Bluetooth report data."""
 
+    __slots__ = ()
+
     _max_observation_accuracy = constants.BLUE_MAX_OBSERVATION_ACCURACY
     _valid_schema = ValidBlueReportSchema()
     _fields = (
@@ -239,14 +536,31 @@ class ValidBlueObservationSchema(ValidBlueReportSchema, ValidReportSchema):
 class BlueObservation(BlueReport, Report, BaseObservation):
     """A class for Bluetooth observation data."""
 
+    __slots__ = ()
+
     _valid_schema = ValidBlueObservationSchema()
     _fields = BlueReport._fields + Report._fields
+    _binary_key = ('mac', 6)
+    _binary_struct, _binary_dtype = _binary_layout(*_binary_key)
+    _partial_dtype = _binary_layout(*_binary_key, fields=_PARTIAL_FIELDS)[1]
+
+    @classmethod
+    def _decode_binary_key(cls, value):
+        return decode_mac(value)
+
+    def _encode_binary_key(self):
+        return encode_mac(self.mac)
 
     @property
     def weight(self):
         signal_weight = 1.0
         return signal_weight * self.base_weight
 
+    @classmethod
+    def _weights(cls, records):
+        signal_weights = 1.0
+        return signal_weights * cls._base_weights(records)
+
 
 class ValidCellReportSchema(ValidCellKeySchema):
     """A schema which validates the cell specific fields in a report."""
@@ -340,6 +654,8 @@ class ValidCellReportSchema(ValidCellKeySchema):
 class CellReport(BaseReport):
     """A class for cell report data."""
 
+    __slots__ = ()
+
     _max_observation_accuracy = constants.CELL_MAX_OBSERVATION_ACCURACY
     _valid_schema = ValidCellReportSchema()
     _fields = (
@@ -396,8 +712,34 @@ class ValidCellObservationSchema(ValidCellReportSchema, ValidReportSchema):
 class CellObservation(CellReport, Report, BaseObservation):
     """A class for cell observation data."""
 
+    __slots__ = ()
+
     _valid_schema = ValidCellObservationSchema()
     _fields = CellReport._fields + Report._fields
+    _binary_key = ('cellid', 11)
+    _binary_extra = (('psc', 'h'), )
+    _binary_struct, _binary_dtype = _binary_layout(
+        *_binary_key, extra=_binary_extra)
+    _partial_dtype = _binary_layout(
+        *_binary_key, extra=_binary_extra, fields=_PARTIAL_FIELDS)[1]
+    _signal_offsets = {
+        # GSM median signal is -95
+        # Map -113: 0.52, -95: 1.0, -79: 2.0, -51: 10.2
+        Radio.gsm: (-95, -5.0),
+        # WCDMA median signal is -100
+        # Map -121: 0.47, -100: 1.0, -80: 2.4, -50: 16, -25: 256
+        Radio.wcdma: (-100, 0.0),
+        # LTE median signal is -105
+        # Map -140: 0.3, -105: 1.0, -89: 2.0, -55: 16.0, -43: 48.0
+        Radio.lte: (-105, 5.0),
+    }
+
+    @classmethod
+    def _decode_binary_key(cls, value):
+        return value
+
+    def _encode_binary_key(self):
+        return self.cellid
 
     @classmethod
     def _from_json_value(cls, dct):
@@ -414,24 +756,32 @@ class CellObservation(CellReport, Report, BaseObservation):
 
     @property
     def weight(self):
-        offsets = {
-            # GSM median signal is -95
-            # Map -113: 0.52, -95: 1.0, -79: 2.0, -51: 10.2
-            Radio.gsm: (-95, -5.0),
-            # WCDMA median signal is -100
-            # Map -121: 0.47, -100: 1.0, -80: 2.4, -50: 16, -25: 256
-            Radio.wcdma: (-100, 0.0),
-            # LTE median signal is -105
-            # Map -140: 0.3, -105: 1.0, -89: 2.0, -55: 16.0, -43: 48.0
-            Radio.lte: (-105, 5.0),
-        }
-        default, offset = offsets.get(self.radio, (None, 0.0))
+        default, offset = self._signal_offsets.get(self.radio, (None, 0.0))
         signal = self.signal if self.signal is not None else default
         signal_weight = 1.0
         if signal is not None:
             signal_weight = ((1.0 / (signal + offset) ** 2) * 10000) ** 2
         return signal_weight * self.base_weight
 
+    @classmethod
+    def _weights(cls, records):
+        # The first byte of the cellid is the radio type.
+        radio = records['cellid'][:, 0]
+        default = numpy.full(len(records), numpy.nan)
+        offset = numpy.zeros(len(records))
+        for key, (radio_default, radio_offset) in cls._signal_offsets.items():
+            match = radio == int(key)
+            default[match] = radio_default
+            offset[match] = radio_offset
+
+        signal = records['signal']
+        signal = numpy.where(
+            signal == numpy.iinfo(signal.dtype).min, default, signal)
+        signal_weights = numpy.where(
+            numpy.isnan(signal),
+            1.0, ((1.0 / (signal + offset) ** 2) * 10000) ** 2)
+        return signal_weights * cls._base_weights(records)
+
 
 class ValidWifiReportSchema(colander.MappingSchema, ValidatorNode):
     """A schema which validates the wifi specific fields in a report."""
@@ -486,6 +836,8 @@ class ValidWifiReportSchema(colander.MappingSchema, ValidatorNode):
 class WifiReport(BaseReport):
     """A class for wifi report data."""
 
+    __slots__ = ()
+
     _max_observation_accuracy = constants.WIFI_MAX_OBSERVATION_ACCURACY
     _valid_schema = ValidWifiReportSchema()
     _fields = (
@@ -522,8 +874,20 @@ class ValidWifiObservationSchema(ValidWifiReportSchema, ValidReportSchema):
 class WifiObservation(WifiReport, Report, BaseObservation):
     """A class for wifi observation data."""
 
+    __slots__ = ()
+
     _valid_schema = ValidWifiObservationSchema()
     _fields = WifiReport._fields + Report._fields
+    _binary_key = ('mac', 6)
+    _binary_struct, _binary_dtype = _binary_layout(*_binary_key)
+    _partial_dtype = _binary_layout(*_binary_key, fields=_PARTIAL_FIELDS)[1]
+
+    @classmethod
+    def _decode_binary_key(cls, value):
+        return decode_mac(value)
+
+    def _encode_binary_key(self):
+        return encode_mac(self.mac)
 
     @property
     def weight(self):
@@ -532,3 +896,11 @@ class WifiObservation(WifiReport, Report, BaseObservation):
         # Maps -100: ~0.5, -80: 1.0, -60: 2.4, -30: 16, -10: ~123
         signal_weight = ((1.0 / (signal - 20.0) ** 2) * 10000) ** 2
         return signal_weight * self.base_weight
+
+    @classmethod
+    def _weights(cls, records):
+        signal = records['signal']
+        signal = numpy.where(
+            signal == numpy.iinfo(signal.dtype).min, -80, signal)
+        signal_weights = ((1.0 / (signal - 20.0) ** 2) * 10000) ** 2
+        return signal_weights * cls._base_weights(records)
@@ -1,3 +1,6 @@
+import copy
+import pickle
+
 import pytest
 
 from ichnaea.models.base import HashableDict
@@ -5,11 +8,13 @@ from ichnaea.models.base import HashableDict
 
 class Single(HashableDict):
 
+    __slots__ = ()
     _fields = ('one', )
 
 
 class Double(HashableDict):
 
+    __slots__ = ()
     _fields = ('one', 'two')
 
 
@@ -71,3 +76,21 @@ class TestHashableDict(object):
         assert empty is not None
         assert empty != {}
         assert empty != object()
+
+    def test_immutable(self):
+        single = Single(one=1)
+        with pytest.raises(AttributeError):
+            single.one = 2
+        with pytest.raises(AttributeError):
+            single.extra = 2
+        assert not hasattr(single, '__dict__')
+
+    def test_tuple(self):
+        double = Double(one=1)
+        assert double != (1, None)
+        assert hash(double) == hash((1, None))
+
+    def test_copy(self):
+        double = Double(one=1, two='two')
+        assert copy.copy(double) == double
+        assert pickle.loads(pickle.dumps(double)) == double
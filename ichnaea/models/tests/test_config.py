@@ -90,3 +90,40 @@ class TestExportConfig(object):
         test('one', frozenset(['ab']))
         test('two', frozenset(['ab', 'cd']))
         test('unicode', frozenset(['ab', non_ascii]))
+
+    def test_partitions(self, redis):
+        config = ExportConfig(name='backup', batch=2, schema='s3')
+        redis.rpush('queue_export_backup:gnss:old', 'a')
+        config.index_partitions(redis)
+        assert config.partitions(redis, shared=False) == [
+            'queue_export_backup:gnss:old']
+        # The keyspace is only scanned once.
+        redis.rpush('queue_export_backup:gnss:older', 'a')
+        config.index_partitions(redis)
+        assert config.partitions(redis, shared=False) == [
+            'queue_export_backup:gnss:old']
+
+        queue_key = config.queue_key('test')
+        with redis.pipeline() as pipe:
+            config.queue(queue_key, redis).enqueue(['b'], pipe=pipe)
+            config.add_partition(pipe, queue_key)
+            pipe.execute()
+        assert config.partitions(redis, shared=False) == [
+            'queue_export_backup:gnss:old', queue_key]
+
+        config.prune_partition(redis, queue_key)
+        assert len(config.partitions(redis, shared=False)) == 2
+        config.queue(queue_key, redis).dequeue()
+        config.prune_partition(redis, queue_key)
+        assert config.partitions(redis, shared=False) == [
+            'queue_export_backup:gnss:old']
+
+    def test_partitions_single(self, redis):
+        config = ExportConfig(name='test', batch=2, schema='dummy')
+        config.index_partitions(redis)
+        with redis.pipeline() as pipe:
+            config.add_partition(pipe, 'queue_export_test')
+            pipe.execute()
+        config.prune_partition(redis, 'queue_export_test')
+        assert redis.keys('export_partitions*') == []
+        assert config.partitions(redis, shared=False) == ['queue_export_test']
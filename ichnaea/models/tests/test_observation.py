@@ -1,3 +1,4 @@
+import numpy
 import simplejson
 
 from ichnaea.conftest import (
@@ -17,6 +18,7 @@ from ichnaea.models import (
     WifiObservation,
     WifiReport,
 )
+from ichnaea.models.observation import haversine
 from ichnaea.tests.factories import (
     BlueObservationFactory,
     CellObservationFactory,
@@ -30,6 +32,21 @@ class BaseTest(object):
         assert self.sample(**{name: value})[name] == expect
 
 
+class BaseObservationTest(object):
+
+    def check_binary_weights(self, observations):
+        obs_model = type(observations[0])
+        records = obs_model.decode_binary(
+            [obs.to_binary() for obs in observations])
+        assert list(records['weight']) == [obs.weight for obs in observations]
+
+    def partials(self, observations):
+        obs_model = type(observations[0])
+        return obs_model.merge_partials(obs_model.to_partials(
+            obs_model.decode_binary(
+                [obs.to_binary() for obs in observations])))
+
+
 class TestReport(BaseTest):
 
     def sample(self, **kwargs):
@@ -103,7 +120,7 @@ class TestReport(BaseTest):
         self.compare(field, constants.MAX_TIMESTAMP + 1, None)
 
 
-class TestBlueObservation(BaseTest):
+class TestBlueObservation(BaseTest, BaseObservationTest):
 
     def test_fields(self):
         mac = '3680873e9b83'
@@ -134,6 +151,44 @@ class TestBlueObservation(BaseTest):
         assert result.source is ReportSource.gnss
         assert type(result.source) is ReportSource
 
+    def test_binary(self):
+        obs = BlueObservationFactory.build(
+            mac='3680873e9b00', accuracy=None, age=-2000,
+            signal=-45, source=ReportSource.gnss)
+        value = obs.to_binary()
+        assert len(value) == 46
+        assert BlueObservation.is_binary(value)
+        assert not BlueObservation.is_binary(
+            simplejson.dumps(obs.to_json()).encode('utf-8'))
+
+        records = BlueObservation.decode_binary([value, value])
+        assert len(records) == 2
+        assert BlueObservation.binary_keys(records) == [obs.mac, obs.mac]
+        record = records[0]
+        assert record['lat'] == obs.lat
+        assert record['lon'] == obs.lon
+        assert numpy.isnan(record['accuracy'])
+        assert record['age'] == -2000
+        assert record['signal'] == -45
+        assert record['source'] == ReportSource.gnss
+        assert record['weight'] == obs.weight
+
+    def test_binary_empty(self):
+        records = BlueObservation.decode_binary([])
+        assert len(records) == 0
+        assert BlueObservation.binary_keys(records) == []
+
+    def test_binary_weight(self):
+        obs_factory = BlueObservationFactory.build
+        self.check_binary_weights([
+            obs_factory(accuracy=None, age=None, speed=None),
+            obs_factory(accuracy=0.0, age=-1000, speed=0.0),
+            obs_factory(accuracy=40.0, age=8000, speed=20.0),
+            obs_factory(accuracy=100.1),
+            obs_factory(age=20001),
+            obs_factory(speed=51.0),
+        ])
+
     def test_weight(self):
         obs_factory = BlueObservationFactory.build
         assert round(obs_factory(accuracy=None).weight, 2) == 1.0
@@ -183,7 +238,7 @@ class TestBlueReport(BaseTest):
         self.compare(field, constants.MAX_BLUE_SIGNAL + 1, None)
 
 
-class TestCellObservation(BaseTest):
+class TestCellObservation(BaseTest, BaseObservationTest):
 
     def test_fields(self):
         obs = CellObservation.create(
@@ -232,6 +287,54 @@ class TestCellObservation(BaseTest):
         assert result.source is ReportSource.fixed
         assert type(result.source) is ReportSource
 
+    def test_binary(self):
+        obs = CellObservationFactory.build(
+            radio=Radio.lte, cid=23552, psc=None, signal=None, source=None)
+        value = obs.to_binary()
+        assert len(value) == 53
+        assert CellObservation.is_binary(value)
+
+        records = CellObservation.decode_binary([value])
+        assert CellObservation.binary_keys(records) == [obs.cellid]
+        record = records[0]
+        assert record['lat'] == obs.lat
+        assert record['lon'] == obs.lon
+        assert record['psc'] == numpy.iinfo(numpy.int16).min
+        assert record['signal'] == numpy.iinfo(numpy.int16).min
+        assert record['source'] == -128
+        assert record['weight'] == obs.weight
+
+    def test_partials(self):
+        obs = CellObservationFactory.build(radio=Radio.wcdma)
+        other = CellObservationFactory.build(
+            radio=Radio.gsm, mcc=obs.mcc, mnc=obs.mnc, lac=obs.lac,
+            cid=obs.cid)
+        later = CellObservationFactory.build(
+            radio=obs.radio, mcc=obs.mcc, mnc=obs.mnc, lac=obs.lac,
+            cid=obs.cid, psc=obs.psc + 1)
+        missing = CellObservationFactory.build(
+            radio=obs.radio, mcc=obs.mcc, mnc=obs.mnc, lac=obs.lac,
+            cid=obs.cid, psc=None)
+        partials = self.partials([obs, other, later, missing])
+        assert len(partials) == 2
+        assert (sorted(CellObservation.binary_keys(partials)) ==
+                sorted([obs.cellid, other.cellid]))
+        assert sorted(partials['samples']) == [1, 3]
+        assert sorted(partials['psc']) == sorted([other.psc, obs.psc + 1])
+        assert len(CellObservation.encode_partials(partials)[0]) == 83
+
+    def test_binary_weight(self):
+        obs_factory = CellObservationFactory.build
+        self.check_binary_weights([
+            obs_factory(radio=Radio.gsm, signal=None),
+            obs_factory(radio=Radio.gsm, accuracy=160.0, signal=-51),
+            obs_factory(radio=Radio.gsm, accuracy=1000.1, signal=-95),
+            obs_factory(radio=Radio.wcdma, signal=None),
+            obs_factory(radio=Radio.wcdma, signal=-121, age=5000),
+            obs_factory(radio=Radio.lte, signal=None, speed=20.0),
+            obs_factory(radio=Radio.lte, signal=-43, accuracy=None),
+        ])
+
     def test_weight(self):
         obs_factory = CellObservationFactory.build
 
@@ -427,7 +530,7 @@ class TestCellReport(BaseTest):
         assert self.sample(radio=Radio.lte, ta=1)['ta'] == 1
 
 
-class TestWifiObservation(BaseTest):
+class TestWifiObservation(BaseTest, BaseObservationTest):
 
     def test_invalid(self):
         assert WifiObservation.create(
@@ -467,6 +570,96 @@ class TestWifiObservation(BaseTest):
         assert result.source == ReportSource.query
         assert type(result.source) is ReportSource
 
+    def test_binary(self):
+        obs = WifiObservationFactory.build(
+            accuracy=12.5, speed=None, source=ReportSource.query)
+        value = obs.to_binary()
+        assert len(value) == 46
+        assert WifiObservation.is_binary(value)
+
+        records = WifiObservation.decode_binary([value])
+        assert WifiObservation.binary_keys(records) == [obs.mac]
+        record = records[0]
+        assert record['accuracy'] == 12.5
+        assert numpy.isnan(record['speed'])
+        assert record['source'] == ReportSource.query
+        assert record['weight'] == obs.weight
+
+    def test_partials(self):
+        obs_factory = WifiObservationFactory.build
+        obs = obs_factory(source=ReportSource.gnss, signal=-80)
+        observations = [
+            obs,
+            obs_factory(mac=obs.mac, lat=obs.lat + 0.002, lon=obs.lon,
+                        source=ReportSource.gnss, signal=-60),
+            obs_factory(mac=obs.mac, lat=obs.lat, lon=obs.lon - 0.001,
+                        source=ReportSource.query),
+            obs_factory(source=ReportSource.gnss),
+            obs_factory(source=ReportSource.gnss, accuracy=10000.0),
+        ]
+        partials = self.partials(observations)
+        assert len(partials) == 3
+        assert sorted(partials['samples']) == [1, 1, 2]
+
+        values = WifiObservation.encode_partials(partials)
+        assert len(values[0]) == 76
+        assert WifiObservation.is_partial(values[0])
+        assert not WifiObservation.is_binary(values[0])
+        assert not WifiObservation.is_partial(obs.to_binary())
+
+        records = WifiObservation.decode_partials(values)
+        assert records.tobytes() == partials.tobytes()
+        keys = WifiObservation.binary_keys(records)
+        assert keys.count(obs.mac) == 2
+        index = [i for i, key in enumerate(keys) if key == obs.mac and
+                 records['source'][i] == ReportSource.gnss][0]
+        record = records[index]
+        weights = [observations[0].weight, observations[1].weight]
+        assert record['samples'] == 2
+        assert round(record['weight'], 7) == round(sum(weights), 7)
+        assert round(record['lat'], 7) == round(
+            (obs.lat * weights[0] + (obs.lat + 0.002) * weights[1]) /
+            sum(weights), 7)
+        assert round(record['lon'], 7) == obs.lon
+        assert record['min_lat'] == obs.lat
+        assert record['max_lat'] == obs.lat + 0.002
+        assert record['min_lon'] == record['max_lon'] == obs.lon
+        # The spread is the distance of the farthest observation.
+        assert round(record['spread'], 3) == round(max(
+            haversine(lat, obs.lon, record['lat'], record['lon'])
+            for lat in (obs.lat, obs.lat + 0.002)), 3)
+        assert sorted(records['spread'])[:2] == [0.0, 0.0]
+
+        # Combining partials again keeps an upper bound.
+        merged = WifiObservation.merge_partials(numpy.concatenate((
+            WifiObservation.to_partials(WifiObservation.decode_binary(
+                [obs_factory(mac=obs.mac, lat=obs.lat - 0.001, lon=obs.lon,
+                             source=ReportSource.gnss).to_binary()])),
+            records[index:index + 1])))
+        assert len(merged) == 1
+        assert merged['spread'][0] >= max(
+            haversine(lat, obs.lon, merged['lat'][0], merged['lon'][0])
+            for lat in (obs.lat - 0.001, obs.lat, obs.lat + 0.002))
+
+    def test_partials_empty(self):
+        records = WifiObservation.decode_binary([])
+        partials = WifiObservation.merge_partials(
+            WifiObservation.to_partials(records))
+        assert len(partials) == 0
+        assert WifiObservation.encode_partials(partials) == []
+        assert len(WifiObservation.decode_partials([])) == 0
+
+    def test_binary_weight(self):
+        obs_factory = WifiObservationFactory.build
+        self.check_binary_weights([
+            obs_factory(accuracy=None, signal=None),
+            obs_factory(accuracy=200.1, signal=-80),
+            obs_factory(accuracy=10, signal=-100),
+            obs_factory(accuracy=100, signal=-10),
+            obs_factory(accuracy=0, age=5000, speed=20.0),
+            obs_factory(accuracy=0, age=20001, speed=50.1),
+        ])
+
     def test_weight(self):
         obs_factory = WifiObservationFactory.build
         assert round(obs_factory(accuracy=None, signal=-80).weight, 2) == 1.0
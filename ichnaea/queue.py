@@ -2,11 +2,315 @@
 Functionality related to custom Redis based queues.
 """
 
-import simplejson
+from collections import namedtuple
+import random
+import struct
+import threading
+import time
+from uuid import uuid4
+import zlib
+
+from redis import ResponseError
 
 from ichnaea.cache import redis_pipeline
+from ichnaea import codec
 from ichnaea import util
 
+# A preset zlib dictionary of strings common in queued reports. The
+# most common strings are at the end. Frames compressed with it are
+# marked with their own codec id, so it must never change. Add a new
+# dictionary and codec id instead.
+REPORT_DICTIONARY = (
+    b'"carrier": "homeMobileCountryCode": "homeMobileNetworkCode": '
+    b'"name": "ssid": "serving": 0, "serving": 1, "timingAdvance": '
+    b'"altitudeAccuracy": "heading": "pressure": "speed": '
+    b'"source": "fused"}, "source": "fixed"}, "source": "query"}, '
+    b'"bluetoothBeacons": [{"macAddress": "'
+    b'"radioType": "lte", "radioType": "wcdma", "radioType": "gsm", '
+    b'"cellTowers": [{"radioType": "gsm", "mobileCountryCode": '
+    b'"mobileNetworkCode": "locationAreaCode": "cellId": "asu": '
+    b'"primaryScramblingCode": "frequency": "channel": '
+    b'"signalToNoiseRatio": "age": "altitude": "accuracy": '
+    b'{"api_key": "test", "report": {"timestamp": 1, "position": '
+    b'{"latitude": 5, "longitude": 1, "accuracy": 10.0, '
+    b'"source": "gnss"}, "wifiAccessPoints": [{"macAddress": "'
+    b'"signalStrength": -"}, {"macAddress": "'
+    b'"}], "source": "gnss"}'
+)
+
+# Frames start with a codec id byte of 0xf0 or above, which neither
+# JSON, gzip nor binary observation records do, followed by the number
+# of items in the frame.
+FRAME_CODECS = {
+    'zlib': (0xf1, None),
+    'report': (0xf2, REPORT_DICTIONARY),
+}
+_FRAME_DICTIONARIES = dict(FRAME_CODECS.values())
+_FRAME_HEADER = struct.Struct('!BI')
+_ITEM_LENGTH = struct.Struct('!I')
+
+# Pop frames from the head of the list, until they contain at least
+# the given batch number of items or the list is empty. A batch of
+# zero pops all frames. Entries which aren't frames count as single
+# items. Returns the list of frames and updates the item count key.
+_DEQUEUE_FRAMES_SCRIPT = """
+local batch = tonumber(ARGV[1])
+local frames = {}
+local count = 0
+while batch == 0 or count < batch do
+    local frame = redis.call('LPOP', KEYS[1])
+    if not frame then
+        break
+    end
+    frames[#frames + 1] = frame
+    if string.byte(frame, 1) >= 240 then
+        local a, b, c, d = string.byte(frame, 2, 5)
+        count = count + ((a * 256 + b) * 256 + c) * 256 + d
+    else
+        count = count + 1
+    end
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[2])
+elseif count > 0 then
+    redis.call('DECRBY', KEYS[2], count)
+end
+return frames
+"""
+
+# A hash counting all items put into each queue, by queue key.
+ENQUEUED_KEY = 'queue_enqueued'
+
+# Delete the lock key, if it still holds the given token.
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Reserve a batch of items for processing. Expired batches in the
+# processing set are claimed first, batches delivered too often are
+# moved to the dead letter list instead. Otherwise a new batch is moved
+# from the head of the list into a processing list for the given token.
+# Returns the token, the number of deliveries, the number of batches
+# moved to the dead letter list and the items.
+_RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local deadline = tonumber(ARGV[2])
+local batch = tonumber(ARGV[3])
+local token = ARGV[4]
+local max_deliveries = tonumber(ARGV[5])
+local ttl = tonumber(ARGV[6])
+
+local function push(key, items)
+    for i = 1, #items, 1000 do
+        redis.call('RPUSH', key, unpack(items, i, math.min(i + 999, #items)))
+    end
+    redis.call('EXPIRE', key, ttl)
+end
+
+local poisoned = 0
+while true do
+    local expired = redis.call(
+        'ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 1)
+    if #expired == 0 then
+        break
+    end
+    local batch_key = KEYS[1] .. ':batch:' .. expired[1]
+    local deliveries = redis.call('HINCRBY', KEYS[3], expired[1], 1)
+    local items = redis.call('LRANGE', batch_key, 0, -1)
+    if deliveries <= max_deliveries and #items > 0 then
+        redis.call('ZADD', KEYS[2], deadline, expired[1])
+        return {expired[1], deliveries, poisoned, items}
+    end
+    if #items > 0 then
+        push(KEYS[4], items)
+        poisoned = poisoned + 1
+    end
+    redis.call('DEL', batch_key)
+    redis.call('ZREM', KEYS[2], expired[1])
+    redis.call('HDEL', KEYS[3], expired[1])
+end
+
+local items
+if batch == 0 then
+    items = redis.call('LRANGE', KEYS[1], 0, -1)
+    redis.call('DEL', KEYS[1])
+else
+    items = redis.call('LRANGE', KEYS[1], 0, batch - 1)
+    redis.call('LTRIM', KEYS[1], batch, -1)
+end
+if #items == 0 then
+    return {'', 0, poisoned, items}
+end
+push(KEYS[1] .. ':batch:' .. token, items)
+redis.call('ZADD', KEYS[2], deadline, token)
+redis.call('HSET', KEYS[3], token, 1)
+redis.call('EXPIRE', KEYS[2], ttl)
+redis.call('EXPIRE', KEYS[3], ttl)
+return {token, 1, poisoned, items}
+"""
+
+# Return the creation time in milliseconds of the oldest item in each
+# of the streams, which the consumer group hasn't read yet, or zero.
+_OLDEST_UNREAD_SCRIPT = """
+local result = {}
+for i, key in ipairs(KEYS) do
+    result[i] = 0
+    if redis.call('EXISTS', key) == 1 then
+        local start = '-'
+        for _, info in ipairs(redis.call('XINFO', 'GROUPS', key)) do
+            local fields = {}
+            for j = 1, #info, 2 do
+                fields[info[j]] = info[j + 1]
+            end
+            if fields['name'] == ARGV[1] then
+                start = '(' .. fields['last-delivered-id']
+            end
+        end
+        local oldest = redis.call('XRANGE', key, start, '+', 'COUNT', 1)
+        if #oldest > 0 then
+            result[i] = tonumber(string.match(oldest[1][1], '^%d+'))
+        end
+    end
+end
+return result
+"""
+
+
+class QueueBatch(namedtuple('QueueBatch', 'token items deliveries')):
+    """
+    A batch of items reserved from a reliable
+    :class:`~ichnaea.queue.DataQueue`, which needs to be acknowledged
+    using its token.
+    """
+
+    __slots__ = ()
+
+
+class QueueSample(namedtuple('QueueSample', 'key size age enqueued')):
+    """
+    The state of a :class:`~ichnaea.queue.DataQueue` at one point in
+    time: the number of items in it, the age of its data in seconds and
+    the total number of items ever put into it.
+
+    For list based queues, the age is derived from the TTL of the list
+    and is the time since data was last put into the queue.
+    """
+
+    __slots__ = ()
+
+    def rates(self, previous, duration):
+        """
+        Return the enqueue and dequeue rates in items per second, since
+        the previous sample of the same queue taken duration seconds ago.
+        """
+        if previous is None or duration <= 0:
+            return (0.0, 0.0)
+        enqueued = self.enqueued - previous.enqueued
+        if enqueued < 0:
+            # The counter was reset in the meantime.
+            enqueued = self.enqueued
+        dequeued = max(previous.size + enqueued - self.size, 0)
+        return (enqueued / duration, dequeued / duration)
+
+
+def sample_queues(redis_client, queues):
+    """
+    Sample all given queues in a single pipelined pass over Redis and
+    return a list of :class:`~ichnaea.queue.QueueSample`.
+    """
+    counts = []
+    with redis_client.pipeline() as pipe:
+        pipe.hgetall(ENQUEUED_KEY)
+        for queue in queues:
+            counts.append(queue._sample(pipe))
+        result = pipe.execute()
+
+    enqueued = result[0]
+    samples = []
+    pos = 1
+    for queue, count in zip(queues, counts):
+        size, age = queue._sample_result(result[pos:pos + count])
+        pos += count
+        samples.append(QueueSample(
+            queue.key, size, age,
+            int(enqueued.get(queue.key.encode('utf-8'), 0))))
+    return samples
+
+
+def ready_queues(redis_client, queues):
+    """
+    Check all given queues in a single pipelined pass over Redis and
+    return a list of booleans, True for each queue which is ready for
+    processing.
+    """
+    counts = []
+    with redis_client.pipeline() as pipe:
+        for queue in queues:
+            counts.append(queue._ready(pipe))
+        result = pipe.execute()
+
+    ready = []
+    pos = 0
+    for queue, count in zip(queues, counts):
+        ready.append(queue._ready_result(result[pos:pos + count]))
+        pos += count
+    return ready
+
+
+class BatchController(object):
+    """
+    Picks the batch size for each dequeue from a
+    :class:`~ichnaea.queue.DataQueue`, between `min_batch` and
+    `max_batch` items.
+
+    The batch size grows while the queue backlog is larger than a batch
+    and batches are processed within the `target_duration`. It shrinks
+    if processing takes longer than the target, is halved if processing
+    runs into database lock conflicts, and decays towards the backlog
+    during quiet periods.
+
+    The state is kept in memory, so each worker process adapts on its
+    own.
+    """
+
+    growth = 1.5  # Factor to grow or decay the batch size by.
+
+    def __init__(self, min_batch, max_batch,
+                 batch=None, target_duration=10.0):
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.target_duration = target_duration
+        self.backlog = 0
+        self.batch = self._limit(batch or min_batch)
+
+    def _limit(self, batch):
+        return int(min(max(batch, self.min_batch), self.max_batch))
+
+    def next_batch(self, backlog):
+        """Return the batch size, given the current queue backlog."""
+        self.backlog = backlog
+        return self.batch
+
+    def update(self, duration, conflicts=0):
+        """
+        Update and return the batch size, given the processing time
+        and number of lock conflicts of the last batch.
+        """
+        batch = self.batch
+        if conflicts:
+            batch = batch / 2.0
+        elif duration > self.target_duration:
+            batch = batch * self.target_duration / duration
+        elif self.backlog > batch:
+            batch = batch * self.growth
+        else:
+            batch = max(self.backlog, batch / self.growth)
+        self.batch = self._limit(batch)
+        return self.batch
+
 
 class DataQueue(object):
     """
@@ -15,25 +319,137 @@ class DataQueue(object):
 
     The lists maintain a TTL value corresponding to the time data has
     been last put into the queue.
+
+    If `frames` is set to one of the :data:`FRAME_CODECS`, the items
+    of each batch are stored together in a single compressed frame,
+    instead of compressing each item on its own. The number of items
+    is tracked in a separate counter key, so the queue size and batch
+    arguments still count items. Dequeue returns whole frames, until
+    they contain at least the batch number of items.
+
+    If `reliable` is set, :meth:`reserve` moves each batch into a
+    processing list, until it is acknowledged via :meth:`ack`. Batches
+    which aren't acknowledged within the `processing_timeout` are
+    delivered again by later calls to :meth:`reserve`. Batches delivered
+    more than `max_deliveries` times are moved to a dead letter list.
+
+    If a `trigger` is set, :meth:`enqueue` calls it to schedule the
+    processing of the queue, see :meth:`notify`.
+
+    If a `controller` is set, it picks the number of items returned by
+    :meth:`dequeue` and :meth:`reserve`, see
+    :class:`~ichnaea.queue.BatchController`.
     """
 
     queue_ttl = 86400  # Maximum TTL value for the Redis list.
     queue_max_age = 3600  # Maximum age that data can sit in the queue.
+    processing_timeout = 300  # Time to acknowledge a reserved batch.
+    max_deliveries = 5  # Maximum deliveries of a reserved batch.
+    trigger = None  # Callable scheduling the processing of the queue.
+    trigger_timeout = 30  # Minimum time between two immediate triggers.
+    trigger_max_age = 30  # Maximum delay for processing a partial batch.
+    controller = None  # Optional adaptive batch size controller.
 
     def __init__(self, key, redis_client,
-                 batch=0, compress=False, json=True):
+                 batch=0, compress=False, json=True, frames=None,
+                 reliable=False):
         self.key = key
         self.redis_client = redis_client
         self.batch = batch
         self.compress = compress
         self.json = json
+        self.frames = frames
+        self.reliable = reliable
+        if reliable:
+            if frames is not None:
+                raise ValueError('Reliable queues do not support frames.')
+            self.processing_key = key + ':processing'
+            self.deliveries_key = key + ':deliveries'
+            self.dead_key = key + ':dead'
+            self._reserve = redis_client.register_script(_RESERVE_SCRIPT)
+        if frames is not None:
+            if frames not in FRAME_CODECS:
+                raise ValueError('Unknown frame codec: %r' % frames)
+            self.count_key = key + ':items'
+            self._dequeue_frames = redis_client.register_script(
+                _DEQUEUE_FRAMES_SCRIPT)
+
+    def _encode_frame(self, items):
+        codec_id, zdict = FRAME_CODECS[self.frames]
+        if zdict is None:
+            compressor = zlib.compressobj()
+        else:
+            compressor = zlib.compressobj(zdict=zdict)
+        data = b''.join([_ITEM_LENGTH.pack(len(item)) + item
+                         for item in items])
+        return (_FRAME_HEADER.pack(codec_id, len(items)) +
+                compressor.compress(data) + compressor.flush())
+
+    def _decode_frame(self, frame):
+        if frame[0] not in _FRAME_DICTIONARIES:
+            # A single item queued before frames were enabled.
+            if frame[:2] == b'\x1f\x8b':
+                frame = util.decode_gzip(frame, encoding=None)
+            return [frame]
+
+        codec_id, count = _FRAME_HEADER.unpack_from(frame)
+        zdict = _FRAME_DICTIONARIES[codec_id]
+        if zdict is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=zdict)
+        data = decompressor.decompress(frame[_FRAME_HEADER.size:])
+
+        items = []
+        pos = 0
+        for i in range(count):
+            length = _ITEM_LENGTH.unpack_from(data, pos)[0]
+            pos += _ITEM_LENGTH.size
+            items.append(data[pos:pos + length])
+            pos += length
+        return items
+
+    def next_batch(self):
+        """
+        Return the default batch size for the next dequeue.
+        """
+        if self.controller is None:
+            return self.batch
+        return self.controller.next_batch(self.size())
+
+    def adapt(self, duration, conflicts=0, stats_client=None):
+        """
+        Report the processing of the last batch to the controller, if
+        one is set, and emit the new batch size as a ``queue.batch``
+        gauge, if a `stats_client` is given.
+
+        :param duration: Time taken to process the batch in seconds.
+        :param conflicts: Number of database lock wait timeouts or
+                          deadlocks encountered while processing it.
+        """
+        if self.controller is None:
+            return
+        batch = self.controller.update(duration, conflicts=conflicts)
+        if stats_client is not None:
+            stats_client.gauge('queue.batch', batch,
+                               tags=['queue:' + self.key])
 
     def dequeue(self, batch=None):
         """
         Get batch number of items from the queue.
         """
         if batch is None:
-            batch = self.batch
+            batch = self.next_batch()
+
+        if self.frames is not None:
+            frames = self._dequeue_frames(
+                keys=[self.key, self.count_key], args=[batch])
+            result = []
+            for frame in frames:
+                result.extend(self._decode_frame(frame))
+            if self.json:
+                result = [codec.loads(item) for item in result]
+            return result
 
         with self.redis_client.pipeline() as pipe:
             pipe.multi()
@@ -45,49 +461,145 @@ class DataQueue(object):
                 pipe.ltrim(self.key, 1, 0)
             result = pipe.execute()[0]
 
-            if self.compress:
-                result = [util.decode_gzip(item, encoding=None)
-                          for item in result]
-            if self.json:
-                # simplejson.loads returns Unicode strings
-                result = [simplejson.loads(item, encoding='utf-8')
-                          for item in result]
+        return self._decode(result)
+
+    def _decode(self, items):
+        if self.compress:
+            items = [util.decode_gzip(item, encoding=None) for item in items]
+        if self.json:
+            items = [codec.loads(item) for item in items]
+        return items
+
+    def reserve(self, batch=None, stats_client=None):
+        """
+        Get a :class:`~ichnaea.queue.QueueBatch` of batch number of items
+        from the queue.
+
+        For reliable queues the items are kept in a processing list,
+        until the batch is acknowledged. Redeliveries and batches moved
+        to the dead letter list are counted in ``queue.redeliver`` and
+        ``queue.poison`` metrics, if a `stats_client` is given.
+        """
+        if batch is None:
+            batch = self.next_batch()
+
+        if not self.reliable:
+            return QueueBatch(None, self.dequeue(batch=batch), 1)
 
-        return result
+        now = time.time()
+        token, deliveries, poisoned, items = self._reserve(
+            keys=[self.key, self.processing_key,
+                  self.deliveries_key, self.dead_key],
+            args=[now, now + self.processing_timeout, batch,
+                  uuid4().hex, self.max_deliveries, self.queue_ttl])
+
+        if stats_client is not None:
+            tags = ['queue:' + self.key]
+            if deliveries > 1:
+                stats_client.incr('queue.redeliver', len(items), tags=tags)
+            if poisoned:
+                stats_client.incr('queue.poison', poisoned, tags=tags)
+
+        return QueueBatch(token.decode('ascii') or None,
+                          self._decode(items), deliveries)
+
+    def ack(self, token, pipe=None):
+        """
+        Acknowledge the processing of a reserved batch of items,
+        optionally as part of the given pipe.
+        """
+        if not (self.reliable and token):
+            return
+        if pipe is not None:
+            self._ack(pipe, token)
+        else:
+            with redis_pipeline(self.redis_client) as pipe:
+                self._ack(pipe, token)
+
+    def _ack(self, pipe, token):
+        pipe.delete(self.key + ':batch:' + token)
+        pipe.zrem(self.processing_key, token)
+        pipe.hdel(self.deliveries_key, token)
 
     def _push(self, pipe, items, batch):
-        for i in range(0, len(items), batch):
-            pipe.rpush(self.key, *items[i:i + batch])
+        if self.frames is not None:
+            pipe.rpush(self.key, *[self._encode_frame(items[i:i + batch])
+                                   for i in range(0, len(items), batch)])
+            pipe.incrby(self.count_key, len(items))
+            pipe.expire(self.count_key, self.queue_ttl)
+        else:
+            for i in range(0, len(items), batch):
+                pipe.rpush(self.key, *items[i:i + batch])
 
         # expire key after it was created by rpush
         pipe.expire(self.key, self.queue_ttl)
+        pipe.hincrby(ENQUEUED_KEY, self.key, len(items))
 
-    def enqueue(self, items, batch=None, pipe=None):
+    def _encode(self, items):
+        if self.json:
+            # codec.dumps returns Unicode strings
+            items = [codec.dumps(item).encode('utf-8') for item in items]
+        if self.compress and self.frames is None:
+            items = [util.encode_gzip(item, encoding=None) for item in items]
+        return items
+
+    def enqueue(self, items, batch=None, pipe=None, keys=None):
         """
         Put items into the queue.
 
         The items will be pushed into Redis as part of a single (given)
         pipe in batches corresponding to the given batch argument.
+
+        The optional keys, one per item, are only used by partitioned
+        queues like :class:`~ichnaea.queue.StreamDataQueue`.
         """
         if batch is None:
             batch = self.batch
 
+        if not items:
+            return
+
         if batch == 0:
             batch = len(items)
 
-        if self.json:
-            # simplejson.dumps returns Unicode strings
-            items = [simplejson.dumps(item, encoding='utf-8').encode('utf-8')
-                     for item in items]
-
-        if self.compress:
-            items = [util.encode_gzip(item, encoding=None) for item in items]
+        items = self._encode(items)
 
         if pipe is not None:
             self._push(pipe, items, batch)
         else:
             with redis_pipeline(self.redis_client) as pipe:
                 self._push(pipe, items, batch)
+            self.notify()
+
+    def notify(self):
+        """
+        Call the trigger, if one is set, after items were put into the
+        queue. Callers passing a pipe to :meth:`enqueue` need to call
+        this after executing the pipe.
+
+        Once the queue holds a full batch, the trigger is called right
+        away, at most once per `trigger_timeout`. Otherwise it is called
+        with a countdown of `trigger_max_age` seconds, at most once per
+        countdown. The calls are deduplicated across processes via
+        Redis ``SET NX`` tokens.
+        """
+        if self.trigger is None:
+            return
+
+        size = self.size()
+        if not size:
+            return
+
+        if size >= self.batch:
+            key = self.key + ':trigger'
+            countdown = 0
+            timeout = self.trigger_timeout
+        else:
+            key = self.key + ':trigger:delayed'
+            countdown = timeout = self.trigger_max_age
+
+        if self.redis_client.set(key, 1, nx=True, ex=timeout):
+            self.trigger(countdown=countdown)
 
     def ready(self, batch=None):
         """
@@ -95,19 +607,495 @@ class DataQueue(object):
         batch number of items in it, or if the last time it has seen
         new data was more than an hour ago (queue_max_age).
         """
+        with self.redis_client.pipeline() as pipe:
+            self._ready(pipe)
+            return self._ready_result(pipe.execute(), batch=batch)
+
+    def _ready(self, pipe):
+        # Add the commands to check the queue and return their number.
+        pipe.ttl(self.key)
+        self._size(pipe)
+        return 2
+
+    def _ready_result(self, result, batch=None):
         if batch is None:
             batch = self.batch
-
-        with self.redis_client.pipeline() as pipe:
-            pipe.ttl(self.key)
-            pipe.llen(self.key)
-            ttl, size = pipe.execute()
+        ttl, size = result
+        size = int(size or 0)
         if ttl < 0:
             age = -1
         else:
             age = max(self.queue_ttl - ttl, 0)
         return bool(size > 0 and (size >= batch or age >= self.queue_max_age))
 
+    def _size(self, pipe):
+        if self.frames is not None:
+            pipe.get(self.count_key)
+        else:
+            pipe.llen(self.key)
+
+    def _sample(self, pipe):
+        # Add the commands to sample the queue and return their number.
+        self._size(pipe)
+        pipe.ttl(self.key)
+        return 2
+
+    def _sample_result(self, result):
+        # Return the size and age of the queue.
+        size, ttl = result
+        size = int(size or 0)
+        if not size or ttl < 0:
+            return (size, 0)
+        return (size, max(self.queue_ttl - ttl, 0))
+
     def size(self):
-        """Return the size of the queue."""
+        """Return the number of items in the queue."""
+        if self.frames is not None:
+            return int(self.redis_client.get(self.count_key) or 0)
         return self.redis_client.llen(self.key)
+
+
+class StreamDataQueue(DataQueue):
+    """
+    A Redis Streams based queue, split into a fixed number of partition
+    streams, which requires Redis 5.0 or later.
+
+    Items are assigned to partitions based on a hash of their key, so
+    all items for the same key stay in order. Each call to
+    :meth:`reserve` locks one partition and reads a batch from it via
+    a consumer group, so multiple workers can drain the queue
+    concurrently, one per partition. Batches are acknowledged and
+    deleted from the stream via :meth:`ack`. Unacknowledged batches are
+    delivered again, once the partition lock expired after the
+    `processing_timeout`. Items delivered more than `max_deliveries`
+    times are moved to a dead letter list.
+
+    If a consumer `group` is given, the queue is shared between several
+    groups, each reading all items. Acknowledged items aren't deleted,
+    but removed by :meth:`trim` once all groups acknowledged them. The
+    size of the queue is the number of items the group hasn't
+    acknowledged yet. Shared queues require Redis 6.2 or later.
+    """
+
+    group = 'workers'
+
+    def __init__(self, key, redis_client,
+                 batch=0, compress=False, json=True, partitions=4,
+                 group=None):
+        super(StreamDataQueue, self).__init__(
+            key, redis_client, batch=batch, compress=compress, json=json)
+        self.partitions = partitions
+        self.stream_keys = ['%s:%s' % (key, i) for i in range(partitions)]
+        self.dead_key = key + ':dead'
+        self.shared = group is not None
+        if self.shared:
+            self.group = group
+            self.read_key = key + ':read'
+        self._release = redis_client.register_script(_RELEASE_SCRIPT)
+        self._oldest_unread = redis_client.register_script(
+            _OLDEST_UNREAD_SCRIPT)
+
+    def _lock_key(self, stream_key):
+        if self.shared:
+            return '%s:lock:%s' % (stream_key, self.group)
+        return stream_key + ':lock'
+
+    def partition(self, key):
+        """Return the partition number for an item key."""
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return zlib.crc32(key) % self.partitions
+
+    def _push(self, pipe, items, keys):
+        streams = set()
+        for item, key in zip(items, keys):
+            stream_key = self.stream_keys[self.partition(key)]
+            pipe.execute_command('XADD', stream_key, '*', 'v', item)
+            streams.add(stream_key)
+
+        for stream_key in sorted(streams):
+            pipe.expire(stream_key, self.queue_ttl)
+        pipe.hincrby(ENQUEUED_KEY, self.key, len(items))
+
+    def enqueue(self, items, batch=None, pipe=None, keys=None):
+        """
+        Put items into the queue, optionally as part of the given pipe.
+
+        Items are partitioned by their keys, or their encoded value if
+        no keys are given.
+        """
+        if not items:
+            return
+
+        items = self._encode(items)
+        if keys is None:
+            keys = items
+
+        if pipe is not None:
+            self._push(pipe, items, keys)
+        else:
+            with redis_pipeline(self.redis_client) as pipe:
+                self._push(pipe, items, keys)
+            self.notify()
+
+    def _create_group(self):
+        # Create the consumer group on all partitions at once.
+        with self.redis_client.pipeline() as pipe:
+            for stream_key in self.stream_keys:
+                pipe.execute_command(
+                    'XGROUP', 'CREATE', stream_key, self.group, '0',
+                    'MKSTREAM')
+            if self.shared:
+                pipe.hget(ENQUEUED_KEY, self.key)
+                for stream_key in self.stream_keys:
+                    pipe.execute_command('XLEN', stream_key)
+            result = pipe.execute(raise_on_error=False)
+
+        created = result[:self.partitions]
+        for value in created:
+            if not isinstance(value, ResponseError):
+                continue
+            if not str(value).startswith('BUSYGROUP'):  # pragma: no cover
+                raise value
+        if self.shared and not any(
+                isinstance(value, ResponseError) for value in created):
+            # The new group starts reading the remaining items in all
+            # partitions, so count all earlier items as read.
+            enqueued = int(result[self.partitions] or 0)
+            length = sum(result[self.partitions + 1:])
+            self.redis_client.hset(
+                self.read_key, self.group, enqueued - length)
+
+    def _pending(self, stream_key, batch):
+        # Claim entries left unacknowledged by an earlier lock holder,
+        # which increments their delivery count.
+        pending = self.redis_client.execute_command(
+            'XPENDING', stream_key, self.group, '-', '+', batch or 10000)
+        if not pending:
+            return ([], 0)
+
+        ids = [entry[0] for entry in pending]
+        deliveries = max(entry[3] for entry in pending) + 1
+        entries = self.redis_client.execute_command(
+            'XCLAIM', stream_key, self.group, self.group, 0, *ids)
+        return (entries, deliveries)
+
+    def _read(self, stream_key, batch):
+        try:
+            entries, deliveries = self._pending(stream_key, batch)
+        except ResponseError as exc:
+            if not str(exc).startswith('NOGROUP'):  # pragma: no cover
+                raise
+            self._create_group()
+            entries, deliveries = ([], 0)
+
+        if not entries:
+            args = ['COUNT', batch] if batch else []
+            result = self.redis_client.execute_command(
+                'XREADGROUP', 'GROUP', self.group, self.group,
+                *(args + ['STREAMS', stream_key, '>']))
+            entries = result[0][1] if result else []
+            deliveries = 1
+
+        # Entries deleted in the meantime are returned without values,
+        # but still need to be acknowledged.
+        ids = [entry_id for entry_id, _ in entries]
+        values = [fields[1] for _, fields in entries if fields]
+        return (ids, values, deliveries)
+
+    def reserve(self, batch=None, stats_client=None):
+        """
+        Lock a partition and get a :class:`~ichnaea.queue.QueueBatch` of
+        batch number of items from it.
+
+        Returns an empty batch if all partitions are locked or empty.
+        """
+        if batch is None:
+            batch = self.next_batch()
+
+        start = random.randrange(self.partitions)
+        for i in range(self.partitions):
+            stream_key = self.stream_keys[(start + i) % self.partitions]
+            lock_key = self._lock_key(stream_key)
+            lock = uuid4().hex
+            if not self.redis_client.set(
+                    lock_key, lock, nx=True,
+                    px=int(self.processing_timeout * 1000)):
+                continue
+
+            ids, values, deliveries = self._read(stream_key, batch)
+            if values and deliveries > self.max_deliveries:
+                self._poison(stream_key, ids, values, stats_client)
+                ids, values, deliveries = self._read(stream_key, batch)
+
+            token = (stream_key, lock, ids)
+            if deliveries > 1 and stats_client is not None:
+                stats_client.incr('queue.redeliver', len(values),
+                                  tags=['queue:' + self.key])
+
+            if not values:
+                self.ack(token)
+                continue
+
+            return QueueBatch(token, self._decode(values), deliveries)
+
+        return QueueBatch(None, [], 0)
+
+    def _poison(self, stream_key, ids, values, stats_client):
+        with redis_pipeline(self.redis_client) as pipe:
+            pipe.rpush(self.dead_key, *values)
+            pipe.expire(self.dead_key, self.queue_ttl)
+            self._done(pipe, stream_key, ids)
+        if stats_client is not None:
+            stats_client.incr('queue.poison', 1, tags=['queue:' + self.key])
+
+    def ack(self, token, pipe=None):
+        """
+        Acknowledge and delete a reserved batch of items and unlock
+        its partition, optionally as part of the given pipe.
+        """
+        if not token:
+            return
+        if pipe is not None:
+            self._ack(pipe, token)
+        else:
+            with redis_pipeline(self.redis_client) as pipe:
+                self._ack(pipe, token)
+
+    def _ack(self, pipe, token):
+        stream_key, lock, ids = token
+        if ids:
+            self._done(pipe, stream_key, ids)
+        self._release(
+            keys=[self._lock_key(stream_key)], args=[lock], client=pipe)
+
+    def _done(self, pipe, stream_key, ids):
+        pipe.execute_command('XACK', stream_key, self.group, *ids)
+        if self.shared:
+            pipe.hincrby(self.read_key, self.group, len(ids))
+        else:
+            pipe.execute_command('XDEL', stream_key, *ids)
+
+    def trim(self, groups):
+        """
+        Remove all items from a shared queue, which have been
+        acknowledged by all of the given consumer groups. Other groups
+        are removed from the queue.
+        """
+        for stream_key in self.stream_keys:
+            try:
+                infos = self.redis_client.execute_command(
+                    'XINFO', 'GROUPS', stream_key)
+            except ResponseError:
+                # The stream doesn't exist.
+                continue
+
+            found = {}
+            for info in infos:
+                info = dict(zip(info[::2], info[1::2]))
+                found[info[b'name'].decode('utf-8')] = info
+            for name in set(found) - set(groups):
+                self.redis_client.execute_command(
+                    'XGROUP', 'DESTROY', stream_key, name)
+                self.redis_client.hdel(self.read_key, name)
+            if set(groups) - set(found):
+                # Some groups haven't started reading yet.
+                continue
+
+            minids = []
+            for name in groups:
+                pending = self.redis_client.execute_command(
+                    'XPENDING', stream_key, name)
+                if pending[0]:
+                    minids.append(pending[1])
+                else:
+                    minids.append(found[name][b'last-delivered-id'])
+            minid = min(minids, key=lambda value: tuple(
+                int(part) for part in value.split(b'-')))
+            self.redis_client.execute_command(
+                'XTRIM', stream_key, 'MINID', minid)
+
+    def dequeue(self, batch=None):
+        """
+        Get batch number of items from one partition of the queue.
+        """
+        result = self.reserve(batch=batch)
+        self.ack(result.token)
+        return result.items
+
+    def _ready(self, pipe):
+        # A partition is ready if it has a batch of items or its
+        # oldest item is older than queue_max_age.
+        if self.shared:
+            self._size(pipe)
+            self._oldest_unread(
+                keys=self.stream_keys, args=[self.group], client=pipe)
+            return 3 + self.partitions
+        for stream_key in self.stream_keys:
+            pipe.execute_command('XLEN', stream_key)
+            pipe.execute_command('XRANGE', stream_key, '-', '+', 'COUNT', 1)
+        return 2 * self.partitions
+
+    def _ready_result(self, result, batch=None):
+        if batch is None:
+            batch = self.batch
+
+        now = time.time() * 1000
+        if self.shared:
+            size = self._size_result(result[:-1])
+            if not size:
+                return False
+            if size >= batch:
+                return True
+            return any(created and now - created >= self.queue_max_age * 1000
+                       for created in result[-1])
+
+        for size, oldest in zip(result[::2], result[1::2]):
+            if not size:
+                continue
+            created = int(oldest[0][0].split(b'-')[0]) if oldest else now
+            if size >= batch or now - created >= self.queue_max_age * 1000:
+                return True
+        return False
+
+    def _size(self, pipe):
+        if self.shared:
+            pipe.hget(ENQUEUED_KEY, self.key)
+            pipe.hget(self.read_key, self.group)
+        for stream_key in self.stream_keys:
+            pipe.execute_command('XLEN', stream_key)
+
+    def _size_result(self, result):
+        if self.shared:
+            enqueued, read = result[:2]
+            if read is None:
+                # The group hasn't started reading yet.
+                return sum(result[2:])
+            return max(int(enqueued or 0) - int(read), 0)
+        return sum(result)
+
+    def size(self):
+        """Return the number of items in the queue."""
+        with self.redis_client.pipeline() as pipe:
+            self._size(pipe)
+            return self._size_result(pipe.execute())
+
+    def _sample(self, pipe):
+        for stream_key in self.stream_keys:
+            pipe.execute_command('XLEN', stream_key)
+            pipe.execute_command('XRANGE', stream_key, '-', '+', 'COUNT', 1)
+        return 2 * self.partitions
+
+    def _sample_result(self, result):
+        now = time.time()
+        size = 0
+        age = 0
+        for length, oldest in zip(result[::2], result[1::2]):
+            size += length
+            if length and oldest:
+                created = int(oldest[0][0].split(b'-')[0]) / 1000.0
+                age = max(age, int(now - created))
+        return (size, age)
+
+
+class BufferedDataQueue(object):
+    """
+    A per-process in-memory buffer in front of a
+    :class:`~ichnaea.queue.DataQueue`.
+
+    Items are collected in memory and pushed into the underlying queue
+    in one call, once the buffer holds at least `batch` items or the
+    last flush happened more than `interval` seconds ago. A background
+    thread, started with the first item, flushes the buffer every
+    `interval` seconds, so items don't wait for the next request on an
+    idle process. The buffer holds at most `max_size` items, additional
+    items are dropped and counted in a ``queue.buffer.drop`` metric.
+    """
+
+    def __init__(self, queue, raven_client=None, stats_client=None,
+                 batch=100, interval=5.0, max_size=10000):
+        self.queue = queue
+        self.raven_client = raven_client
+        self.stats_client = stats_client
+        self.batch = batch
+        self.interval = interval
+        self.max_size = max_size
+        self._items = []
+        self._last_flush = time.time()
+        # Look up the primitives at runtime, to use the gevent versions
+        # once the process is monkey patched.
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+
+    @property
+    def key(self):
+        return self.queue.key
+
+    def _drop(self, num):
+        if self.stats_client is not None and num > 0:
+            self.stats_client.incr(
+                'queue.buffer.drop', num, tags=['queue:' + self.key])
+
+    def enqueue(self, items):
+        """
+        Put items into the buffer, potentially flushing it.
+        """
+        with self._lock:
+            room = max(self.max_size - len(self._items), 0)
+            if len(items) > room:
+                self._drop(len(items) - room)
+                items = items[:room]
+            self._items.extend(items)
+            if self._timer is None and self.interval > 0:
+                self._timer = threading.Thread(
+                    target=self._run, daemon=True)
+                self._timer.start()
+            should_flush = (
+                len(self._items) >= self.batch or
+                time.time() - self._last_flush >= self.interval)
+
+        if should_flush:
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._items:
+                self.flush()
+
+    def close(self):
+        """
+        Stop the background thread and flush the remaining items.
+
+        A later enqueue starts a new background thread.
+        """
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            self._stop.set()
+            timer.join()
+            self._stop.clear()
+        self.flush()
+
+    def flush(self):
+        """
+        Push all buffered items into the underlying queue.
+        """
+        with self._lock:
+            items = self._items
+            self._items = []
+            self._last_flush = time.time()
+
+        if not items:
+            return
+
+        try:
+            self.queue.enqueue(items)
+        except Exception:
+            self._drop(len(items))
+            if self.raven_client is not None:
+                self.raven_client.captureException()
+
+    def size(self):
+        """Return the number of items in the buffer."""
+        return len(self._items)
@@ -0,0 +1,151 @@
+"""
+Benchmark implementations of hot code paths against their alternatives.
+
+Script is installed as `location_benchmark`.
+"""
+
+import argparse
+import sys
+import time
+
+from ichnaea.api.rate_limit import (
+    gcra_rate_limit_exceeded,
+    rate_limit_exceeded,
+)
+from ichnaea.cache import configure_redis
+from ichnaea.codec import (
+    SimplejsonCodec,
+    UjsonCodec,
+    ujson,
+)
+
+
+def timed(func, number):
+    """
+    Call `func` `number` times with the call index and return the
+    duration in seconds.
+    """
+    start = time.time()
+    for i in range(number):
+        func(i)
+    return time.time() - start
+
+
+def benchmark_ratelimit(redis_client, number):
+    """
+    Compare the GCRA rate limiter with the fixed window INCR/EXPIRE
+    rate limiter. Half of the requests are over the limit.
+    """
+    incr_key = 'benchmark:ratelimit:incr'
+    gcra_key = 'benchmark:ratelimit:gcra'
+    maxreq = max(number // 2, 1)
+    redis_client.delete(incr_key, gcra_key)
+    try:
+        return [
+            ('ratelimit.incr_expire', timed(
+                lambda i: rate_limit_exceeded(
+                    redis_client, incr_key, maxreq=maxreq, expire=3600),
+                number)),
+            ('ratelimit.gcra', timed(
+                lambda i: gcra_rate_limit_exceeded(
+                    redis_client, gcra_key, maxreq=maxreq, interval=3600),
+                number)),
+        ]
+    finally:
+        redis_client.delete(incr_key, gcra_key)
+
+
+def _codec_report(num):
+    """
+    Return a submit report with 15 networks, similar to the reports
+    stored in the incoming queue.
+    """
+    return {
+        'timestamp': 1500000000000 + num,
+        'position': {
+            'latitude': 51.5 + num * 0.0001,
+            'longitude': -0.1 - num * 0.0001,
+            'accuracy': 10.0,
+            'source': 'gnss',
+        },
+        'cellTowers': [{
+            'radioType': 'lte',
+            'mobileCountryCode': 234,
+            'mobileNetworkCode': 30,
+            'locationAreaCode': 1000 + i,
+            'cellId': 10000 * num + i,
+            'signalStrength': -80 - i,
+        } for i in range(3)],
+        'wifiAccessPoints': [{
+            'macAddress': '01005e%06x' % (num * 16 + i),
+            'signalStrength': -60 - i,
+            'ssid': 'network %s' % i,
+        } for i in range(12)],
+    }
+
+
+def benchmark_codec(redis_client, number):
+    """
+    Compare the JSON codecs on encoding and decoding single reports,
+    as done for queue items, and on decoding a submit body with 100
+    reports.
+    """
+    codecs = [SimplejsonCodec()]
+    if ujson is not None:
+        codecs.append(UjsonCodec())
+
+    reports = [_codec_report(i) for i in range(100)]
+    body = SimplejsonCodec().dumps({'items': reports}).encode('utf-8')
+    results = []
+    for codec in codecs:
+        encoded = [codec.dumps(report) for report in reports]
+        results.extend([
+            ('codec.%s.dumps' % codec.name, timed(
+                lambda i: codec.dumps(reports[i % 100]), number)),
+            ('codec.%s.loads' % codec.name, timed(
+                lambda i: codec.loads(encoded[i % 100]), number)),
+            ('codec.%s.body' % codec.name, timed(
+                lambda i: codec.loads(body), number)),
+        ])
+    return results
+
+
+BENCHMARKS = {
+    'codec': benchmark_codec,
+    'ratelimit': benchmark_ratelimit,
+}
+
+
+def format_results(results, number):
+    """
+    Return a table of the benchmark results.
+    """
+    lines = ['%-32s %10s %12s' % ('BENCHMARK', 'SECONDS', 'USEC/CALL')]
+    for name, duration in results:
+        lines.append('%-32s %10.3f %12.1f' % (
+            name, duration, duration * 1000000.0 / number))
+    return '\n'.join(lines)
+
+
+def main(argv, _redis_client=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description='Run micro benchmarks.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+                        help='The benchmark to run.')
+    parser.add_argument('--number', type=int, default=10000,
+                        help='Number of calls per implementation.')
+
+    args = parser.parse_args(argv[1:])
+
+    redis_client = configure_redis(_client=_redis_client)
+    try:
+        results = BENCHMARKS[args.benchmark](redis_client, args.number)
+        print(format_results(results, args.number))
+    finally:
+        if _redis_client is None:  # pragma: no cover
+            redis_client.close()
+    return 0
+
+
+def console_entry():  # pragma: no cover
+    sys.exit(main(sys.argv))
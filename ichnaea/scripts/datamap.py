@@ -13,9 +13,9 @@ import sys
 
 import billiard
 import boto3
-from simplejson import dumps
 from sqlalchemy import text
 
+from ichnaea import codec
 from ichnaea.config import (
     ASSET_BUCKET,
 )
@@ -287,7 +287,7 @@ def upload_files(pool, bucketname, tiles, max_zoom,
 
     obj = bucket.Object(bucket_prefix + 'data.json')
     obj.put(
-        Body=dumps({'updated': util.utcnow().isoformat()}),
+        Body=codec.dumps({'updated': util.utcnow().isoformat()}),
         CacheControl='max-age=3600, public',
         ContentType='application/json',
     )
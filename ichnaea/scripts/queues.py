@@ -0,0 +1,87 @@
+"""
+Show the size, data age and throughput of all Redis queues.
+
+Script is installed as `location_queues`.
+"""
+
+import argparse
+import sys
+import time
+
+from ichnaea.async.config import configure_data
+from ichnaea.cache import configure_redis
+from ichnaea.data.monitor import monitored_queues
+from ichnaea.db import (
+    configure_db,
+    db_worker_session,
+)
+from ichnaea.models import ExportConfig
+from ichnaea.queue import sample_queues
+
+CLEAR_SCREEN = '\x1b[2J\x1b[H'
+
+
+def format_samples(samples, previous, duration):
+    """
+    Return a table of the queue samples, with the largest queues first.
+    """
+    lines = ['%-48s %10s %8s %8s %8s' % (
+        'QUEUE', 'SIZE', 'AGE', 'IN/S', 'OUT/S')]
+    for sample in sorted(samples, key=lambda sample: (-sample.size,
+                                                       sample.key)):
+        enqueue, dequeue = sample.rates(previous.get(sample.key), duration)
+        lines.append('%-48s %10d %8d %8.1f %8.1f' % (
+            sample.key, sample.size, sample.age, enqueue, dequeue))
+    return '\n'.join(lines)
+
+
+def main(argv, _db=None, _redis_client=None, _sleep=time.sleep):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description='Show the state of all Redis queues.')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='Seconds between two updates.')
+    parser.add_argument('--count', type=int, default=0,
+                        help='Number of updates, zero to run until '
+                             'interrupted.')
+
+    args = parser.parse_args(argv[1:])
+
+    db = configure_db('ro', transport='sync', _db=_db)
+    with db_worker_session(db, commit=False) as session:
+        export_configs = ExportConfig.all(session)
+    if _db is None:  # pragma: no cover
+        db.close()
+
+    redis_client = configure_redis(_client=_redis_client)
+    data_queues = configure_data(redis_client)
+
+    previous = {}
+    previous_time = None
+    num = 0
+    try:
+        while True:
+            now = time.time()
+            # The partitions of the exports change over time.
+            queues = monitored_queues(
+                redis_client, data_queues, export_configs)
+            samples = sample_queues(redis_client, queues)
+            duration = now - previous_time if previous_time else 0
+            print(CLEAR_SCREEN + format_samples(samples, previous, duration))
+            sys.stdout.flush()
+
+            num += 1
+            if args.count and num >= args.count:
+                break
+            previous = dict((sample.key, sample) for sample in samples)
+            previous_time = now
+            _sleep(args.interval)
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        if _redis_client is None:  # pragma: no cover
+            redis_client.close()
+    return 0
+
+
+def console_entry():  # pragma: no cover
+    sys.exit(main(sys.argv))
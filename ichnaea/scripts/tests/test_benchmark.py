@@ -0,0 +1,34 @@
+from ichnaea.scripts import benchmark
+
+
+class TestBenchmark(object):
+
+    def test_compiles(self):
+        assert hasattr(benchmark, 'console_entry')
+
+    def test_ratelimit(self, capsys, redis):
+        assert benchmark.main(['script', 'ratelimit', '--number=10'],
+                              _redis_client=redis) == 0
+        out, _ = capsys.readouterr()
+        lines = out.splitlines()
+        assert lines[0].split() == ['BENCHMARK', 'SECONDS', 'USEC/CALL']
+        assert [line.split()[0] for line in lines[1:]] == [
+            'ratelimit.incr_expire', 'ratelimit.gcra']
+        assert not redis.keys('benchmark:*')
+
+    def test_format(self):
+        lines = benchmark.format_results(
+            [('a', 0.5), ('b', 2.0)], 1000).splitlines()
+        assert lines[1].split() == ['a', '0.500', '500.0']
+        assert lines[2].split() == ['b', '2.000', '2000.0']
+
+    def test_codec(self, capsys, redis):
+        assert benchmark.main(['script', 'codec', '--number=10'],
+                              _redis_client=redis) == 0
+        out, _ = capsys.readouterr()
+        names = [line.split()[0] for line in out.splitlines()[1:]]
+        assert names[:3] == [
+            'codec.simplejson.dumps',
+            'codec.simplejson.loads',
+            'codec.simplejson.body',
+        ]
@@ -0,0 +1,37 @@
+from ichnaea.queue import (
+    DataQueue,
+    QueueSample,
+)
+from ichnaea.scripts import queues
+
+
+class TestQueues(object):
+
+    def test_compiles(self):
+        assert hasattr(queues, 'console_entry')
+
+    def test_main(self, capsys, redis, sync_db):
+        queue = DataQueue('update_wifi_0', redis)
+        queue.enqueue([1, 2, 3])
+        sleeps = []
+        assert queues.main(['script', '--count=2', '--interval=2'],
+                           _db=sync_db, _redis_client=redis,
+                           _sleep=sleeps.append) == 0
+        assert sleeps == [2.0]
+
+        out, _ = capsys.readouterr()
+        lines = out.split(queues.CLEAR_SCREEN)[-1].splitlines()
+        assert lines[0].split() == ['QUEUE', 'SIZE', 'AGE', 'IN/S', 'OUT/S']
+        assert lines[1].split()[:2] == ['update_wifi_0', '3']
+        assert 'update_incoming' in out
+        assert 'celery_default' in out
+
+    def test_format(self):
+        previous = {'a': QueueSample('a', 10, 5, 100)}
+        samples = [
+            QueueSample('a', 5, 10, 120),
+            QueueSample('b', 20, 0, 20),
+        ]
+        lines = queues.format_samples(samples, previous, 5.0).splitlines()
+        assert lines[1].split() == ['b', '20', '0', '0.0', '0.0']
+        assert lines[2].split() == ['a', '5', '10', '4.0', '5.0']
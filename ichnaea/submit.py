@@ -0,0 +1,195 @@
+"""
+Functionality shared between the submit APIs and the async workers,
+including the deferred validation of submitted data.
+
+With deferred validation the web tier only checks the structure of a
+request body and queues it unparsed. The async workers then decode
+and validate it and turn it into one incoming queue item per report.
+"""
+
+import base64
+import codecs
+import gzip
+from io import BytesIO
+import struct
+import zlib
+
+import colander
+
+from ichnaea.api.submit.schema_v0 import SUBMIT_V0_SCHEMA
+from ichnaea.api.submit.schema_v1 import SUBMIT_V1_SCHEMA
+from ichnaea.api.submit.schema_v2 import SUBMIT_V2_SCHEMA
+from ichnaea import codec
+from ichnaea.config import (
+    SUBMIT_DEFERRED_MAX_ITEMS,
+    SUBMIT_MAX_BODY_SIZE,
+)
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
+from ichnaea import util
+
+CHUNK_SIZE = 65536
+WHITESPACE = ' \t\n\r\ufeff'
+
+SUBMIT_SCHEMAS = {
+    'v1.submit': SUBMIT_V0_SCHEMA,
+    'v1.geosubmit': SUBMIT_V1_SCHEMA,
+    'v2.geosubmit': SUBMIT_V2_SCHEMA,
+}
+
+
+def report_items(valid_key, reports):
+    """
+    Return one incoming queue item for each of the validated reports.
+    """
+    data = []
+    for report in reports:
+        source = 'gnss'
+        if report is not None:
+            position = report.get('position')
+            if position is not None:
+                source = position.get('source', 'gnss')
+
+        data.append({
+            'api_key': valid_key,
+            'report': report,
+            'source': source,
+        })
+    return data
+
+
+def _iter_chunks(body, gzip_encoded):
+    if not gzip_encoded:
+        yield body
+        return
+
+    if body[:2] != b'\x1f\x8b':
+        raise GZIPDecodeError('Not a gzipped file')
+    try:
+        with gzip.GzipFile(None, mode='rb',
+                           fileobj=BytesIO(body)) as gzip_file:
+            for data in iter(lambda: gzip_file.read(CHUNK_SIZE), b''):
+                yield data
+    except (IOError, OSError, EOFError, struct.error, zlib.error) as exc:
+        raise GZIPDecodeError(repr(exc))
+
+
+def check_body(body, gzip=False, encoding=None,
+               max_size=SUBMIT_MAX_BODY_SIZE):
+    """
+    Do cheap structural checks of a request body, without parsing it.
+
+    The body needs to be within `max_size` bytes and decode to a JSON
+    object mentioning an `items` key. Compressed bodies are only
+    decompressed until the key is found.
+
+    Returns the decoded text of an uncompressed body or the unchanged
+    compressed body.
+
+    :raises: :exc:`~ichnaea.exceptions.BodyTooLargeError`,
+             :exc:`~ichnaea.exceptions.GZIPDecodeError`,
+             :exc:`ValueError`
+    """
+    if max_size and len(body) > max_size:
+        raise BodyTooLargeError('Body larger than %s bytes.' % max_size)
+
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')()
+    size = 0
+    started = False
+    text = ''
+    for data in _iter_chunks(body, gzip):
+        size += len(data)
+        if max_size and size > max_size:
+            raise BodyTooLargeError(
+                'Body larger than %s bytes.' % max_size)
+        # Keep the end of the last chunk, in case the key was split.
+        text = text[-6:] + decoder.decode(data)
+        if not started and text.lstrip(WHITESPACE):
+            if not text.lstrip(WHITESPACE).startswith('{'):
+                raise ValueError('Expecting object')
+            started = True
+        if '"items"' in text:
+            break
+    else:
+        raise ValueError('Missing items')
+
+    if gzip:
+        return body
+    return text
+
+
+def deferred_item(valid_key, path, body, gzip=False, charset=None):
+    """
+    Return a single incoming queue item holding the request body for
+    the given API path, as returned by :func:`check_body`.
+
+    Decoded text is stored as is. The queue compresses it, so it isn't
+    base64 encoded. Compressed bodies are base64 encoded, which the
+    queue compression mostly reverts.
+    """
+    deferred = {
+        'charset': charset,
+        'gzip': gzip,
+        'path': path,
+    }
+    if gzip:
+        deferred['body'] = base64.b64encode(body).decode('ascii')
+    else:
+        deferred['text'] = body
+    return {
+        'api_key': valid_key,
+        'deferred': deferred,
+    }
+
+
+def expand_deferred(item, stats_client=None,
+                    max_items=SUBMIT_DEFERRED_MAX_ITEMS,
+                    max_size=SUBMIT_MAX_BODY_SIZE):
+    """
+    Decode and validate the request body of a deferred incoming queue
+    item and return one incoming queue item per report.
+
+    Returns an empty list if the body isn't valid, counted in a
+    ``data.batch.drop`` metric. Only the first `max_items` reports are
+    kept, additional reports are counted in a ``data.report.drop``
+    metric.
+    """
+    deferred = item['deferred']
+    schema = SUBMIT_SCHEMAS.get(deferred['path'])
+    tags = None
+    if item['api_key']:
+        tags = ['key:%s' % item['api_key']]
+
+    request_data = None
+    dropped = 0
+    try:
+        if 'text' in deferred:
+            content = deferred['text']
+        else:
+            content = base64.b64decode(deferred['body'])
+            if deferred['gzip']:
+                content = util.decode_gzip(
+                    content, encoding=None, max_size=max_size)
+        if schema is not None:
+            request_data = codec.loads(content, encoding=deferred['charset'])
+            items = None
+            if isinstance(request_data, dict):
+                items = request_data.get('items')
+            if isinstance(items, list) and len(items) > max_items:
+                dropped = len(items) - max_items
+                request_data['items'] = items[:max_items]
+            request_data = schema.deserialize(request_data)
+    except (BodyTooLargeError, GZIPDecodeError,
+            ValueError, colander.Invalid):
+        request_data = None
+
+    if not request_data:
+        if stats_client is not None:
+            stats_client.incr('data.batch.drop', tags=tags)
+        return []
+
+    if dropped and stats_client is not None:
+        stats_client.incr('data.report.drop', dropped, tags=tags)
+    return report_items(item['api_key'], request_data.get('items', ()))
@@ -0,0 +1,123 @@
+import pytest
+import simplejson
+
+from ichnaea import codec
+
+CODECS = [codec.SimplejsonCodec()]
+if codec.ujson is not None:
+    CODECS.append(codec.UjsonCodec())
+
+
+@pytest.fixture(params=CODECS, ids=lambda codec: codec.name)
+def json_codec(request):
+    yield request.param
+
+
+class TestCodec(object):
+
+    values = [
+        None,
+        True,
+        0,
+        -1,
+        2 ** 62,
+        'foo',
+        '',
+        {'a': [1, 2.5, None], 'b': {'c': 'd'}},
+        [{}, []],
+    ]
+
+    floats = [
+        0.0,
+        -0.0,
+        0.1,
+        1.0,
+        -12.3456,
+        51.12345678901234,
+        1e-10,
+        1.7976931348623157e+308,
+    ]
+
+    strings = [
+        'caf\xe9',
+        '  ',
+        '\U0001f600',
+        'http://example.com/a/b',
+        '"quoted" \\ \n\t',
+    ]
+
+    def test_default(self):
+        assert codec.create_codec().name == codec.JSON_LIBRARY
+        assert codec.create_codec('unknown').name == 'simplejson'
+
+    def test_roundtrip(self, json_codec):
+        for value in self.values:
+            assert json_codec.loads(json_codec.dumps(value)) == value
+
+    def test_tuple(self, json_codec):
+        assert json_codec.loads(json_codec.dumps((1, 2))) == [1, 2]
+
+    def test_dumps_unicode(self, json_codec):
+        for value in self.values + self.floats + self.strings:
+            assert isinstance(json_codec.dumps(value), str)
+
+    def test_float(self, json_codec):
+        for value in self.floats:
+            encoded = json_codec.dumps(value)
+            assert encoded == simplejson.dumps(value)
+            assert json_codec.loads(encoded) == value
+            assert repr(json_codec.loads(encoded)) == repr(value)
+
+    def test_unicode(self, json_codec):
+        for value in self.strings:
+            encoded = json_codec.dumps(value)
+            assert simplejson.loads(encoded) == value
+            assert json_codec.loads(encoded) == value
+            assert json_codec.loads(encoded.encode('utf-8')) == value
+            assert json_codec.loads(simplejson.dumps(value)) == value
+
+    def test_ascii_output(self, json_codec):
+        encoded = json_codec.dumps({'name': 'caf\xe9 \U0001f600'})
+        encoded.encode('ascii')
+
+    def test_bytes_values(self, json_codec):
+        encoded = json_codec.dumps({'name': b'caf\xc3\xa9'})
+        assert json_codec.loads(encoded) == {'name': 'caf\xe9'}
+
+    def test_unserializable(self, json_codec):
+        with pytest.raises(TypeError):
+            json_codec.dumps({'value': object()})
+
+    def test_loads_bytes(self, json_codec):
+        assert json_codec.loads(b'{"a": "caf\xc3\xa9"}') == {'a': 'caf\xe9'}
+
+    def test_loads_encoding(self, json_codec):
+        data = '{"a": "caf\xe9"}'
+        for encoding in ('utf-8', 'latin-1', 'utf-16'):
+            assert (json_codec.loads(data.encode(encoding),
+                                     encoding=encoding) == {'a': 'caf\xe9'})
+
+    def test_loads_bom(self, json_codec):
+        assert json_codec.loads(b'\xef\xbb\xbf{"a": 1}') == {'a': 1}
+
+    def test_loads_invalid(self, json_codec):
+        for value in (b'', b'[1,', b'{"a"}', b'\xff\xfe\xfd', '[invalid'):
+            with pytest.raises(ValueError):
+                json_codec.loads(value)
+
+    def test_raw_decode(self, json_codec):
+        assert json_codec.raw_decode('[1, {"a": 2}] x') == ([1, {'a': 2}], 13)
+        assert json_codec.raw_decode('x "caf\xe9", 1', 2) == ('caf\xe9', 8)
+        with pytest.raises(ValueError):
+            json_codec.raw_decode('[1,')
+
+    def test_cross_compatible(self):
+        for first in CODECS:
+            for second in CODECS:
+                for value in self.values + self.floats + self.strings:
+                    assert second.loads(first.dumps(value)) == value
+
+    def test_module_functions(self):
+        assert codec.loads(codec.dumps({'a': [1.5]})) == {'a': [1.5]}
+        assert codec.loads(b'"caf\xe9"', encoding='latin-1') == 'caf\xe9'
+        assert codec.raw_decode('{} []', 2) == ([], 5)
@@ -3,6 +3,10 @@ import warnings
 from pymysql import err
 from sqlalchemy import text
 
+from ichnaea.db import (
+    bulk_update,
+    bulk_upsert,
+)
 from ichnaea.models.wifi import WifiShard0
 
 
@@ -51,3 +55,50 @@ class TestDatabase(object):
                 set(['000000100000', '000000300000']))
         assert (set([row.region for row in rows]) ==
                 set(['DE', u'\xe4']))
+
+    def test_bulk_upsert(self, session):
+        session.add(WifiShard0(mac='000000100000', region='DE', samples=1))
+        session.commit()
+
+        bulk_upsert(session, WifiShard0.__table__, [
+            {'mac': '000000300000', 'region': 'FR', 'samples': 2},
+            {'mac': '000000100000', 'region': 'GB', 'samples': 3},
+            {'mac': '000000200000', 'region': 'FR', 'samples': 4},
+            {'mac': '000000400000', 'region': 'FR'},
+        ], chunk_size=2)
+        session.commit()
+        rows = dict((row.mac, row) for row in session.query(WifiShard0))
+        assert len(rows) == 4
+        assert rows['000000100000'].region == 'GB'
+        assert rows['000000100000'].samples == 3
+        assert rows['000000200000'].samples == 4
+        assert rows['000000400000'].samples is None
+
+        bulk_upsert(session, WifiShard0.__table__, [
+            {'mac': '000000100000', 'region': 'DE', 'samples': 5},
+        ], update=('samples', ))
+        session.commit()
+        row = session.query(WifiShard0).get('000000100000')
+        assert row.region == 'GB'
+        assert row.samples == 5
+
+    def test_bulk_update(self, session):
+        session.add_all([
+            WifiShard0(mac='000000100000', region='DE', samples=1),
+            WifiShard0(mac='000000200000', region='DE', samples=2),
+        ])
+        session.commit()
+
+        bulk_update(session, WifiShard0.__table__, [
+            {'mac': '000000300000', 'region': 'FR', 'samples': 3},
+            {'mac': '000000200000', 'region': 'FR', 'samples': 4},
+            {'mac': '000000100000', 'samples': 5},
+        ], chunk_size=1)
+        session.commit()
+        rows = dict((row.mac, row) for row in session.query(WifiShard0))
+        # Rows which don't exist aren't inserted.
+        assert set(rows) == set(['000000100000', '000000200000'])
+        assert rows['000000100000'].region == 'DE'
+        assert rows['000000100000'].samples == 5
+        assert rows['000000200000'].region == 'FR'
+        assert rows['000000200000'].samples == 4
@@ -1,5 +1,7 @@
 import time
 
+from ichnaea.log import StageTimer
+
 
 class TestStatsAPI(object):
 
@@ -46,3 +48,51 @@ class TestStatsAPI(object):
         stats.incr('metric', 1, tags=['t2:v2', 't1:v1'])
         stats.check(
             counter=[('metric', 1, 1, ['t2:v2', 't1:v1'])])
+
+
+class TestStageTimer(object):
+
+    def test_stage(self):
+        timer = StageTimer()
+        with timer.stage('fetch', 'wifi'):
+            time.sleep(0.001)
+        with timer.stage('store'):
+            pass
+        assert list(timer.durations.keys()) == [('fetch', 'wifi'),
+                                                ('store', None)]
+        assert 0.0007 < timer.durations[('fetch', 'wifi')] < 0.01
+
+    def test_repeated(self):
+        timer = StageTimer()
+        for i in range(2):
+            with timer.stage('aggregate', 'cell'):
+                time.sleep(0.001)
+        assert len(timer.durations) == 1
+        assert timer.durations[('aggregate', 'cell')] > 0.0015
+
+    def test_exception(self):
+        timer = StageTimer()
+        try:
+            with timer.stage('lookup'):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert ('lookup', None) in timer.durations
+
+    def test_send(self, stats):
+        timer = StageTimer()
+        timer.durations[('get_key', None)] = 0.0024
+        timer.durations[('fetch', 'wifi')] = 0.013
+        timer.send(stats, 'locate.timing', tags=['path:v1.geolocate'])
+        stats.check(timer=[
+            ('locate.timing', 1, 2, ['path:v1.geolocate', 'stage:get_key']),
+            ('locate.timing', 1, 13,
+                ['path:v1.geolocate', 'stage:fetch', 'source:wifi']),
+        ])
+
+    def test_header(self):
+        timer = StageTimer()
+        assert timer.header() == ''
+        timer.durations[('get_key', None)] = 0.0024
+        timer.durations[('fetch', 'wifi')] = 0.013
+        assert timer.header() == 'get_key;dur=2.4, wifi.fetch;dur=13.0'
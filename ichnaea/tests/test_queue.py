@@ -1,13 +1,26 @@
+import time
+from unittest import mock
 from uuid import uuid4
 
-from ichnaea.queue import DataQueue
+import pytest
+from redis import RedisError
+
+from ichnaea.queue import (
+    BatchController,
+    BufferedDataQueue,
+    DataQueue,
+    ready_queues,
+    StreamDataQueue,
+)
 
 
 class TestDataQueue(object):
 
-    def _make_queue(self, redis, batch=0, compress=False, json=True):
-        return DataQueue(uuid4().hex, redis,
-                         batch=batch, compress=compress, json=json)
+    def _make_queue(self, redis, batch=0, compress=False, json=True,
+                    frames=None, key=None, reliable=False):
+        return DataQueue(key or uuid4().hex, redis,
+                         batch=batch, compress=compress, json=json,
+                         frames=frames, reliable=reliable)
 
     def test_objects(self, redis):
         queue = self._make_queue(redis)
@@ -72,3 +85,537 @@ class TestDataQueue(object):
         assert queue.size() == 2
         queue.dequeue()
         assert queue.size() == 0
+
+    def test_frames(self, redis):
+        for frames in ('zlib', 'report'):
+            queue = self._make_queue(redis, frames=frames)
+            items = [{'a': 1}, 'b', 2]
+            queue.enqueue(items)
+            assert redis.llen(queue.key) == 1
+            assert queue.size() == 3
+            assert queue.dequeue() == items
+            assert queue.size() == 0
+            assert not redis.exists(queue.count_key)
+
+    def test_frames_binary(self, redis):
+        queue = self._make_queue(redis, json=False, frames='zlib')
+        items = [b'\x00ab', b'', b'\xf1123']
+        queue.enqueue(items)
+        assert queue.dequeue() == items
+
+    def test_frames_batch(self, redis):
+        queue = self._make_queue(redis, batch=2, frames='zlib')
+        queue.enqueue([1, 2, 3, 4, 5, 6])
+        assert redis.llen(queue.key) == 3
+        assert queue.size() == 6
+        # Only whole frames are returned.
+        assert queue.dequeue(batch=3) == [1, 2, 3, 4]
+        assert queue.size() == 2
+        queue.enqueue([7])
+        assert queue.dequeue(batch=0) == [5, 6, 7]
+        assert queue.size() == 0
+
+    def test_frames_compression(self, redis):
+        items = [{'api_key': 'test', 'report': {
+            'position': {'latitude': 51.5 + i * 0.001, 'longitude': -0.1},
+            'wifiAccessPoints': [{'macAddress': '3680873e9b%02x' % i,
+                                  'signalStrength': -80}],
+        }} for i in range(20)]
+        gzip_queue = self._make_queue(redis, compress=True)
+        gzip_queue.enqueue(items)
+        zlib_queue = self._make_queue(redis, frames='zlib')
+        zlib_queue.enqueue(items)
+        report_queue = self._make_queue(redis, frames='report')
+        report_queue.enqueue(items)
+
+        def memory(queue):
+            return sum(len(value) for value in
+                       redis.lrange(queue.key, 0, -1))
+
+        assert memory(zlib_queue) * 3 < memory(gzip_queue)
+        assert memory(report_queue) < memory(zlib_queue)
+        assert report_queue.dequeue() == items
+
+    def test_frames_legacy(self, redis):
+        queue = self._make_queue(redis, compress=True)
+        queue.enqueue([1, 2])
+        framed = self._make_queue(redis, frames='report', key=queue.key)
+        framed.enqueue([3, 4])
+        assert framed.dequeue(batch=3) == [1, 2, 3, 4]
+        assert not redis.exists(framed.count_key)
+
+    def test_frames_pipe(self, redis):
+        queue = self._make_queue(redis, frames='zlib')
+        pipe = redis.pipeline()
+        queue.enqueue([1, 2, 3], pipe=pipe)
+        assert queue.size() == 0
+        pipe.execute()
+        assert queue.size() == 3
+
+    def test_frames_ready(self, redis):
+        queue = self._make_queue(redis, batch=4, frames='zlib')
+        assert not queue.ready()
+        queue.enqueue(['a', 'b', 'c'])
+        assert not queue.ready()
+        queue.enqueue(['d'])
+        assert queue.ready()
+        redis.expire(queue.key, 70000)
+        queue.dequeue(batch=3)
+        assert queue.ready()
+
+    def test_frames_unknown(self, redis):
+        with pytest.raises(ValueError):
+            self._make_queue(redis, frames='unknown')
+
+    def test_reserve(self, redis):
+        queue = self._make_queue(redis, batch=2)
+        queue.enqueue([1, 2, 3])
+        batch = queue.reserve()
+        assert batch.token is None
+        assert batch.items == [1, 2]
+        assert batch.deliveries == 1
+        queue.ack(batch.token)
+        assert queue.size() == 1
+
+    def test_reliable(self, redis):
+        queue = self._make_queue(redis, batch=2, compress=True, reliable=True)
+        queue.enqueue([{'a': 1}, 'b', 2])
+        batch = queue.reserve()
+        assert batch.token
+        assert batch.items == [{'a': 1}, 'b']
+        assert batch.deliveries == 1
+        assert queue.size() == 1
+        assert redis.zcard(queue.processing_key) == 1
+
+        queue.ack(batch.token)
+        assert not redis.exists(queue.key + ':batch:' + batch.token)
+        assert redis.zcard(queue.processing_key) == 0
+        assert redis.hlen(queue.deliveries_key) == 0
+
+        batch = queue.reserve(batch=0)
+        assert batch.items == [2]
+        pipe = redis.pipeline()
+        queue.ack(batch.token, pipe=pipe)
+        assert redis.zcard(queue.processing_key) == 1
+        pipe.execute()
+        assert redis.zcard(queue.processing_key) == 0
+
+        batch = queue.reserve()
+        assert batch.token is None
+        assert batch.items == []
+
+    def test_reliable_redeliver(self, redis, stats):
+        queue = self._make_queue(redis, batch=2, reliable=True)
+        queue.enqueue([1, 2, 3])
+        first = queue.reserve(stats_client=stats)
+        # The first batch isn't expired yet.
+        assert queue.reserve(stats_client=stats).items == [3]
+
+        redis.zadd(queue.processing_key, 0, first.token)
+        batch = queue.reserve(stats_client=stats)
+        assert batch.token == first.token
+        assert batch.items == [1, 2]
+        assert batch.deliveries == 2
+        stats.check(counter=[
+            ('queue.redeliver', 1, 2, ['queue:' + queue.key]),
+        ])
+
+    def test_reliable_poison(self, redis, stats):
+        queue = self._make_queue(redis, batch=2, reliable=True)
+        queue.processing_timeout = -1
+        queue.max_deliveries = 2
+        queue.enqueue([1, 2])
+        assert queue.reserve(stats_client=stats).deliveries == 1
+        assert queue.reserve(stats_client=stats).deliveries == 2
+
+        queue.enqueue([3])
+        batch = queue.reserve(stats_client=stats)
+        assert batch.items == [3]
+        assert batch.deliveries == 1
+        assert redis.lrange(queue.dead_key, 0, -1) == [b'1', b'2']
+        stats.check(counter=[
+            ('queue.redeliver', 1, 2, ['queue:' + queue.key]),
+            ('queue.poison', 1, 1, ['queue:' + queue.key]),
+        ])
+
+    def test_reliable_frames(self, redis):
+        with pytest.raises(ValueError):
+            self._make_queue(redis, frames='zlib', reliable=True)
+
+    def test_controller(self, redis, stats):
+        queue = self._make_queue(redis, batch=2)
+        queue.controller = BatchController(2, 10, batch=2)
+        queue.enqueue(list(range(10)))
+        assert queue.dequeue() == [0, 1]
+        queue.adapt(0.1, stats_client=stats)
+        assert queue.dequeue() == [2, 3, 4]
+        queue.adapt(0.1, conflicts=1, stats_client=stats)
+        assert queue.dequeue() == [5, 6]
+        stats.check(gauge=[
+            ('queue.batch', 1, 3, ['queue:' + queue.key]),
+            ('queue.batch', 1, 2, ['queue:' + queue.key]),
+        ])
+
+    def test_trigger(self, redis):
+        queue = self._make_queue(redis, batch=2)
+        queue.trigger = trigger = mock.Mock()
+        queue.enqueue([1])
+        trigger.assert_called_once_with(countdown=queue.trigger_max_age)
+        assert redis.ttl(queue.key + ':trigger:delayed') > 0
+
+        # The delayed trigger is only called once.
+        trigger.reset_mock()
+        queue.enqueue([1, 2, 3])
+        trigger.assert_called_once_with(countdown=0)
+        queue.enqueue([4, 5])
+        assert trigger.call_count == 1
+
+        redis.delete(queue.key + ':trigger')
+        queue.enqueue([6, 7])
+        assert trigger.call_count == 2
+
+    def test_trigger_pipe(self, redis):
+        queue = self._make_queue(redis, batch=2)
+        queue.trigger = trigger = mock.Mock()
+        with redis.pipeline() as pipe:
+            queue.enqueue([1, 2], pipe=pipe)
+            pipe.execute()
+        assert not trigger.called
+        queue.notify()
+        trigger.assert_called_once_with(countdown=0)
+
+    def test_trigger_empty(self, redis):
+        queue = self._make_queue(redis, batch=2)
+        queue.trigger = trigger = mock.Mock()
+        queue.notify()
+        queue.enqueue([])
+        assert not trigger.called
+
+
+class TestStreamDataQueue(object):
+
+    @pytest.fixture(autouse=True)
+    def require_streams(self, redis_version):
+        if redis_version < (5, 0):
+            pytest.skip('Redis Streams require Redis 5.0')
+
+    @pytest.fixture
+    def require_shared(self, redis_version):
+        if redis_version < (6, 2):
+            pytest.skip('Shared stream queues require Redis 6.2')
+
+    def _make_queue(self, redis, batch=0, compress=False, json=True,
+                    partitions=4):
+        return StreamDataQueue(uuid4().hex, redis,
+                               batch=batch, compress=compress, json=json,
+                               partitions=partitions)
+
+    def test_objects(self, redis):
+        queue = self._make_queue(redis, partitions=1)
+        items = [{'a': 1}, 'b', 2]
+        queue.enqueue(items)
+        assert queue.size() == 3
+        assert queue.dequeue() == items
+        assert queue.size() == 0
+        assert queue.dequeue() == []
+
+    def test_compress_binary(self, redis):
+        queue = self._make_queue(
+            redis, compress=True, json=False, partitions=1)
+        queue.enqueue([b'\x00ab', b'\xff'])
+        assert queue.dequeue() == [b'\x00ab', b'\xff']
+
+    def test_partitions(self, redis):
+        queue = self._make_queue(redis, partitions=3)
+        keys = ['key%s' % (i % 5) for i in range(30)]
+        queue.enqueue(list(range(30)), keys=keys)
+        assert queue.size() == 30
+
+        found = {}
+        for _ in range(3):
+            items = queue.dequeue()
+            partitions = set(queue.partition(keys[item]) for item in items)
+            assert len(partitions) == 1
+            for item in items:
+                found.setdefault(keys[item], []).append(item)
+        assert queue.size() == 0
+        assert found == {
+            'key%s' % i: list(range(i, 30, 5)) for i in range(5)}
+
+    def test_concurrent(self, redis):
+        queue = self._make_queue(redis, partitions=2)
+        keys = [str(i) for i in range(20)]
+        queue.enqueue(list(range(20)), keys=keys)
+        first = queue.reserve()
+        second = queue.reserve()
+        assert first.token[0] != second.token[0]
+        assert set(first.items + second.items) == set(range(20))
+        # Both partitions are locked.
+        assert queue.reserve().items == []
+
+        queue.ack(first.token)
+        queue.ack(second.token)
+        assert queue.size() == 0
+        assert queue.reserve().token is None
+
+    def test_pipe(self, redis):
+        queue = self._make_queue(redis, partitions=1)
+        with redis.pipeline() as pipe:
+            queue.enqueue([1, 2], pipe=pipe)
+            assert queue.size() == 0
+            pipe.execute()
+        assert queue.size() == 2
+
+        batch = queue.reserve()
+        pipe = redis.pipeline()
+        queue.ack(batch.token, pipe=pipe)
+        assert queue.size() == 2
+        pipe.execute()
+        assert queue.size() == 0
+
+    def test_redeliver(self, redis, stats):
+        queue = self._make_queue(redis, batch=2, partitions=1)
+        queue.enqueue([1, 2, 3])
+        first = queue.reserve(stats_client=stats)
+        assert first.items == [1, 2]
+        # The partition is still locked.
+        assert queue.reserve(stats_client=stats).items == []
+
+        redis.delete(first.token[0] + ':lock')
+        batch = queue.reserve(stats_client=stats)
+        assert batch.items == [1, 2]
+        assert batch.deliveries == 2
+        # The expired lock can no longer be released.
+        queue.ack((first.token[0], first.token[1], []))
+        assert redis.exists(first.token[0] + ':lock')
+
+        queue.ack(batch.token)
+        assert queue.dequeue() == [3]
+        stats.check(counter=[
+            ('queue.redeliver', 1, 2, ['queue:' + queue.key]),
+        ])
+
+    def test_poison(self, redis, stats):
+        queue = self._make_queue(redis, batch=2, partitions=1)
+        queue.max_deliveries = 2
+        queue.enqueue([1, 2, 3])
+        for deliveries in (1, 2):
+            batch = queue.reserve(stats_client=stats)
+            assert batch.deliveries == deliveries
+            redis.delete(batch.token[0] + ':lock')
+
+        batch = queue.reserve(stats_client=stats)
+        assert batch.items == [3]
+        assert batch.deliveries == 1
+        assert redis.lrange(queue.dead_key, 0, -1) == [b'1', b'2']
+        stats.check(counter=[
+            ('queue.redeliver', 1, 2, ['queue:' + queue.key]),
+            ('queue.poison', 1, 1, ['queue:' + queue.key]),
+        ])
+
+    def test_shared(self, redis, require_shared):
+        key = uuid4().hex
+        first = StreamDataQueue(key, redis, batch=2, partitions=1,
+                                group='first')
+        second = StreamDataQueue(key, redis, batch=2, partitions=1,
+                                 group='second')
+        assert first.reserve().items == []
+        assert second.reserve().items == []
+        first.enqueue([1, 2, 3])
+        assert first.size() == 3
+        assert second.size() == 3
+        assert first.ready()
+
+        batch = first.reserve()
+        assert batch.items == [1, 2]
+        first.ack(batch.token)
+        assert first.size() == 1
+        assert second.size() == 3
+        assert first.dequeue() == [3]
+        assert not first.ready()
+        assert second.ready()
+
+        first.trim(['first', 'second'])
+        assert redis.execute_command('XLEN', first.stream_keys[0]) == 3
+        assert second.dequeue() == [1, 2]
+        first.trim(['first', 'second'])
+        assert redis.execute_command('XLEN', first.stream_keys[0]) == 2
+        assert second.dequeue() == [3]
+        assert second.size() == 0
+
+        # Unknown groups are removed, late groups read remaining items.
+        third = StreamDataQueue(key, redis, batch=2, partitions=1,
+                                group='third')
+        first.trim(['first', 'third'])
+        assert third.size() == 2
+        assert third.dequeue() == [2, 3]
+        assert third.size() == 0
+        first.enqueue([4])
+        assert third.size() == 1
+        assert not third.ready()
+        third.queue_max_age = 0
+        assert third.ready()
+
+    def test_shared_partitions(self, redis, require_shared):
+        key = uuid4().hex
+        StreamDataQueue(key, redis, partitions=2).enqueue(
+            [1, 2, 3, 4], keys=['a', 'b', 'c', 'd'])
+        shared_queue = StreamDataQueue(
+            key, redis, partitions=2, group='test')
+        assert shared_queue.size() == 4
+        items = shared_queue.dequeue()
+        assert shared_queue.size() == 4 - len(items)
+        items += shared_queue.dequeue()
+        assert sorted(items) == [1, 2, 3, 4]
+        assert shared_queue.size() == 0
+
+    def test_ready(self, redis):
+        queue = self._make_queue(redis, batch=2, partitions=2)
+        assert not queue.ready()
+        queue.enqueue([1], keys=['a'])
+        assert not queue.ready()
+        queue.enqueue([2], keys=['a'])
+        assert queue.ready()
+        assert not queue.ready(batch=3)
+        queue.queue_max_age = 0
+        assert queue.ready(batch=3)
+
+    def test_ready_queues(self, redis, require_shared):
+        data_queue = DataQueue(uuid4().hex, redis, batch=2)
+        stream_queue = self._make_queue(redis, batch=2, partitions=2)
+        key = uuid4().hex
+        StreamDataQueue(key, redis, partitions=1).enqueue([1, 2, 3])
+        shared_queue = StreamDataQueue(
+            key, redis, batch=2, partitions=1, group='test')
+        queues = [data_queue, stream_queue, shared_queue]
+        assert ready_queues(redis, queues) == [False, False, True]
+
+        data_queue.enqueue([1, 2])
+        stream_queue.enqueue([1], keys=['a'])
+        assert ready_queues(redis, queues) == [True, False, True]
+        assert ready_queues(redis, []) == []
+
+        stream_queue.enqueue([2], keys=['a'])
+        shared_queue.dequeue(batch=2)
+        assert ready_queues(redis, queues) == [True, True, False]
+        assert ([queue.ready() for queue in queues] ==
+                ready_queues(redis, queues))
+
+
+class TestBatchController(object):
+
+    def test_grow(self):
+        controller = BatchController(10, 100, batch=20)
+        assert controller.next_batch(1000) == 20
+        assert controller.update(1.0) == 30
+        for _ in range(10):
+            controller.next_batch(1000)
+            controller.update(1.0)
+        assert controller.batch == 100
+
+    def test_slow(self):
+        controller = BatchController(10, 100, batch=80, target_duration=10.0)
+        controller.next_batch(1000)
+        assert controller.update(20.0) == 40
+        assert controller.update(100.0) == 10
+
+    def test_conflicts(self):
+        controller = BatchController(10, 100, batch=80)
+        controller.next_batch(1000)
+        assert controller.update(1.0, conflicts=2) == 40
+        assert controller.update(1.0, conflicts=1) == 20
+
+    def test_quiet(self):
+        controller = BatchController(10, 100, batch=90)
+        controller.next_batch(50)
+        assert controller.update(1.0) == 60
+        controller.next_batch(0)
+        assert controller.update(0.1) == 40
+        for _ in range(4):
+            controller.next_batch(0)
+            controller.update(0.1)
+        assert controller.batch == 10
+
+
+class TestBufferedDataQueue(object):
+
+    @pytest.fixture
+    def make_queue(self, redis):
+        queues = []
+
+        def _make(stats=None, raven=None,
+                  batch=3, interval=3600.0, max_size=5):
+            queue = DataQueue(uuid4().hex, redis)
+            buffered = BufferedDataQueue(
+                queue, raven_client=raven, stats_client=stats,
+                batch=batch, interval=interval, max_size=max_size)
+            queues.append(buffered)
+            return buffered
+
+        yield _make
+        for buffered in queues:
+            buffered.close()
+
+    def test_batch(self, make_queue):
+        buffered = make_queue()
+        buffered.enqueue([1])
+        buffered.enqueue([2])
+        assert buffered.size() == 2
+        assert buffered.queue.size() == 0
+        buffered.enqueue([3])
+        assert buffered.size() == 0
+        assert buffered.queue.dequeue() == [1, 2, 3]
+
+    def test_interval(self, make_queue):
+        buffered = make_queue(interval=0.0)
+        buffered.enqueue([1])
+        assert buffered.size() == 0
+        assert buffered.queue.dequeue() == [1]
+
+    def test_timer(self, make_queue):
+        buffered = make_queue(interval=0.01)
+        buffered.enqueue([1])
+        # The background thread flushes without any further enqueue.
+        for i in range(500):
+            if not buffered.size():
+                break
+            time.sleep(0.01)
+        assert buffered.size() == 0
+        assert buffered.queue.dequeue() == [1]
+
+        buffered.close()
+        assert buffered._timer is None
+        buffered.enqueue([2])
+        assert buffered._timer.is_alive()
+        buffered.close()
+        assert buffered.queue.dequeue() == [2]
+
+    def test_flush(self, make_queue):
+        buffered = make_queue()
+        buffered.flush()
+        buffered.enqueue([1, 2])
+        buffered.flush()
+        assert buffered.size() == 0
+        assert buffered.queue.dequeue() == [1, 2]
+
+    def test_max_size(self, make_queue, stats):
+        buffered = make_queue(stats=stats, batch=10)
+        buffered.enqueue([1, 2, 3, 4])
+        buffered.enqueue([5, 6, 7])
+        assert buffered.size() == 5
+        buffered.flush()
+        assert buffered.queue.dequeue() == [1, 2, 3, 4, 5]
+        stats.check(counter=[
+            ('queue.buffer.drop', 1, 2, ['queue:' + buffered.key]),
+        ])
+
+    def test_failure(self, raven, make_queue, stats):
+        buffered = make_queue(stats=stats, raven=raven)
+        with mock.patch.object(buffered.queue, 'enqueue',
+                               side_effect=RedisError()):
+            buffered.enqueue([1, 2, 3])
+        assert buffered.size() == 0
+        raven.check([('RedisError', 1)])
+        stats.check(counter=[
+            ('queue.buffer.drop', 1, 3, ['queue:' + buffered.key]),
+        ])
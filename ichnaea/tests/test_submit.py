@@ -0,0 +1,148 @@
+import base64
+
+import pytest
+
+from ichnaea.api.submit.schema_v0 import SUBMIT_V0_SCHEMA
+from ichnaea.api.submit.schema_v1 import SUBMIT_V1_SCHEMA
+from ichnaea import codec
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
+from ichnaea.submit import (
+    check_body,
+    deferred_item,
+    expand_deferred,
+    report_items,
+)
+from ichnaea.tests.factories import WifiShardFactory
+from ichnaea import util
+
+
+class TestSubmit(object):
+
+    def _data(self, num=2):
+        wifis = WifiShardFactory.build_batch(num)
+        return {'items': [{
+            'latitude': wifi.lat,
+            'longitude': wifi.lon,
+            'wifiAccessPoints': [{'macAddress': wifi.mac}],
+        } for wifi in wifis]}
+
+    def _expected(self, schema, data, valid_key='test'):
+        items = report_items(valid_key, schema.deserialize(data)['items'])
+        for item in items:
+            # The report timestamp defaults to the time of validation.
+            del item['report']['timestamp']
+        return items
+
+    def _expand(self, item):
+        items = expand_deferred(codec.loads(codec.dumps(item)))
+        for item in items:
+            del item['report']['timestamp']
+        return items
+
+    def test_report_items(self):
+        items = report_items('test', [
+            None,
+            {'position': {'source': 'query'}},
+            {'position': {}},
+        ])
+        assert ([item['source'] for item in items] ==
+                ['gnss', 'query', 'gnss'])
+        assert set([item['api_key'] for item in items]) == set(['test'])
+
+    def test_check_body(self):
+        body = b' \n{"a": 1, "items": [1, 2]}'
+        assert check_body(body) == ' \n{"a": 1, "items": [1, 2]}'
+        assert check_body(b'{"items": []}', encoding='latin-1') == (
+            '{"items": []}')
+        gzipped = util.encode_gzip(body)
+        assert check_body(gzipped, gzip=True) == gzipped
+
+    def test_check_body_chunks(self):
+        body = ('{"other": "%s", "items": []}' % ('a' * 70000)).encode()
+        assert check_body(util.encode_gzip(body), gzip=True)
+        with pytest.raises(BodyTooLargeError):
+            check_body(util.encode_gzip(body), gzip=True, max_size=1000)
+
+    def test_check_body_invalid(self):
+        with pytest.raises(BodyTooLargeError):
+            check_body(b'{"items": []}', max_size=10)
+        with pytest.raises(GZIPDecodeError):
+            check_body(b'{"items": []}', gzip=True)
+        with pytest.raises(GZIPDecodeError):
+            check_body(b'\x1f\x8b\x08\x00invalid', gzip=True)
+        for body in (b'', b'  ', b'[1]', b'{}', b'{"item": 1}', b'\xff{'):
+            with pytest.raises(ValueError):
+                check_body(body)
+
+    def test_deferred_item(self):
+        item = deferred_item('test', 'v1.geosubmit', '{"items": []}',
+                             charset='UTF-8')
+        assert item == {
+            'api_key': 'test',
+            'deferred': {
+                'charset': 'UTF-8',
+                'gzip': False,
+                'path': 'v1.geosubmit',
+                'text': '{"items": []}',
+            },
+        }
+
+    def test_deferred_item_gzip(self):
+        body = util.encode_gzip('{"items": []}')
+        item = deferred_item('test', 'v1.geosubmit', body, gzip=True)
+        assert item['deferred']['body'] == (
+            base64.b64encode(body).decode('ascii'))
+        assert item['deferred']['gzip']
+
+    def test_expand(self):
+        data = self._data()
+        item = deferred_item('test', 'v1.geosubmit', codec.dumps(data))
+        assert (self._expand(item) ==
+                self._expected(SUBMIT_V1_SCHEMA, data))
+
+    def test_expand_gzip(self):
+        data = self._data()
+        item = deferred_item(
+            None, 'v1.geosubmit',
+            util.encode_gzip(codec.dumps(data)), gzip=True)
+        assert (self._expand(item) ==
+                self._expected(SUBMIT_V1_SCHEMA, data, valid_key=None))
+
+    def test_expand_v0(self):
+        wifi = WifiShardFactory.build()
+        data = {'items': [{
+            'lat': wifi.lat,
+            'lon': wifi.lon,
+            'wifi': [{'key': wifi.mac}],
+        }]}
+        item = deferred_item('test', 'v1.submit', codec.dumps(data))
+        items = self._expand(item)
+        assert items == self._expected(SUBMIT_V0_SCHEMA, data)
+        assert items[0]['report']['position']['latitude'] == wifi.lat
+
+    def test_expand_max_items(self, stats):
+        data = self._data(3)
+        item = deferred_item('test', 'v1.geosubmit', codec.dumps(data))
+        items = expand_deferred(item, stats_client=stats, max_items=2)
+        assert len(items) == 2
+        stats.check(counter=[('data.report.drop', 1, 1, ['key:test'])])
+
+    def test_expand_invalid(self, stats):
+        for path, body, gzip in (
+                ('v1.geosubmit', '{"items": [1', False),
+                ('v1.geosubmit', '[1]', False),
+                ('v1.geosubmit', '{}', False),
+                ('v1.geosubmit', b'{"items": []}', True),
+                ('unknown', codec.dumps(self._data()), False)):
+            item = deferred_item(None, path, body, gzip=gzip)
+            assert expand_deferred(item, stats_client=stats) == []
+        stats.check(counter=[('data.batch.drop', 5)])
+
+    def test_expand_too_large(self, stats):
+        body = util.encode_gzip(codec.dumps(self._data()))
+        item = deferred_item('test', 'v1.geosubmit', body, gzip=True)
+        assert expand_deferred(item, stats_client=stats, max_size=100) == []
+        stats.check(counter=[('data.batch.drop', 1, 1, ['key:test'])])
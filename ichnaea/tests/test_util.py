@@ -3,7 +3,10 @@ from datetime import datetime
 import pytest
 from pytz import UTC
 
-from ichnaea.exceptions import GZIPDecodeError
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
 from ichnaea import util
 
 
@@ -42,6 +45,11 @@ class TestUtil(object):
         assert isinstance(result, bytes)
         assert result == b'\x00ab'
 
+    def test_decode_gzip_max_size(self):
+        assert util.decode_gzip(self.gzip_foo, max_size=3) == u'foo'
+        with pytest.raises(BodyTooLargeError):
+            util.decode_gzip(self.gzip_foo, max_size=2)
+
     def test_decode_gzip_error(self):
         with pytest.raises(GZIPDecodeError):
             util.decode_gzip(self.gzip_foo[:1])
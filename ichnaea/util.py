@@ -9,7 +9,10 @@ import zlib
 
 from pytz import UTC
 
-from ichnaea.exceptions import GZIPDecodeError
+from ichnaea.exceptions import (
+    BodyTooLargeError,
+    GZIPDecodeError,
+)
 
 
 @contextmanager
@@ -36,15 +39,22 @@ def encode_gzip(data, compresslevel=6, encoding='utf-8'):
     return out.getvalue()
 
 
-def decode_gzip(data, encoding='utf-8'):
+def decode_gzip(data, encoding='utf-8', max_size=0):
     """Decode the bytes data and return a Unicode string.
 
-    :raises: :exc:`~ichnaea.exceptions.GZIPDecodeError`
+    :param max_size: The maximum size of the decompressed data in
+                     bytes, zero for no limit.
+
+    :raises: :exc:`~ichnaea.exceptions.GZIPDecodeError`,
+             :exc:`~ichnaea.exceptions.BodyTooLargeError`
     """
     try:
         with gzip.GzipFile(None, mode='rb',
                            fileobj=BytesIO(data)) as gzip_file:
-            out = gzip_file.read()
+            out = gzip_file.read(max_size + 1 if max_size else -1)
+        if max_size and len(out) > max_size:
+            raise BodyTooLargeError(
+                'Decompressed data larger than %s bytes.' % max_size)
         if encoding:
             return out.decode(encoding)
         return out
@@ -6,11 +6,17 @@ from pyramid.config import Configurator
 from pyramid.tweens import EXCVIEW
 
 from ichnaea.api.config import configure_api
+from ichnaea.api.key import API_CACHE
 from ichnaea.api.locate.searcher import (
     configure_position_searcher,
     configure_region_searcher,
 )
+from ichnaea.api.rate_limit import configure_api_usage
 from ichnaea.cache import configure_redis
+from ichnaea.config import (
+    DATA_QUEUE_FRAMES,
+    DATA_QUEUE_TRIGGER,
+)
 from ichnaea.content.views import configure_content
 from ichnaea.db import (
     configure_db,
@@ -23,14 +29,17 @@ from ichnaea.log import (
     configure_raven,
     configure_stats,
 )
-from ichnaea.queue import DataQueue
+from ichnaea.queue import (
+    BufferedDataQueue,
+    DataQueue,
+)
 from ichnaea.webapp.monitor import configure_monitor
 
 
 def main(ping_connections=False,
          _db=None, _geoip_db=None, _http_session=None,
          _raven_client=None, _redis_client=None, _stats_client=None,
-         _position_searcher=None, _region_searcher=None):
+         _position_searcher=None, _region_searcher=None, _api_usage=None):
     """
     Configure the web app stored in :data:`ichnaea.webapp.app._APP`.
 
@@ -81,14 +90,31 @@ def main(ping_connections=False,
 
     registry.http_session = configure_http_session(_session=_http_session)
 
+    registry.api_usage = configure_api_usage(
+        redis_client, raven_client, _api_usage=_api_usage)
+
+    # Listen for API key changes.
+    API_CACHE.subscribe(redis_client)
+
     registry.geoip_db = geoip_db = configure_geoip(
         raven_client=raven_client, _client=_geoip_db)
 
     # Needs to be the exact same as the *_incoming entries in async.config.
     registry.data_queues = data_queues = {
         'update_incoming': DataQueue('update_incoming', redis_client,
-                                     batch=100, compress=True),
+                                     batch=100, compress=True,
+                                     frames=DATA_QUEUE_FRAMES),
     }
+    if DATA_QUEUE_TRIGGER:
+        # Only load the Celery app, if the web app sends tasks.
+        from ichnaea.async.app import celery_app
+        from ichnaea.async.config import configure_triggers
+        configure_triggers(celery_app, data_queues, raven_client=raven_client)
+    # Collect stored locate queries in memory and push them in batches.
+    data_queues['update_incoming_buffered'] = BufferedDataQueue(
+        data_queues['update_incoming'],
+        raven_client=raven_client, stats_client=stats_client,
+        batch=20, interval=5.0, max_size=5000)
 
     for name, func, default in (('position_searcher',
                                  configure_position_searcher,
@@ -119,6 +145,14 @@ def main(ping_connections=False,
 def shutdown_worker(app):
     registry = getattr(app, 'registry', None)
     if registry is not None:
+        for queue in registry.data_queues.values():
+            if isinstance(queue, BufferedDataQueue):
+                queue.close()
+        if registry.api_usage is not None:
+            registry.api_usage.flush()
+        del registry.api_usage
+        API_CACHE.unsubscribe()
+
         registry.db.close()
         del registry.db
         del registry.raven_client
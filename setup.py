@@ -54,7 +54,9 @@ setup(
     entry_points={
         'console_scripts': [
             'location_dump=ichnaea.scripts.dump:console_entry',
+            'location_benchmark=ichnaea.scripts.benchmark:console_entry',
             'location_map=ichnaea.scripts.datamap:console_entry',
+            'location_queues=ichnaea.scripts.queues:console_entry',
             'location_region_json=ichnaea.scripts.region_json:console_entry',
         ],
     },